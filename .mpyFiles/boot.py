@@ -1,30 +1,105 @@
 # import micropython
 # micropython.opt_level(3)
 
+import binascii
+import hashlib
+import struct
+from array import array
+
 import aioble
 import bluetooth
 import uasyncio
 import ujson
+import uos
 import utils
-from aioble.client import ClientCharacteristic, ClientService
-from machine import PWM, Pin
-
-REMOTE_FILE = "remote"
-SETTINGS_FILE = "settings"
-SELECTED_SETTINGS_FILE = "selected_setting"
-
-
-try:
-    current_setting: str = utils.load_file(SELECTED_SETTINGS_FILE)
-    if not current_setting.strip():
-        raise Exception
-    settings_cfg: dict[str, list[float]] = ujson.loads(utils.load_file(SETTINGS_FILE))
-except:
-    current_setting = "default"
-    settings_cfg = dict(default=[0.0, 0.25, 0.5, 0.75, 1.0])
-    utils.write_to_file(SELECTED_SETTINGS_FILE, current_setting)
-    utils.write_to_file(SETTINGS_FILE, ujson.dumps(settings_cfg))
+import utime
+from aioble.client import ClientCharacteristic, ClientDescriptor, ClientService
+from machine import PWM, Pin, Timer
+from store import RecordStore, StateFile
+
+REMOTES_FILE = "remotes.db"
+REMOTE_HANDLES_FILE = "remote_handles"
+LEGACY_REMOTE_FILE = "remote"
+LEGACY_REMOTE_ADDR_FILE = "remote_addr"
+LEGACY_REMOTE_COUNTER_FILE = "remote_counter"
+STATE_FILE = "state"
+SNAPSHOT_FILE = "snapshot"
+
+# Start scanning from the snapshot of the selected profile, and load everything else after the first scan window.
+FAST_BOOT = True
+FAST_BOOT_DEFER_MS = 1_000  # Longest wait for the first scan result before loading the rest
+ENABLE_PHONE = False
+# How paired remotes send presses, has to match TRANSPORT_ADV in remote.ino. 0: connect and wait for a
+# notification (RemoteHandler.TRANSPORT_GATT), 1: authenticated command in the remote's advertisement
+# (RemoteHandler.TRANSPORT_ADV).
+TRANSPORT = 0
+# Rebroadcast every applied command so receivers out of the remote's range follow it. Needs scanning, so
+# receivers in relay mode don't use the direct connect to a single remote. Relays are signed with a relay key the
+# phone gives every receiver (PhoneHandler, remotes characteristic), nothing is relayed without one.
+RELAY = False
+RELAY_TTL = 2  # Hops after the receiver that heard the remote
+# Let default-key remotes pair for RemoteHandler.PAIRING_WINDOW_MS after power on, next to the paired ones. Off, a
+# receiver with remotes only pairs more once the phone opens the window (RemoteHandler.open_pairing()), so a
+# power cut doesn't let every receiver in the building grab the unpaired remotes around it.
+PAIR_AFTER_BOOT = False
+
+# The remote path's view of the settings: the selected profile and the duty tables (only the selected one while
+# running from the snapshot). phone.py owns the settings store and the full config.
+current_setting = "default"
+duty_tables: dict[str, array] = {}
+radio_tiers: list[list[int]] = []
 setting_index = 1  # Start from lowest
+state_file: StateFile | None = None
+
+
+# phone.py is the bulk of the code, fast boot imports it only after the first scan window.
+def load_config():
+    global current_setting, duty_tables, radio_tiers
+    import phone
+
+    phone.load_settings()
+    current_setting, duty_tables = phone.current_setting, phone.duty_tables
+    radio_tiers = phone.load_radio_tiers()
+
+
+def use_profiles(name: str, tables: dict[str, array]):
+    global current_setting, duty_tables
+    current_setting, duty_tables = name, tables
+    write_snapshot()
+
+
+# Snapshot: <name len:u8><tier count:u8><name><tiers: 4 x u32 each><selected profile duties: u16 each>
+def load_snapshot() -> bool:
+    global current_setting, duty_tables, radio_tiers
+    try:
+        data = utils.load_bytes_file(SNAPSHOT_FILE)
+        offset = 2 + data[0]
+        name = data[2:offset].decode()
+        tiers = [list(struct.unpack_from("<IIII", data, offset + 16 * i)) for i in range(data[1])]
+        offset += 16 * data[1]
+        table = array("H", struct.unpack_from("<%dH" % ((len(data) - offset) // 2), data, offset))
+        if not tiers or not table:
+            return False
+    except:
+        return False
+    current_setting, radio_tiers, duty_tables = name, tiers, {name: table}
+    return True
+
+
+def write_snapshot():
+    table = duty_tables.get(current_setting)
+    if table is None:
+        return
+    name = current_setting.encode()
+    data = struct.pack("<BB", len(name), len(radio_tiers)) + name
+    data += b"".join(struct.pack("<IIII", *tier) for tier in radio_tiers)
+    data += struct.pack("<%dH" % len(table), *table)
+    try:
+        if utils.load_bytes_file(SNAPSHOT_FILE) == data:
+            return
+    except:
+        pass
+    utils.write_bytes_to_file(SNAPSHOT_FILE, data)
 
 
 ConnHandle = int
@@ -37,62 +112,388 @@ DefHandle = int  # handle of the characteristic declaration
 
 
 def r(delete=False):
-    import uos
-
-    try:
-        if delete:
-            uos.remove(REMOTE_FILE)
-    except:
-        pass
+    if delete:
+        for file in (
+            REMOTES_FILE,
+            REMOTE_HANDLES_FILE,
+            LEGACY_REMOTE_FILE,
+            LEGACY_REMOTE_ADDR_FILE,
+            LEGACY_REMOTE_COUNTER_FILE,
+        ):
+            try:
+                uos.remove(file)
+            except:
+                pass
     uasyncio.run(main())
 
 
 async def main():
+    global state_file, setting_index
+    fast = FAST_BOOT and load_snapshot()
+    if not fast:
+        load_config()
+
+    # Level survives reboots and brownouts, saves are debounced so a burst of presses is one write.
+    state_file = StateFile(STATE_FILE)
+    if state_file.state is not None:
+        setting_index = min(state_file.state[0], len(duty_tables[current_setting]) - 1)
+
     ble = bluetooth.BLE()
     ble.active(True)
+    radio = RadioScheduler(radio_tiers)
+    remote = RemoteHandler(ble, LED(26, duty_tables[current_setting][setting_index]), radio, TRANSPORT)
 
     try:
-        await uasyncio.gather(
-            RemoteHandler(ble, LED(26, settings_cfg["default"][setting_index])).serve(),
-            # PhoneHandler(ble).serve(),
-        )
+        tasks = [uasyncio.create_task(remote.serve())]
+        if fast:
+            try:
+                await uasyncio.wait_for_ms(remote.first_result.wait(), FAST_BOOT_DEFER_MS)
+            except uasyncio.TimeoutError:
+                pass
+            load_config()
+            radio.tiers = radio_tiers
+        write_snapshot()
+        if ENABLE_PHONE:
+            while remote.busy:  # Services can't be registered while the remote is connected
+                await uasyncio.sleep_ms(50)
+            import phone
+
+            tasks.append(uasyncio.create_task(phone.PhoneHandler(ble, radio, use_profiles, remote).serve()))
+        await uasyncio.gather(*tasks)
     except BaseException as e:
         print(e)
 
     ble.active(False)
 
 
+class RadioScheduler:
+    IDLE_RECHECK_MS = 10_000  # Longest single scan/advertise run once the last tier is reached
+
+    def __init__(self, tiers: list[list[int]]):
+        self.tiers = tiers
+        self.activity()  # Boot counts as activity
+
+    def activity(self):
+        self.last_activity = utime.ticks_ms()
+
+    # Returns the active tier and the ms left until it steps down.
+    def current(self) -> tuple[list[int], int]:
+        elapsed = utime.ticks_diff(utime.ticks_ms(), self.last_activity)
+        for tier in self.tiers:
+            hold_ms = tier[0]
+            if hold_ms <= 0:
+                break
+            if elapsed < hold_ms:
+                return tier, hold_ms - elapsed
+            elapsed -= hold_ms
+        return self.tiers[-1], self.IDLE_RECHECK_MS
+
+
 class LED:
-    def __init__(self, pin: int, init_percentage=0.0, freq=1000) -> None:
+    FADE_TICK_MS = 10
+    CURVES = {
+        "linear": lambda t: t,
+        "ease": lambda t: t * t * (3 - 2 * t),
+        "ease-in": lambda t: t * t,
+    }
+
+    def __init__(self, pin: int, init_duty=0, freq=1000, fade_ms=300, curve="ease", timer_id=0) -> None:
         self.led = PWM(Pin(pin), freq=freq)
-        self.control(init_percentage)
+        self.timer = Timer(timer_id)
+        self.duty = init_duty
+        self.led.duty(self.duty)
+
+        # Fade progress per tick in 1/255ths, so the timer callback only does small int math.
+        steps = fade_ms // self.FADE_TICK_MS
+        ease = self.CURVES[curve]
+        self.curve = bytes(round(255 * ease(i / steps)) for i in range(1, steps + 1)) if steps > 0 else b""
+        self.start = self.target = self.duty
+        self.step = 0
+        self._tick = self.tick  # Bound once, allocating in the timer callback is not allowed
+
+    # Starts (or retargets) a fade from the current duty. Runs from the timer, never blocks the caller.
+    def control(self, duty: int):
+        self.timer.deinit()
+        if not self.curve or duty == self.duty:
+            self.duty = self.target = duty
+            self.led.duty(duty)
+            return
+        self.start = self.duty
+        self.target = duty
+        self.step = 0
+        self.timer.init(period=self.FADE_TICK_MS, mode=Timer.PERIODIC, callback=self._tick)
+
+    def tick(self, _timer):
+        step = self.step
+        if step >= len(self.curve) - 1:
+            self.duty = self.target
+            self.timer.deinit()
+        else:
+            self.duty = self.start + (self.target - self.start) * self.curve[step] // 255
+            self.step = step + 1
+        self.led.duty(self.duty)
+
+
+class Remote:
+    def __init__(self, key: str, last_counter=0, device: aioble.Device | None = None, profiles=None):
+        self.key = key
+        self.key_id = hashlib.sha256(key.encode()).digest()[:2]
+        self.last_counter = last_counter  # Highest adv command counter accepted from this remote
+        self.device = device  # Last address the remote connected from
+        self.profiles: list[str] = profiles or []  # Profiles the remote may change, empty: all
+        self.last_seq: int | None = None  # Seq of the last notification, not persisted
+
+    def allows(self, profile: str) -> bool:
+        return not self.profiles or profile in self.profiles
+
+
+# Paired remotes, one record per remote: "r:<key>" -> <counter:u32><addr type:u8><addr:6s><profiles>
+# Addr type 0xFF: address not known yet. Profiles are newline separated names.
+REMOTE_PREFIX = "r:"
+REMOTE_RECORD = "<IB6s"
+REMOTE_RECORD_SIZE = 11
+NO_ADDR = 0xFF
+# Relay key, the same on every receiver: "g" -> <key>. Highest relayed counter of a remote that isn't paired here:
+# "c:<key id, hex>" -> <counter:u32>.
+RELAY_KEY_RECORD = "g"
+COUNTER_PREFIX = "c:"
+
+
+class RemoteRegistry:
+    def __init__(self, path: str):
+        self.store = RecordStore(path)
+        # Scan results are matched by advertised name (the key), adv commands by key id. Lookups are dict
+        # hits, so the scan loop costs the same with one remote or twenty.
+        self.by_key: dict[str, Remote] = {}
+        self.by_key_id: dict[bytes, Remote] = {}
+        for key, value in self.store.records.items():
+            if key.startswith(REMOTE_PREFIX):
+                self._index(self.decode(key[len(REMOTE_PREFIX) :], value))
+
+    def __len__(self) -> int:
+        return len(self.by_key)
+
+    def get(self, key: str) -> Remote | None:
+        return self.by_key.get(key)
+
+    def save(self, remote: Remote):
+        self._index(remote)
+        self.store.put(REMOTE_PREFIX + remote.key, self.encode(remote))
+
+    def remove(self, key: str):
+        remote = self.by_key.pop(key, None)
+        if remote is not None:
+            if self.by_key_id.get(remote.key_id) is remote:
+                del self.by_key_id[remote.key_id]
+            self.store.delete(REMOTE_PREFIX + key)
+
+    def relay_key(self) -> bytes:
+        return self.store.get(RELAY_KEY_RECORD, b"")
+
+    def set_relay_key(self, key: bytes):
+        self.store.put(RELAY_KEY_RECORD, key)
+
+    # Highest command counter seen from a remote, whether it's paired here or only heard through relays.
+    def last_counter(self, key_id: bytes) -> int:
+        remote = self.by_key_id.get(key_id)
+        if remote is not None:
+            return remote.last_counter
+        return struct.unpack("<I", self.store.get(self.counter_record(key_id), bytes(4)))[0]
+
+    def set_last_counter(self, key_id: bytes, counter: int):
+        remote = self.by_key_id.get(key_id)
+        if remote is not None:
+            remote.last_counter = counter
+            self.save(remote)
+        else:
+            self.store.put(self.counter_record(key_id), struct.pack("<I", counter))
+
+    @staticmethod
+    def counter_record(key_id: bytes) -> str:
+        return COUNTER_PREFIX + binascii.hexlify(key_id).decode()
+
+    def _index(self, remote: Remote):
+        self.by_key[remote.key] = remote
+        self.by_key_id[remote.key_id] = remote  # One remote per id, sync_keys() never hands out one in use
+
+    @staticmethod
+    def encode(remote: Remote) -> bytes:
+        if remote.device is None:
+            addr_type, addr = NO_ADDR, bytes(6)
+        else:
+            addr_type, addr = remote.device.addr_type, bytes(remote.device.addr)
+        return struct.pack(REMOTE_RECORD, remote.last_counter, addr_type, addr) + "\n".join(remote.profiles).encode()
+
+    @staticmethod
+    def decode(key: str, value: bytes) -> Remote:
+        counter, addr_type, addr = struct.unpack_from(REMOTE_RECORD, value)
+        profiles = value[REMOTE_RECORD_SIZE:]
+        return Remote(
+            key,
+            counter,
+            aioble.Device(addr_type, addr) if addr_type != NO_ADDR else None,
+            profiles.decode().split("\n") if profiles else [],
+        )
+
+
+# Fixed-size set of the most recent commands, the oldest entry is dropped when it's full.
+class RecentCache:
+    def __init__(self, size=32):
+        self.ring: list[bytes | None] = [None] * size
+        self.entries: set[bytes] = set()
+        self.next = 0
 
-    def control(self, percentage: float):
-        self.led.duty(round(1023 * percentage))
+    def __contains__(self, entry: bytes) -> bool:
+        return entry in self.entries
+
+    def add(self, entry: bytes):
+        old = self.ring[self.next]
+        if old is not None:
+            self.entries.discard(old)
+        self.ring[self.next] = entry
+        self.entries.add(entry)
+        self.next = (self.next + 1) % len(self.ring)
 
 
 class RemoteHandler:
     REMOTE_SERVICE_UUID = bluetooth.UUID("A9DCFE62-41AF-49E3-ADC0-000000000000")
     REMOTE_PAIRING_CHAR_UUID = bluetooth.UUID("A9DCFE62-41AF-49E3-ADC0-000000000001")
     REMOTE_NOTIFY_CHAR_UUID = bluetooth.UUID("A9DCFE62-41AF-49E3-ADC0-000000000002")
+    REMOTE_ACK_CHAR_UUID = bluetooth.UUID("A9DCFE62-41AF-49E3-ADC0-000000000003")
+    CCCD_UUID = bluetooth.UUID(0x2902)
     DEFAULT_KEY = "rl-default"
-
-    def __init__(self, ble: bluetooth.BLE, led: LED):
+    DIRECT_CONNECT_MS = 10_000  # How long each direct connect attempt waits for the remote
+    CONNECT_SETUP_MS = 50  # From the connect request to the connected IRQ
+    RESCAN_EVERY = 6  # Direct connect timeouts before a scan checks for an address change
+    RESCAN_MS = 2_000
+    NOTIFY_TIMEOUT_MS = 5_000
+    NOTIFY_LINGER_MS = 1_500  # Wait for more presses on the open connection, remotes without acks linger 1 s
+    SEQ_WINDOW = 16
+    PAIRING_WINDOW_MS = 60_000  # How long default-key remotes may pair next to the paired ones, once opened
+
+    TRANSPORT_GATT = 0  # Connect and wait for a notification for every press
+    TRANSPORT_ADV = 1  # Authenticated command in the remote's advertisement, no connection
+    ADV_MANUFACTURER_ID = 0xFECA  # b"\xca\xfe"
+    ADV_COMMAND_LEN = 11  # <key id:2><counter:u32><step:i8><tag:4>
+    RELAY_MANUFACTURER_ID = 0xFECB
+    RELAY_COMMAND_LEN = 12  # <key id:2><counter:u32><step:i8><tag:4><ttl:u8>, tag from the relay key
+    RELAY_INTERVAL_US = 20_000
+    RELAY_BURST_MS = 60  # Three advertising events, scanners at full duty catch at least one
+
+    def __init__(self, ble: bluetooth.BLE, led: LED, radio: RadioScheduler, transport=TRANSPORT_GATT):
         self.ble = ble
         self.led = led
+        self.radio = radio
+        self.transport = transport
+        self.first_result = uasyncio.Event()
+        self.busy = False  # Connecting or connected to the remote
+        self.pairing_until: int | None = None  # ticks_ms() the pairing window closes at, None: closed
+        if PAIR_AFTER_BOOT:
+            self.open_pairing()
+        self.registry = RemoteRegistry(REMOTES_FILE)
+        if not self.registry:
+            self.migrate_remote()
+        self.remote: Remote | None = None  # Remote of the connection or command being handled
+        self.ackchar: ClientCharacteristic | None = None  # None: the remote's firmware doesn't take acks
+        self.recent = RecentCache()  # <key id><counter> of commands already applied or relayed
+        self.relay_lock = uasyncio.Lock()
+        self.pairing_key: str | None = None  # Key for the next remote to pair, None: a random one
+        if RELAY and not self.registry.relay_key():
+            print("relay: no relay key yet, not relaying")
         try:
-            with open(REMOTE_FILE, "rt") as f:
-                self.remote_key = f.read()
+            # remote key -> [service start, service end, char end, value handle, properties, cccd handle, ack handle]
+            self.handle_cache: dict[str, list[int]] = ujson.loads(utils.load_file(REMOTE_HANDLES_FILE))
         except:
-            self.remote_key = self.DEFAULT_KEY
+            self.handle_cache = {}
+
+    # Single remote pairing from older versions.
+    def migrate_remote(self):
+        try:
+            key = utils.load_file(LEGACY_REMOTE_FILE)
+        except:
+            return
+        remote = Remote(key)
+        try:
+            remote.last_counter = struct.unpack("<I", utils.load_bytes_file(LEGACY_REMOTE_COUNTER_FILE))[0]
+        except:
+            pass
+        try:
+            addr = utils.load_bytes_file(LEGACY_REMOTE_ADDR_FILE)
+            remote.device = aioble.Device(addr[0], addr[1:])
+        except:
+            pass
+        self.registry.save(remote)
+
+    # New remotes pair while none is paired, or while the pairing window is open.
+    def pairing_open(self) -> bool:
+        return not self.registry or self.pairing_ms() > 0
+
+    def pairing_ms(self) -> int:
+        return 0 if self.pairing_until is None else utime.ticks_diff(self.pairing_until, utime.ticks_ms())
+
+    # Takes effect once the running direct connect round (up to DIRECT_CONNECT_MS) ends, window_ms 0 closes it. With
+    # a key, the next remote to pair gets that one instead of a random key, so the phone can add the same remote to
+    # other receivers (add_remote()).
+    def open_pairing(self, window_ms=PAIRING_WINDOW_MS, key: str | None = None) -> bool:
+        if key is not None and not self.key_available(key):
+            return False
+        self.pairing_key = key
+        self.pairing_until = utime.ticks_add(utime.ticks_ms(), window_ms) if window_ms > 0 else None
+        return True
+
+    # A remote paired on another receiver, so this one takes its presses too.
+    def add_remote(self, key: str) -> bool:
+        if key in self.registry.by_key:
+            return True
+        if not self.key_available(key):
+            return False
+        remote = Remote(key)
+        remote.last_counter = self.registry.last_counter(remote.key_id)  # Relayed commands already seen
+        self.registry.save(remote)
+        self.registry.store.delete(self.registry.counter_record(remote.key_id))
+        return True
+
+    # Shaped like the keys sync_keys() makes, and no other remote here has its key id.
+    def key_available(self, key: str) -> bool:
+        if len(key) != 19 or not key.startswith("rl-") or key in self.registry.by_key:
+            return False
+        return Remote(key).key_id not in self.registry.by_key_id
 
     async def serve(self, timeout=5000):
+        if self.transport == self.TRANSPORT_ADV:
+            return await self.serve_adv()
+        misses = 0
         while True:
-            async with aioble.scan(0, 100_000, 100_000, True) as scanner:
+            # A single paired remote with a known address: let the controller wait for it with a direct connect
+            # instead of decoding every advertisement in range. More remotes than that need the scan.
+            tier, remaining_ms = self.radio.current()
+            remote = next(iter(self.registry.by_key.values())) if len(self.registry) == 1 else None
+            if remote is not None and remote.device is not None and not self.pairing_open() and not RELAY:
+                if await self.direct_connect(remote, tier):
+                    misses = 0
+                    continue
+                misses += 1
+                if misses < self.RESCAN_EVERY:
+                    continue
+                misses = 0
+                duration_ms = self.RESCAN_MS  # Short scan in case the remote rotated its address
+            else:
+                duration_ms = remaining_ms
+                if self.registry and self.pairing_open():  # Back to the direct connect once the window closes
+                    duration_ms = max(1, min(duration_ms, self.pairing_ms()))  # 0 scans forever
+            async with aioble.scan(duration_ms, tier[1], tier[2], True) as scanner:
                 async for result in scanner:
+                    if not self.first_result.is_set():
+                        self.log_first_result()
+                    if RELAY:
+                        for _, data in result.manufacturer(self.RELAY_MANUFACTURER_ID):
+                            await self.handle_relay(data)
                     name = result.name()
-                    if name == self.remote_key and self.REMOTE_SERVICE_UUID in result.services():
-                        assert name is not None
+                    if name is None:
+                        continue
+                    if name in self.registry.by_key or (name == self.DEFAULT_KEY and self.pairing_open()):
+                        if self.REMOTE_SERVICE_UUID not in result.services():
+                            continue
                         try:
                             await self.handle_conn(result.device, name)
                             # await uasyncio.wait_for_ms(self.handle_conn(result.device, name), timeout)
@@ -100,156 +501,293 @@ class RemoteHandler:
                             print("waited for", e)
                         break
 
-    async def handle_conn(self, device: aioble.Device, name: str):
-        result: int = 2  # 0: Success, 1: Generate new keys, 2: Fail
-        if len(name) == len(self.DEFAULT_KEY):
-            if name == self.DEFAULT_KEY:
-                result = 1
-        else:
-            result = 0
-        if result != 2:
-            try:
-                print("connecting")
-                async with await device.connect() as conn:
-                    print("connected")
-                    service = await conn.service(self.REMOTE_SERVICE_UUID)
-                    assert service is not None
-
-                    pairingchar: ClientCharacteristic
-                    notifychar: ClientCharacteristic
-                    pairingchar, notifychar = await uasyncio.gather(
-                        service.characteristic(self.REMOTE_PAIRING_CHAR_UUID),
-                        service.characteristic(self.REMOTE_NOTIFY_CHAR_UUID),
-                    )
-                    assert pairingchar is not None and notifychar is not None
-
-                    if result == 1 and not await self.sync_keys(pairingchar):
-                        return
-                    print("notifydata receving")
-                    data = await notifychar.notified()
+    # One DIRECT_CONNECT_MS round of waiting for the remote. The initiator always runs at full duty, so idle tiers
+    # alternate connect attempts of one scan window with sleeps for the rest of the scan interval: same duty as
+    # the scan, and a press waits about one interval instead of a whole round.
+    async def direct_connect(self, remote: Remote, tier: list[int]) -> bool:
+        window_ms = max(1, tier[2] // 1000)
+        sleep_ms = (tier[1] - tier[2]) // 1000
+        if sleep_ms <= 0:
+            return await self.handle_conn(remote.device, remote.key, self.DIRECT_CONNECT_MS)
+        deadline = utime.ticks_add(utime.ticks_ms(), self.DIRECT_CONNECT_MS)
+        while utime.ticks_diff(deadline, utime.ticks_ms()) > 0:
+            if await self.handle_conn(remote.device, remote.key, window_ms):
+                return True
+            await uasyncio.sleep_ms(sleep_ms)
+        return False
+
+    async def serve_adv(self):
+        while True:
+            tier, remaining_ms = self.radio.current()
+            async with aioble.scan(remaining_ms, tier[1], tier[2], True) as scanner:
+                async for result in scanner:
+                    if not self.first_result.is_set():
+                        self.log_first_result()
+                    for manufacturer_id, data in result.manufacturer():
+                        if manufacturer_id == self.ADV_MANUFACTURER_ID:
+                            await self.handle_command(data)
+                        elif manufacturer_id == self.RELAY_MANUFACTURER_ID:
+                            await self.handle_relay(data)
+                        else:
+                            continue
+                        break
+                    else:
+                        # Pairing still exchanges the key over GATT.
+                        if self.pairing_open() and result.name() == self.DEFAULT_KEY:
+                            if self.REMOTE_SERVICE_UUID in result.services():
+                                await self.handle_conn(result.device, self.DEFAULT_KEY)
+                                break
+
+    def log_first_result(self):
+        print("boot: first scan result", utime.ticks_ms(), "ms after reset")
+        self.first_result.set()
+
+    # Adv command straight from a remote. Only remotes paired here can be checked, anything else is dropped.
+    async def handle_command(self, data: bytes):
+        step = self.parse_adv_command(data)
+        if step is None:
+            return
+        await self.handle_notify(step)
+        self.relay_command(bytes(data[:7]))
+
+    # Relay from another receiver, checked with the relay key. A counter that isn't newer than the last one from
+    # that remote is a replay, or a command this receiver already applied (it heard the remote itself). Its
+    # profile limits apply if the remote is paired here.
+    async def handle_relay(self, data: bytes):
+        if len(data) != self.RELAY_COMMAND_LEN:
+            return
+        seen = bytes(data[:6])
+        if seen in self.recent:
+            return
+        self.recent.add(seen)
+        key = self.registry.relay_key()
+        if not key or utils.hmac_sha256(key, data[:7])[:4] != data[7:11]:
+            return
+        key_id = bytes(data[:2])
+        counter, step = struct.unpack_from("<Ib", data, 2)
+        if counter <= self.registry.last_counter(key_id):
+            return
+        self.registry.set_last_counter(key_id, counter)
+        self.remote = self.registry.by_key_id.get(key_id)
+        await self.handle_notify(step)
+        if data[11] > 0:
+            uasyncio.create_task(self.relay(bytes(data[:11]), data[11] - 1))
+
+    # Relays <key id><counter><step> of an applied command, tagged with the relay key: remote keys are what GATT
+    # remotes advertise as their name, so they can't vouch for anything, and receivers the remote isn't paired to
+    # don't have them.
+    def relay_command(self, body: bytes):
+        key = self.registry.relay_key()
+        if not RELAY or not key:
+            return
+        command = body + utils.hmac_sha256(key, body)[:4]
+        self.recent.add(command[:6])
+        uasyncio.create_task(self.relay(command, RELAY_TTL))
+
+    # GATT presses have no counter of their own, relays number them with the remote's adv command counter.
+    def count_press(self, remote: Remote, step: int) -> bytes:
+        remote.last_counter += 1
+        self.registry.save(remote)
+        return remote.key_id + struct.pack("<Ib", remote.last_counter, step)
+
+    # Short non-connectable burst. Takes over the advertiser, so the phone service stops advertising until
+    # its next advertise() call.
+    async def relay(self, command: bytes, ttl: int):
+        payload = struct.pack("<H", self.RELAY_MANUFACTURER_ID) + command + bytes((ttl,))
+        adv_data = b"\x02\x01\x04" + bytes((len(payload) + 1, 0xFF)) + payload
+        async with self.relay_lock:
+            self.ble.gap_advertise(self.RELAY_INTERVAL_US, adv_data, connectable=False)
+            await uasyncio.sleep_ms(self.RELAY_BURST_MS)
+            self.ble.gap_advertise(None)
+
+    def parse_adv_command(self, data: bytes) -> int | None:
+        if len(data) != self.ADV_COMMAND_LEN:
+            return None
+        remote = self.registry.by_key_id.get(bytes(data[:2]))
+        if remote is None:
+            return None
+        counter, step = struct.unpack_from("<Ib", data, 2)
+        if counter <= remote.last_counter:  # Replay, or a repeat of the same advertising burst
+            return None
+        if utils.hmac_sha256(remote.key.encode(), data[:7])[:4] != data[7:]:
+            return None
+        remote.last_counter = counter
+        self.registry.save(remote)
+        self.remote = remote
+        return step
+
+    def store_device(self, remote: Remote, device: aioble.Device):
+        if device == remote.device:
+            return
+        remote.device = device
+        self.registry.save(remote)
+
+    async def handle_conn(self, device: aioble.Device, name: str, timeout_ms=10_000) -> bool:
+        pair = name == self.DEFAULT_KEY
+        remote = self.registry.get(name)
+        if remote is None and not pair:
+            return False
+        self.busy = True
+        self.remote = remote
+        try:
+            print("connecting")
+            # Without scan_duration_ms the controller initiates for its default 2 s whatever timeout_ms is. aioble
+            # waits CONNECT_SETUP_MS longer than the controller scans, so a connection made at the very end of a
+            # short window still reaches it, and the next attempt never finds the controller busy (EALREADY).
+            async with await device.connect(
+                timeout_ms=timeout_ms + self.CONNECT_SETUP_MS, scan_duration_ms=timeout_ms
+            ) as conn:
+                print("connected")
+                cached = not pair
+                notifychar = await self.cached_notify_char(conn) if cached else None
+                if notifychar is None:
+                    cached = False
+                    notifychar = await self.discover_notify_char(conn, device if pair else None)
+                    if notifychar is None:
+                        return False
+                print("notifydata receving")
+                # The remote keeps the link up for a moment after a press, later presses arrive on the same
+                # connection instead of needing a new one.
+                timeout_ms = self.NOTIFY_TIMEOUT_MS
+                received = False
+                while True:
+                    try:
+                        data = await notifychar.notified(timeout_ms)
+                    except (uasyncio.TimeoutError, aioble.DeviceDisconnectedError):
+                        if received:
+                            break
+                        if cached:  # Handles may point at a stale GATT table
+                            self.forget_handles()
+                        raise
                     print("notifydata", data)
-                    if len(data) == 1:
-                        await self.handle_notify(bool(int(data[0])))
-                    print("end service", service)
-            except uasyncio.TimeoutError as e:
-                print("te", e)
-            except uasyncio.CancelledError as e:
-                print("ce", e)
-            except BaseException as e:
-                print("be", dir(e), e, repr(e))
-
-    async def sync_keys(self, pairingchar: ClientCharacteristic) -> bool:
+                    received = True
+                    timeout_ms = self.NOTIFY_LINGER_MS
+                    press = self.parse_notify(data)
+                    if press is not None:
+                        step, level = press
+                        await self.handle_notify(step, level)
+                    if self.ackchar is not None and len(data) >= 3:
+                        # Repeats are acked too, the remote may have missed the first ack.
+                        await self.ackchar.write(bytes(data[1:3]) + bytes((setting_index,)))
+                    if press is not None and RELAY and step:
+                        self.relay_command(self.count_press(self.remote, step))
+                self.store_device(self.remote, device)
+                return True
+        except uasyncio.TimeoutError as e:
+            print("te", e)
+        except uasyncio.CancelledError as e:
+            print("ce", e)
+        except BaseException as e:
+            print("be", dir(e), e, repr(e))
+        finally:
+            self.busy = False
+        return False
+
+    async def cached_notify_char(self, conn: aioble.DeviceConnection) -> ClientCharacteristic | None:
+        handles = self.handle_cache.get(self.remote.key)
+        if handles is None or len(handles) != 7:  # Cached before remotes had the ack characteristic
+            return None
+        start_handle, end_handle, char_end_handle, value_handle, properties, cccd_handle, ack_handle = handles
+        service = ClientService(conn, start_handle, end_handle, self.REMOTE_SERVICE_UUID)
+        notifychar = ClientCharacteristic(
+            service, char_end_handle, value_handle, properties, self.REMOTE_NOTIFY_CHAR_UUID
+        )
+        self.ackchar = None
+        if ack_handle:
+            self.ackchar = ClientCharacteristic(
+                service, ack_handle, ack_handle, bluetooth.FLAG_WRITE_NO_RESPONSE, self.REMOTE_ACK_CHAR_UUID
+            )
+        try:
+            await ClientDescriptor(notifychar, cccd_handle, self.CCCD_UUID).write(b"\x01\x00", True)
+        except aioble.GattError:
+            self.forget_handles()
+            return None
+        return notifychar
+
+    # pair_device: the unpaired remote to give a new key, None if self.remote is already paired.
+    async def discover_notify_char(
+        self, conn: aioble.DeviceConnection, pair_device: aioble.Device | None
+    ) -> ClientCharacteristic | None:
+        service = await conn.service(self.REMOTE_SERVICE_UUID)
+        assert service is not None
+
+        pairingchar: ClientCharacteristic
+        notifychar: ClientCharacteristic
+        pairingchar, notifychar, self.ackchar = await uasyncio.gather(
+            service.characteristic(self.REMOTE_PAIRING_CHAR_UUID),
+            service.characteristic(self.REMOTE_NOTIFY_CHAR_UUID),
+            service.characteristic(self.REMOTE_ACK_CHAR_UUID),
+        )
+        assert pairingchar is not None and notifychar is not None
+
+        if pair_device is not None and not await self.sync_keys(pairingchar, pair_device):
+            return None
+        cccd = await notifychar.descriptor(self.CCCD_UUID)
+        assert cccd is not None
+        await cccd.write(b"\x01\x00", True)
+
+        self.handle_cache[self.remote.key] = [
+            service._start_handle,
+            service._end_handle,
+            notifychar._end_handle,
+            notifychar._value_handle,
+            notifychar.properties,
+            cccd._value_handle,
+            self.ackchar._value_handle if self.ackchar is not None else 0,
+        ]
+        utils.write_to_file(REMOTE_HANDLES_FILE, ujson.dumps(self.handle_cache))
+        return notifychar
+
+    def forget_handles(self):
+        if self.handle_cache.pop(self.remote.key, None) is not None:
+            utils.write_to_file(REMOTE_HANDLES_FILE, ujson.dumps(self.handle_cache))
+
+    async def sync_keys(self, pairingchar: ClientCharacteristic, device: aioble.Device) -> bool:
         try:
             print("syncing keys")
-            new_key = "rl-" + utils.gen_random_string()
+            # Adv commands find their remote by the 16 bit key id, a remote sharing it would shadow the other one.
+            new_key = self.pairing_key or "rl-" + utils.gen_random_string()
+            while Remote(new_key).key_id in self.registry.by_key_id:
+                new_key = "rl-" + utils.gen_random_string()
             await pairingchar.write(new_key, True)
-            f = open(REMOTE_FILE, "wt")
-            f.write(new_key)
-            f.flush()
-            self.remote_key = new_key
-            print("syncing keys end")
+            self.remote = Remote(new_key, 0, device)
+            if new_key == self.pairing_key:
+                # Already relayed to this receiver from the ones it's paired to
+                self.remote.last_counter = self.registry.last_counter(self.remote.key_id)
+                self.registry.store.delete(self.registry.counter_record(self.remote.key_id))
+                self.open_pairing(0)  # The phone's key is for one remote
+            self.registry.save(self.remote)
+            print("syncing keys end", len(self.registry), "remotes paired")
             return True
         except aioble.GattError:
             pass
         print("syncing keys failed")
         return False
 
-    async def handle_notify(self, increase: bool):
+    # Notification: <step:i8><seq:u16>[<level:u8>], step is the sum of the presses the remote coalesced and
+    # level an absolute index into the profile. Older remotes send a single b"1" or b"0".
+    def parse_notify(self, data: bytes) -> tuple[int, int | None] | None:
+        if len(data) == 1:
+            return (1 if data[0] in b"1\x01" else -1), None
+        if len(data) not in (3, 4):
+            return None
+        step, seq = struct.unpack_from("<bH", data)
+        remote = self.remote
+        # Repeat of one of the last notifications. Anything further back is a remote that lost its counter.
+        if remote.last_seq is not None and (remote.last_seq - seq) & 0xFFFF < self.SEQ_WINDOW:
+            return None
+        remote.last_seq = seq
+        return step, data[3] if len(data) == 4 else None
+
+    async def handle_notify(self, step: int, level: int | None = None):
         global setting_index
-        if increase:
-            setting_index = min(len(settings_cfg[current_setting]) - 1, setting_index + 1)
-        else:
-            setting_index = max(0, setting_index - 1)
-        self.led.control(settings_cfg[current_setting][setting_index])
-
-
-class PhoneHandler:
-    SERVICE_UUID = bluetooth.UUID("A9DCFE62-41AF-49E3-ADC0-100000000000")
-    JSON_DATA_UUID = bluetooth.UUID("A9DCFE62-41AF-49E3-ADC0-100000000001")
-    SETTING_DATA_UUID = bluetooth.UUID("A9DCFE62-41AF-49E3-ADC0-100000000002")
-
-    def __init__(self, ble: bluetooth.BLE):
-        self.ble = ble
-        service = aioble.Service(self.SERVICE_UUID)
-        self.json_characteristic = aioble.Characteristic(
-            service,
-            self.JSON_DATA_UUID,
-            write=True,
-            read=True,
-            capture=True,
-            notify=True,
-        )
-        self.setting_characteristic = aioble.Characteristic(
-            service,
-            self.SETTING_DATA_UUID,
-            write=True,
-            read=True,
-            capture=True,
-            notify=True,
-        )
-        aioble.register_services(service)
-        self.connections: dict[ConnHandle, aioble.device.DeviceConnection] = {}
-
-    async def serve(self, interval_us: int | None = 250_000, name="MyProject"):
-        self.setting_characteristic.write(current_setting)
-        self.json_characteristic.write(ujson.dumps(settings_cfg))
-        tasks = [uasyncio.create_task(t) for t in (self.handle_json_char(), self.handle_setting_char())]
-        while True:
-            connection = await aioble.advertise(interval_us, name=name, services=[self.SERVICE_UUID])
-            assert connection is not None
-            assert connection._conn_handle is not None
-            self.connections[connection._conn_handle] = connection
-            try:
-                await connection.disconnected(None)
-            except:
-                pass
-            await self.force_disconnect(connection._conn_handle)
-
-    async def force_disconnect(self, conn_handler: ConnHandle):
-        try:
-            conn = self.connections.pop(conn_handler)
-            if conn._task is not None:
-                conn._task.cancel()
-            await conn.disconnect()
-        except:
-            pass
-
-    async def handle_setting_char(self):
-        global current_setting
-        conn_handler: ConnHandle
-        data: bytes
-        while True:
-            conn_handler, data = await self.setting_characteristic.written()  # type: ignore
-            try:
-                data_str = data.decode()
-                if data_str and data_str in settings_cfg:
-                    current_setting = data_str
-                    self.setting_characteristic.write(data, True)
-                    utils.write_to_file(SELECTED_SETTINGS_FILE, current_setting)
-                    continue
-            except:
-                pass
-            await self.force_disconnect(conn_handler)
-
-    async def handle_json_char(self):
-        global settings_cfg
-        conn_handler: ConnHandle
-        data: bytes
-        while True:
-            conn_handler, data = await self.json_characteristic.written()  # type: ignore
-            try:
-                new_config: dict[str, list[float]] = ujson.loads(data)
-                for key, value in new_config.items():
-                    if not key or not all((isinstance(v, float) and 0 <= v <= 1.0 for v in value)):
-                        break
-                else:
-                    settings_cfg = new_config
-                    self.json_characteristic.write(data, True)
-                    utils.write_to_file(SETTINGS_FILE, ujson.dumps(settings_cfg))
-                    continue
-            except:
-                pass
-            await self.force_disconnect(conn_handler)
+        if self.remote is not None and not self.remote.allows(current_setting):
+            return
+        self.radio.activity()
+        table = duty_tables[current_setting]
+        setting_index = max(0, min(len(table) - 1, setting_index + step if level is None else level))
+        self.led.control(table[setting_index])
+        state_file.save(setting_index, table[setting_index])
 
 
 if __name__ == "__main__":
@@ -0,0 +1,580 @@
+# Profiles, radio tiers and the phone's GATT service that edits them. boot.py imports this from main(), with
+# fast boot only after the first scan window, so none of it is compiled before the receiver starts scanning.
+
+import binascii
+import struct
+from array import array
+
+import aioble
+import bluetooth
+import uasyncio
+import ujson
+import uos
+import utils
+from store import RecordStore
+
+SETTINGS_FILE = "settings.db"
+LEGACY_SETTINGS_FILE = "settings"
+LEGACY_SELECTED_SETTINGS_FILE = "selected_setting"
+RADIO_SETTINGS_FILE = "radio_settings"
+CONFIG_UPLOAD_FILE = "config.tmp"
+CONFIG_EXPORT_FILE = "config.json"  # settings_cfg as JSON, what config downloads are served from
+
+CONFIG_L2CAP = False  # Also accept config uploads over an L2CAP channel
+
+DUTY_CORRECTION = "none"  # "none", "gamma" or "cie" (profile steps are CIE lightness)
+GAMMA = 2.2
+
+
+def to_duty(percentage: float) -> int:
+    if DUTY_CORRECTION == "gamma":
+        percentage = percentage**GAMMA
+    elif DUTY_CORRECTION == "cie":
+        lightness = percentage * 100
+        percentage = ((lightness + 16) / 116) ** 3 if lightness > 8 else lightness / 903.3
+    return round(1023 * percentage)
+
+
+# Profiles are turned into final PWM duties once, the command path only indexes ints.
+def compile_profiles(cfg: dict[str, list[float]]) -> dict[str, array]:
+    return {name: array("H", [to_duty(v) for v in values]) for name, values in cfg.items()}
+
+
+# Settings store keys: the selected profile name, the config version (u32, bumped on every profile change)
+# and one float32 record per profile.
+SELECTED_KEY = "sel"
+VERSION_KEY = "ver"
+PROFILE_PREFIX = "p:"
+
+
+def load_profiles() -> dict[str, list[float]]:
+    profiles = {}
+    for key, value in settings_store.records.items():
+        if key.startswith(PROFILE_PREFIX):
+            profiles[key[len(PROFILE_PREFIX) :]] = list(struct.unpack("<%df" % (len(value) // 4), value))
+    return profiles
+
+
+# Only profiles that changed or were removed append records.
+def save_profiles(cfg: dict[str, list[float]]):
+    for key in [k for k in settings_store.records if k.startswith(PROFILE_PREFIX)]:
+        if key[len(PROFILE_PREFIX) :] not in cfg:
+            settings_store.delete(key)
+    for name, values in cfg.items():
+        settings_store.put(PROFILE_PREFIX + name, struct.pack("<%df" % len(values), *values))
+
+
+settings_store: RecordStore | None = None
+current_setting = "default"
+settings_cfg: dict[str, list[float]] = {}
+duty_tables: dict[str, array] = {}
+config_version = 0
+
+
+def load_settings():
+    global settings_store, current_setting, settings_cfg, duty_tables, config_version
+    settings_store = RecordStore(SETTINGS_FILE)
+    if not settings_store.records:
+        try:  # Migrate the JSON files written by older versions
+            current_setting = utils.load_file(LEGACY_SELECTED_SETTINGS_FILE).strip()
+            settings_cfg = ujson.loads(utils.load_file(LEGACY_SETTINGS_FILE))
+            if current_setting not in settings_cfg:
+                raise Exception
+        except:
+            current_setting = "default"
+            settings_cfg = dict(default=[0.0, 0.25, 0.5, 0.75, 1.0])
+        save_profiles(settings_cfg)
+        settings_store.put(SELECTED_KEY, current_setting.encode())
+    current_setting = settings_store.get(SELECTED_KEY, b"").decode()
+    settings_cfg = load_profiles()
+    if current_setting not in settings_cfg:
+        current_setting = next(iter(settings_cfg))
+    duty_tables = compile_profiles(settings_cfg)
+    config_version = struct.unpack("<I", settings_store.get(VERSION_KEY, bytes(4)))[0]
+
+
+def load_radio_tiers() -> list[list[int]]:
+    try:
+        # [hold_ms, scan_interval_us, scan_window_us, adv_interval_us], hold_ms 0: until the next activity
+        radio_tiers = ujson.loads(utils.load_file(RADIO_SETTINGS_FILE))
+        if not radio_tiers:
+            raise Exception
+    except:
+        radio_tiers = [
+            [10_000, 100_000, 100_000, 100_000],
+            [60_000, 100_000, 50_000, 250_000],
+            [0, 320_000, 32_000, 1_000_000],
+        ]
+        utils.write_to_file(RADIO_SETTINGS_FILE, ujson.dumps(radio_tiers))
+    return radio_tiers
+
+
+ConnHandle = int
+
+
+class PhoneHandler:
+    SERVICE_UUID = bluetooth.UUID("A9DCFE62-41AF-49E3-ADC0-100000000000")
+    JSON_DATA_UUID = bluetooth.UUID("A9DCFE62-41AF-49E3-ADC0-100000000001")
+    SETTING_DATA_UUID = bluetooth.UUID("A9DCFE62-41AF-49E3-ADC0-100000000002")
+    CONFIG_TRANSFER_UUID = bluetooth.UUID("A9DCFE62-41AF-49E3-ADC0-100000000003")
+    CONFIG_PATCH_UUID = bluetooth.UUID("A9DCFE62-41AF-49E3-ADC0-100000000004")
+    REMOTES_UUID = bluetooth.UUID("A9DCFE62-41AF-49E3-ADC0-100000000005")
+
+    # Chunked config transfer. The phone writes:
+    #   BEGIN <op><total:u32><crc32:u32>    start an upload
+    #   DATA  <op><offset:u32><bytes>       without response, MTU sized chunks or long writes up to TRANSFER_BUFFER
+    #   END   <op>                          check length and crc, then parse and apply
+    #   READ  <op><offset:u32>              download from offset
+    # Notified back: <op | 0x80><status:u8><offset:u32> after BEGIN and END, and after DATA only when it wasn't
+    # at the expected offset (the offset field holds that one, the phone resends from there). A READ is
+    # answered with INFO <op><total:u32><crc32:u32> and DATA frames up to the end.
+    OP_BEGIN = 1
+    OP_DATA = 2
+    OP_END = 3
+    OP_READ = 4
+    OP_INFO = 5
+    STATUS_OK = 0
+    STATUS_OFFSET = 1
+    STATUS_CRC = 2
+    STATUS_INVALID = 3
+    STATUS_IDLE = 4  # No upload running
+    STATUS_NOT_FOUND = 5
+
+    # Config patches, one per write: <op><name len:u8><name><args>
+    #   UPSERT    <values: f32 each>      add or replace a profile
+    #   DELETE                            remove a profile, the last one can't be removed
+    #   SET_STEP  <index:u8><value:f32>   change one step of a profile
+    # Answered with <op | 0x80><status:u8><version:u32>. The characteristic reads as <version:u32>, so the
+    # phone can skip the sync when it already has that version.
+    PATCH_UPSERT = 1
+    PATCH_DELETE = 2
+    PATCH_SET_STEP = 3
+
+    # Paired remotes, one command per write: <op><args>, answered with <op | 0x80><status:u8>
+    #   PAIR       <seconds:u16>[<key>]                         let default-key remotes pair that long, 0 closes.
+    #                                                           With a key the next remote gets it, for ADD elsewhere
+    #   PROFILES   <key len:u8><key><names, newline separated>  profiles the remote may change, none: all
+    #   ADD        <key>                                        remote paired on another receiver
+    #   RELAY_KEY  <key, 16+ bytes>                             shared by all receivers, signs relayed commands
+    # Keys are write only, nothing here is readable or advertised.
+    REMOTES_PAIR = 1
+    REMOTES_PROFILES = 2
+    REMOTES_ADD = 3
+    REMOTES_RELAY_KEY = 4
+    RELAY_KEY_MIN = 16
+
+    CONFIG_MTU = 247  # Offered when the phone exchanges MTUs
+    TRANSFER_BUFFER = 512
+    L2CAP_PSM = 0x81
+    L2CAP_MTU = 512  # Uploads over L2CAP: one <total:u32><crc32:u32> SDU, then the data
+    JSON_REFRESH_MS = 500  # Changes within this share one rebuild of the JSON value
+
+    # on_change(current_setting, duty_tables) runs after every change boot.py's remote path has to follow (another
+    # selected profile, new tables or a new table for the selected one), boot.py also rewrites its snapshot then.
+    # remotes is boot.py's RemoteHandler, for the remote commands.
+    def __init__(self, ble: bluetooth.BLE, radio, on_change, remotes):
+        self.ble = ble
+        self.radio = radio
+        self.on_change = on_change
+        self.remotes = remotes
+        self.upload = None  # Open upload file while a transfer runs
+        self.upload_total = 0
+        self.upload_crc = 0
+        self.upload_received = 0
+        self.upload_running_crc = 0
+        self.json_stale = False  # The JSON value is behind settings_cfg until refresh_json() runs
+        self.json_refresh = None
+        aioble.config(mtu=self.CONFIG_MTU)
+        service = aioble.Service(self.SERVICE_UUID)
+        self.json_characteristic = aioble.Characteristic(
+            service,
+            self.JSON_DATA_UUID,
+            write=True,
+            read=True,
+            capture=True,
+            notify=True,
+        )
+        self.setting_characteristic = aioble.Characteristic(
+            service,
+            self.SETTING_DATA_UUID,
+            write=True,
+            read=True,
+            capture=True,
+            notify=True,
+        )
+        self.transfer_characteristic = aioble.Characteristic(
+            service,
+            self.CONFIG_TRANSFER_UUID,
+            write=True,
+            write_no_response=True,
+            capture=True,
+            notify=True,
+        )
+        self.patch_characteristic = aioble.Characteristic(
+            service,
+            self.CONFIG_PATCH_UUID,
+            write=True,
+            read=True,
+            capture=True,
+            notify=True,
+        )
+        self.remotes_characteristic = aioble.Characteristic(
+            service,
+            self.REMOTES_UUID,
+            write=True,
+            capture=True,
+            notify=True,
+        )
+        aioble.register_services(service)
+        # The default buffer only takes 20 bytes, long writes need room for the whole value. A patch has to fit
+        # in one write.
+        ble.gatts_set_buffer(self.transfer_characteristic._value_handle, self.TRANSFER_BUFFER)
+        ble.gatts_set_buffer(self.patch_characteristic._value_handle, self.CONFIG_MTU - 3)
+        ble.gatts_set_buffer(self.remotes_characteristic._value_handle, self.CONFIG_MTU - 3)
+        self.connections: dict[ConnHandle, aioble.device.DeviceConnection] = {}
+
+    async def serve(self, name="MyProject"):
+        self.setting_characteristic.write(current_setting)
+        self.json_characteristic.write(ujson.dumps(settings_cfg))
+        self.patch_characteristic.write(struct.pack("<I", config_version))
+        tasks = [
+            uasyncio.create_task(t)
+            for t in (
+                self.handle_json_char(),
+                self.handle_setting_char(),
+                self.handle_transfer_char(),
+                self.handle_patch_char(),
+                self.handle_remotes_char(),
+            )
+        ]
+        while True:
+            tier, remaining_ms = self.radio.current()
+            try:
+                connection = await aioble.advertise(
+                    tier[3], name=name, services=[self.SERVICE_UUID], timeout_ms=remaining_ms
+                )
+            except uasyncio.TimeoutError:
+                continue  # Step down to the next tier
+            self.radio.activity()
+            assert connection is not None
+            assert connection._conn_handle is not None
+            self.connections[connection._conn_handle] = connection
+            l2cap = uasyncio.create_task(self.l2cap_upload(connection)) if CONFIG_L2CAP else None
+            try:
+                await connection.disconnected(None)
+            except:
+                pass
+            if l2cap is not None:
+                l2cap.cancel()
+            self.abort_upload()
+            await self.force_disconnect(connection._conn_handle)
+
+    async def force_disconnect(self, conn_handler: ConnHandle):
+        try:
+            conn = self.connections.pop(conn_handler)
+            if conn._task is not None:
+                conn._task.cancel()
+            await conn.disconnect()
+        except:
+            pass
+
+    async def handle_setting_char(self):
+        global current_setting
+        conn_handler: ConnHandle
+        data: bytes
+        while True:
+            conn_handler, data = await self.setting_characteristic.written()  # type: ignore
+            try:
+                data_str = data.decode()
+                if data_str and data_str in settings_cfg:
+                    current_setting = data_str
+                    self.setting_characteristic.write(data, True)
+                    settings_store.put(SELECTED_KEY, data)
+                    self.on_change(current_setting, duty_tables)
+                    continue
+            except:
+                pass
+            await self.force_disconnect(conn_handler)
+
+    async def handle_json_char(self):
+        conn_handler: ConnHandle
+        data: bytes
+        while True:
+            conn_handler, data = await self.json_characteristic.written()  # type: ignore
+            try:
+                new_config: dict[str, list[float]] = ujson.loads(data)
+                if self.apply_config(new_config):
+                    self.json_characteristic.write(data, True)
+                    self.json_stale = False
+                    utils.write_bytes_to_file(CONFIG_EXPORT_FILE, data)
+                    continue
+            except:
+                pass
+            await self.force_disconnect(conn_handler)
+
+    async def handle_transfer_char(self):
+        connection: aioble.DeviceConnection
+        data: bytes
+        while True:
+            connection, data = await self.transfer_characteristic.written()  # type: ignore
+            try:
+                op = data[0]
+                if op == self.OP_BEGIN:
+                    total, crc = struct.unpack_from("<II", data, 1)
+                    self.begin_upload(total, crc)
+                    self.transfer_status(connection, op, self.STATUS_OK, 0)
+                elif op == self.OP_DATA:
+                    offset = struct.unpack_from("<I", data, 1)[0]
+                    if self.upload is None:
+                        self.transfer_status(connection, op, self.STATUS_IDLE, 0)
+                    elif offset != self.upload_received or not self.upload_chunk(memoryview(data)[5:]):
+                        self.transfer_status(connection, op, self.STATUS_OFFSET, self.upload_received)
+                elif op == self.OP_END:
+                    self.transfer_status(connection, op, self.end_upload(), self.upload_received)
+                elif op == self.OP_READ:
+                    await self.send_config(connection, struct.unpack_from("<I", data, 1)[0])
+                continue
+            except:
+                pass
+            self.abort_upload()
+            await self.force_disconnect(connection._conn_handle)
+
+    def transfer_status(self, connection: aioble.DeviceConnection, op: int, status: int, offset: int):
+        self.transfer_characteristic.notify(connection, struct.pack("<BBI", op | 0x80, status, offset))
+
+    # Chunks go straight to a file with a running crc, so the upload is never in RAM as a whole.
+    def begin_upload(self, total: int, crc: int):
+        self.abort_upload()
+        self.upload = open(CONFIG_UPLOAD_FILE, "wb")
+        self.upload_total = total
+        self.upload_crc = crc
+        self.upload_received = 0
+        self.upload_running_crc = 0
+
+    def upload_chunk(self, chunk) -> bool:
+        if self.upload_received + len(chunk) > self.upload_total:
+            return False
+        self.upload.write(chunk)
+        self.upload_running_crc = binascii.crc32(chunk, self.upload_running_crc)
+        self.upload_received += len(chunk)
+        return True
+
+    def abort_upload(self):
+        if self.upload is not None:
+            self.upload.close()
+            self.upload = None
+
+    def end_upload(self) -> int:
+        if self.upload is None:
+            return self.STATUS_IDLE
+        self.abort_upload()
+        if self.upload_received != self.upload_total or self.upload_running_crc != self.upload_crc:
+            return self.STATUS_CRC
+        try:
+            with open(CONFIG_UPLOAD_FILE, "rt") as f:
+                new_config = ujson.load(f)  # Parses from the file, the text is never loaded as one string
+        except:
+            return self.STATUS_INVALID
+        if not self.apply_config(new_config):
+            return self.STATUS_INVALID
+        uos.rename(CONFIG_UPLOAD_FILE, CONFIG_EXPORT_FILE)
+        return self.STATUS_OK
+
+    def apply_config(self, new_config: dict[str, list[float]]) -> bool:
+        global settings_cfg, duty_tables, current_setting
+        if not isinstance(new_config, dict) or not new_config:
+            return False
+        for key, value in new_config.items():
+            # An empty profile would compile to an empty duty table that handle_notify() can't index.
+            if not key or not isinstance(value, list) or not value:
+                return False
+            if not all((isinstance(v, float) and 0 <= v <= 1.0 for v in value)):
+                return False
+        settings_cfg = new_config
+        duty_tables = compile_profiles(new_config)
+        if current_setting not in settings_cfg:
+            self.select_setting(next(iter(settings_cfg)))
+        save_profiles(settings_cfg)
+        self.on_change(current_setting, duty_tables)
+        self.config_changed()
+        return True
+
+    def select_setting(self, name: str):
+        global current_setting
+        current_setting = name
+        settings_store.put(SELECTED_KEY, name.encode())
+        self.setting_characteristic.write(name, True)
+
+    def config_changed(self):
+        global config_version
+        config_version += 1
+        settings_store.put(VERSION_KEY, struct.pack("<I", config_version))
+        self.patch_characteristic.write(struct.pack("<I", config_version))
+        self.json_stale = True
+        if self.json_refresh is None:
+            self.json_refresh = uasyncio.create_task(self.refresh_json())
+        try:
+            uos.remove(CONFIG_EXPORT_FILE)  # Stale, the next download writes it again
+        except OSError:
+            pass
+
+    # Dumping the whole config costs far more than a patch, so a burst of patches rebuilds the JSON value once.
+    # Until then the version on the patch characteristic is ahead of what a read returns.
+    async def refresh_json(self):
+        await uasyncio.sleep_ms(self.JSON_REFRESH_MS)
+        self.json_refresh = None
+        if self.json_stale:
+            self.json_stale = False
+            self.json_characteristic.write(ujson.dumps(settings_cfg))
+
+    async def handle_patch_char(self):
+        connection: aioble.DeviceConnection
+        data: bytes
+        while True:
+            connection, data = await self.patch_characteristic.written()  # type: ignore
+            try:
+                status = self.apply_patch(data)
+                reply = struct.pack("<BBI", data[0] | 0x80, status, config_version)
+                self.patch_characteristic.notify(connection, reply)
+                continue
+            except:
+                pass
+            finally:
+                # The write left the patch in the value, reads have to see the version whatever the status
+                self.patch_characteristic.write(struct.pack("<I", config_version))
+            await self.force_disconnect(connection._conn_handle)
+
+    # Only the patched profile is validated, compiled and written to the settings store.
+    def apply_patch(self, data: bytes) -> int:
+        op = data[0]
+        name = bytes(data[2 : 2 + data[1]]).decode()
+        args = bytes(data[2 + data[1] :])
+        if not name:
+            return self.STATUS_INVALID
+        if op == self.PATCH_DELETE:
+            if name not in settings_cfg:
+                return self.STATUS_NOT_FOUND
+            if len(settings_cfg) == 1:
+                return self.STATUS_INVALID
+            del settings_cfg[name]
+            del duty_tables[name]
+            settings_store.delete(PROFILE_PREFIX + name)
+            if name == current_setting:
+                self.select_setting(next(iter(settings_cfg)))
+                self.on_change(current_setting, duty_tables)
+            self.config_changed()
+            return self.STATUS_OK
+        if op == self.PATCH_UPSERT:
+            if not args or len(args) % 4:
+                return self.STATUS_INVALID
+            values = list(struct.unpack("<%df" % (len(args) // 4), args))
+        elif op == self.PATCH_SET_STEP:
+            if name not in settings_cfg:
+                return self.STATUS_NOT_FOUND
+            index, value = struct.unpack("<Bf", args)
+            values = settings_cfg[name][:]
+            if index >= len(values):
+                return self.STATUS_INVALID
+            values[index] = value
+        else:
+            return self.STATUS_INVALID
+        if not all(0 <= v <= 1.0 for v in values):  # NaN fails too
+            return self.STATUS_INVALID
+        settings_cfg[name] = values
+        duty_tables[name] = compile_profiles({name: values})[name]
+        settings_store.put(PROFILE_PREFIX + name, struct.pack("<%df" % len(values), *values))
+        if name == current_setting:
+            self.on_change(current_setting, duty_tables)
+        self.config_changed()
+        return self.STATUS_OK
+
+    async def handle_remotes_char(self):
+        connection: aioble.DeviceConnection
+        data: bytes
+        while True:
+            connection, data = await self.remotes_characteristic.written()  # type: ignore
+            try:
+                status = self.apply_remotes_command(data)
+                self.remotes_characteristic.notify(connection, struct.pack("<BB", data[0] | 0x80, status))
+                continue
+            except:
+                pass
+            await self.force_disconnect(connection._conn_handle)
+
+    def apply_remotes_command(self, data: bytes) -> int:
+        op = data[0]
+        if op == self.REMOTES_PAIR:
+            key = bytes(data[3:]).decode() or None
+            if not self.remotes.open_pairing(struct.unpack_from("<H", data, 1)[0] * 1000, key):
+                return self.STATUS_INVALID
+            return self.STATUS_OK
+        if op == self.REMOTES_PROFILES:
+            remote = self.remotes.registry.get(bytes(data[2 : 2 + data[1]]).decode())
+            if remote is None:
+                return self.STATUS_NOT_FOUND
+            names = bytes(data[2 + data[1] :]).decode()
+            profiles = names.split("\n") if names else []
+            if not all(name in settings_cfg for name in profiles):
+                return self.STATUS_INVALID
+            remote.profiles = profiles
+            self.remotes.registry.save(remote)
+            return self.STATUS_OK
+        if op == self.REMOTES_ADD:
+            return self.STATUS_OK if self.remotes.add_remote(bytes(data[1:]).decode()) else self.STATUS_INVALID
+        if op == self.REMOTES_RELAY_KEY:
+            if len(data) - 1 < self.RELAY_KEY_MIN:
+                return self.STATUS_INVALID
+            self.remotes.registry.set_relay_key(bytes(data[1:]))
+            return self.STATUS_OK
+        return self.STATUS_INVALID
+
+    async def send_config(self, connection: aioble.DeviceConnection, offset: int):
+        try:
+            size = uos.stat(CONFIG_EXPORT_FILE)[6]
+        except OSError:
+            with open(CONFIG_EXPORT_FILE, "wt") as f:
+                ujson.dump(settings_cfg, f)
+            size = uos.stat(CONFIG_EXPORT_FILE)[6]
+        # Notifications carry up to MTU - 3 bytes, mtu is None until the phone exchanges MTUs (default 23).
+        buf = bytearray(max((connection.mtu or 23) - 3, 6))
+        mv = memoryview(buf)
+        crc = 0
+        with open(CONFIG_EXPORT_FILE, "rb") as f:
+            while n := f.readinto(buf):
+                crc = binascii.crc32(mv[:n], crc)
+            self.transfer_characteristic.notify(connection, struct.pack("<BII", self.OP_INFO, size, crc))
+            f.seek(offset)
+            while n := f.readinto(mv[5:]):
+                struct.pack_into("<BI", buf, 0, self.OP_DATA, offset)
+                await self.notify_retry(connection, mv[: 5 + n])
+                offset += n
+
+    # Notifications fail while the controller's buffers are full, wait for it to send some.
+    async def notify_retry(self, connection: aioble.DeviceConnection, data):
+        while True:
+            try:
+                self.transfer_characteristic.notify(connection, data)
+                return
+            except OSError:
+                await uasyncio.sleep_ms(10)
+
+    async def l2cap_upload(self, connection: aioble.DeviceConnection):
+        try:
+            channel = await connection.l2cap_accept(self.L2CAP_PSM, self.L2CAP_MTU)
+            buf = bytearray(self.L2CAP_MTU)
+            mv = memoryview(buf)
+            while True:
+                # recvinto() fills the whole buffer when an SDU has more, so the header and the data are read
+                # into slices that end where they do: nothing past them is taken from the channel.
+                n = 0
+                while n < 8:
+                    n += await channel.recvinto(mv[n:8])
+                self.begin_upload(*struct.unpack_from("<II", buf))
+                while self.upload_received < self.upload_total:
+                    n = await channel.recvinto(mv[: min(len(buf), self.upload_total - self.upload_received)])
+                    if not self.upload_chunk(mv[:n]):
+                        break
+                self.transfer_status(connection, self.OP_END, self.end_upload(), self.upload_received)
+        except aioble.DeviceDisconnectedError:
+            return
+
@@ -0,0 +1,152 @@
+import binascii
+import struct
+
+import uasyncio
+import uos
+
+# Append-only record log. Each record is <op:u8><key len:u8><value len:u16><key><value><crc32:u32>,
+# the crc covers everything before it. Replay stops at the first torn or corrupt record.
+HEADER = "<BBH"
+HEADER_SIZE = 4
+CRC_SIZE = 4
+OP_PUT = 1
+OP_DELETE = 2
+
+
+class RecordStore:
+    def __init__(self, path: str, compact_min=4096):
+        self.path = path
+        self.compact_min = compact_min  # Don't bother compacting logs smaller than this
+        self.records: dict[str, bytes] = {}
+        self.size = 0  # Bytes in the log
+        self.live = 0  # Bytes the live records would take after compaction
+        try:
+            uos.remove(path + ".tmp")  # Unfinished compaction, the log itself is still intact
+        except OSError:
+            pass
+        if self.replay():
+            self.compact()  # Drop the torn tail so new records don't land after garbage
+
+    # Returns True if the log ended in a torn or corrupt record.
+    def replay(self) -> bool:
+        try:
+            f = open(self.path, "rb")
+        except OSError:
+            return False
+        with f:
+            while True:
+                header = f.read(HEADER_SIZE)
+                if not header:
+                    return False
+                if len(header) < HEADER_SIZE:
+                    return True
+                op, key_len, value_len = struct.unpack(HEADER, header)
+                body = f.read(key_len + value_len + CRC_SIZE)
+                if len(body) < key_len + value_len + CRC_SIZE:
+                    return True
+                data = memoryview(body)[:-CRC_SIZE]
+                if binascii.crc32(data, binascii.crc32(header)) != struct.unpack("<I", body[-CRC_SIZE:])[0]:
+                    return True
+                key = bytes(data[:key_len]).decode()
+                if op == OP_PUT:
+                    self._apply(key, bytes(data[key_len:]))
+                elif op == OP_DELETE:
+                    self._apply(key, None)
+                self.size += HEADER_SIZE + len(body)
+
+    def get(self, key: str, default: bytes | None = None) -> bytes | None:
+        return self.records.get(key, default)
+
+    def put(self, key: str, value: bytes):
+        if self.records.get(key) == value:
+            return
+        self._append(OP_PUT, key, value)
+
+    def delete(self, key: str):
+        if key in self.records:
+            self._append(OP_DELETE, key, b"")
+
+    def compact(self):
+        tmp = self.path + ".tmp"
+        with open(tmp, "wb") as f:
+            size = 0
+            for key, value in self.records.items():
+                size += f.write(self._encode(OP_PUT, key, value))
+        uos.rename(tmp, self.path)
+        self.size = size
+
+    def _append(self, op: int, key: str, value: bytes):
+        with open(self.path, "ab") as f:
+            self.size += f.write(self._encode(op, key, value))
+        self._apply(key, value if op == OP_PUT else None)
+        if self.size > self.compact_min and self.size > 2 * self.live:
+            self.compact()
+
+    def _apply(self, key: str, value: bytes | None):
+        old = self.records.pop(key, None)
+        if old is not None:
+            self.live -= self._record_size(key, old)
+        if value is not None:
+            self.records[key] = value
+            self.live += self._record_size(key, value)
+
+    @staticmethod
+    def _record_size(key: str, value: bytes) -> int:
+        return HEADER_SIZE + len(key) + len(value) + CRC_SIZE
+
+    @staticmethod
+    def _encode(op: int, key: str, value: bytes) -> bytes:
+        key_bytes = key.encode()
+        record = struct.pack(HEADER, op, len(key_bytes), len(value)) + key_bytes + value
+        return record + struct.pack("<I", binascii.crc32(record))
+
+
+# Current level as one small record in its own file: <index:u16><duty:u16><check:u16>. Saves are debounced, so
+# a burst of presses costs one write, and boot reads the record back. Wear-leveling is the filesystem's job:
+# littlefs (what MicroPython formats the ESP32's flash with) writes updates copy-on-write and moves blocks that
+# have seen too many erases, so the writes spread over the whole partition, and a write torn by a power cut
+# leaves the previous record. On FAT the check catches a torn sector.
+STATE = "<HHH"
+STATE_SIZE = 6
+
+
+class StateFile:
+    def __init__(self, path: str, debounce_ms=2000):
+        self.path = path
+        self.debounce_ms = debounce_ms
+        self.state: tuple[int, int] | None = None  # (index, duty)
+        self.pending: tuple[int, int] | None = None
+        self.task = None
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except OSError:
+            return
+        if len(data) == STATE_SIZE:
+            index, duty, check = struct.unpack(STATE, data)
+            if check == self._check(index, duty):
+                self.state = (index, duty)
+
+    @staticmethod
+    def _check(index: int, duty: int) -> int:
+        return index ^ duty ^ 0xA5A5
+
+    def save(self, index: int, duty: int):
+        self.pending = (index, duty)
+        if self.task is None:
+            self.task = uasyncio.create_task(self.flush_later())
+
+    async def flush_later(self):
+        await uasyncio.sleep_ms(self.debounce_ms)
+        self.task = None
+        self.flush()
+
+    def flush(self):
+        if self.pending is None or self.pending == self.state:
+            self.pending = None
+            return
+        index, duty = self.pending
+        self.pending = None
+        with open(self.path, "wb") as f:
+            f.write(struct.pack(STATE, index, duty, self._check(index, duty)))
+        self.state = (index, duty)
@@ -16,3 +16,24 @@ def write_to_file(file: str, value: str):
 def load_file(file: str):
     with open(file, "rt") as f:
         return f.read()
+
+
+def write_bytes_to_file(file: str, value: bytes):
+    with open(file, "wb") as f:
+        return f.write(value)
+
+
+def load_bytes_file(file: str) -> bytes:
+    with open(file, "rb") as f:
+        return f.read()
+
+
+def hmac_sha256(key: bytes, msg: bytes) -> bytes:
+    if len(key) > 64:
+        key = hashlib.sha256(key).digest()
+    key = key + bytes(64 - len(key))
+    inner = hashlib.sha256(bytes(b ^ 0x36 for b in key))
+    inner.update(msg)
+    outer = hashlib.sha256(bytes(b ^ 0x5C for b in key))
+    outer.update(inner.digest())
+    return outer.digest()
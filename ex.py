@@ -49,115 +49,152 @@ _TEMP_UUID = bluetooth.UUID(0x2A6E)
 # org.bluetooth.characteristic.gap.appearance.xml
 _ADV_APPEARANCE_GENERIC_THERMOMETER = const(768)
 
-
+# Connections held at once, the controller's limit (MicroPython's ESP32 build
+# allows 4 with NimBLE).
+_MAX_SENSORS = const(4)
+
+
+# Connected (or being connected) sensor, the per-connection state of the central.
+class _Sensor:
+    def __init__(self, addr_type, addr, name):
+        self.addr_type = addr_type
+        self.addr = addr
+        self.name = name
+        self.conn_handle = None
+        self.start_handle = None
+        self.end_handle = None
+        self.value_handle = None
+        self.value = None
+        # Callback for a pending read, reset back to None after being invoked.
+        self.read_callback = None
+
+
+# Central for a room of sensors: a scan collects every sensor in range, then
+# they're connected one after the other. The next connection is only started
+# once the previous sensor's discovery finished (or failed), so service and
+# characteristic discovery never overlap between connections. IRQ events are
+# routed to the sensor by conn_handle.
 class BLETemperatureCentral:
-    def __init__(self, ble):
+    def __init__(self, ble, max_sensors=_MAX_SENSORS):
         self._ble = ble
+        self._max_sensors = max_sensors
         self._ble.active(True)
         self._ble.irq(self._irq)
 
         self._reset()
 
     def _reset(self):
-        # Cached name and address from a successful scan.
-        self._name = None
-        self._addr_type = None
-        self._addr = None
+        # Sensors found by the last scan and not connected yet, by address.
+        self._found = {}
+
+        # Sensors waiting for their turn to connect, and the one currently
+        # connecting or being discovered.
+        self._pending = []
+        self._connecting = None
 
-        # Cached value (if we have one)
-        self._value = None
+        # Connected sensors by conn_handle.
+        self._sensors = {}
 
-        # Callbacks for completion of various operations.
-        # These reset back to None after being invoked.
+        # Callbacks for completion of scanning and of each sensor's setup.
         self._scan_callback = None
         self._conn_callback = None
-        self._read_callback = None
 
-        # Persistent callback for when new data is notified from the device.
+        # Persistent callback for when new data is notified from a device.
         self._notify_callback = None
 
-        # Connected device.
-        self._conn_handle = None
-        self._start_handle = None
-        self._end_handle = None
-        self._value_handle = None
-
     def _irq(self, event, data):
         if event == _IRQ_SCAN_RESULT:
             addr_type, addr, adv_type, rssi, adv_data = data
             if adv_type in (_ADV_IND, _ADV_DIRECT_IND) and _ENV_SENSE_UUID in decode_services(
                 adv_data
             ):
-                # Found a potential device, remember it and stop scanning.
-                self._addr_type = addr_type
-                self._addr = bytes(
-                    addr
-                )  # Note: addr buffer is owned by caller so need to copy it.
-                self._name = decode_name(adv_data) or "?"
-                self._ble.gap_scan(None)
+                # Note: addr buffer is owned by caller so need to copy it.
+                addr = bytes(addr)
+                room = len(self._found) + len(self._sensors) < self._max_sensors
+                if room and addr not in self._found and self._sensor_by_addr(addr) is None:
+                    self._found[addr] = _Sensor(addr_type, addr, decode_name(adv_data) or "?")
+                    if len(self._found) + len(self._sensors) >= self._max_sensors:
+                        # As many as we can connect to, stop scanning early.
+                        self._ble.gap_scan(None)
 
         elif event == _IRQ_SCAN_DONE:
             if self._scan_callback:
-                if self._addr:
-                    # Found a device during the scan (and the scan was explicitly stopped).
-                    self._scan_callback(self._addr_type, self._addr, self._name)
-                    self._scan_callback = None
-                else:
-                    # Scan timed out.
-                    self._scan_callback(None, None, None)
+                self._scan_callback(list(self._found.values()))
+                self._scan_callback = None
 
         elif event == _IRQ_PERIPHERAL_CONNECT:
             # Connect successful.
             conn_handle, addr_type, addr = data
-            if addr_type == self._addr_type and addr == self._addr:
-                self._conn_handle = conn_handle
-                self._ble.gattc_discover_services(self._conn_handle)
+            sensor = self._connecting
+            if sensor and addr_type == sensor.addr_type and addr == sensor.addr:
+                sensor.conn_handle = conn_handle
+                self._sensors[conn_handle] = sensor
+                self._ble.gattc_discover_services(conn_handle)
 
         elif event == _IRQ_PERIPHERAL_DISCONNECT:
-            # Disconnect (either initiated by us or the remote end).
-            conn_handle, _, _ = data
-            if conn_handle == self._conn_handle:
-                # If it was initiated by us, it'll already be reset.
-                self._reset()
+            # Disconnect (either initiated by us or the remote end), or a
+            # connection attempt that failed (conn_handle 65535).
+            conn_handle, _, addr = data
+            sensor = self._sensors.pop(conn_handle, None)
+            connecting = self._connecting
+            if connecting and (sensor is connecting or bytes(addr) == connecting.addr):
+                # Didn't make it through setup, go on with the next sensor.
+                self._connect_next()
 
         elif event == _IRQ_GATTC_SERVICE_RESULT:
             # Connected device returned a service.
             conn_handle, start_handle, end_handle, uuid = data
-            if conn_handle == self._conn_handle and uuid == _ENV_SENSE_UUID:
-                self._start_handle, self._end_handle = start_handle, end_handle
+            sensor = self._sensors.get(conn_handle)
+            if sensor and uuid == _ENV_SENSE_UUID:
+                sensor.start_handle, sensor.end_handle = start_handle, end_handle
 
         elif event == _IRQ_GATTC_SERVICE_DONE:
             # Service query complete.
-            if self._start_handle and self._end_handle:
+            conn_handle, status = data
+            sensor = self._sensors.get(conn_handle)
+            if not sensor:
+                return
+            if sensor.start_handle and sensor.end_handle:
                 self._ble.gattc_discover_characteristics(
-                    self._conn_handle, self._start_handle, self._end_handle
+                    conn_handle, sensor.start_handle, sensor.end_handle
                 )
             else:
                 print("Failed to find environmental sensing service.")
+                self._ble.gap_disconnect(conn_handle)
 
         elif event == _IRQ_GATTC_CHARACTERISTIC_RESULT:
             # Connected device returned a characteristic.
             conn_handle, def_handle, value_handle, properties, uuid = data
-            if conn_handle == self._conn_handle and uuid == _TEMP_UUID:
-                self._value_handle = value_handle
+            sensor = self._sensors.get(conn_handle)
+            if sensor and uuid == _TEMP_UUID:
+                sensor.value_handle = value_handle
 
         elif event == _IRQ_GATTC_CHARACTERISTIC_DONE:
             # Characteristic query complete.
-            if self._value_handle:
-                # We've finished connecting and discovering device, fire the connect callback.
+            conn_handle, status = data
+            sensor = self._sensors.get(conn_handle)
+            if not sensor:
+                return
+            if sensor.value_handle:
+                # We've finished connecting and discovering this device, fire
+                # the connect callback and start on the next one.
                 if self._conn_callback:
-                    self._conn_callback()
+                    self._conn_callback(sensor)
+                if sensor is self._connecting:
+                    self._connect_next()
             else:
                 print("Failed to find temperature characteristic.")
+                self._ble.gap_disconnect(conn_handle)
 
         elif event == _IRQ_GATTC_READ_RESULT:
             # A read completed successfully.
             conn_handle, value_handle, char_data = data
-            if conn_handle == self._conn_handle and value_handle == self._value_handle:
-                self._update_value(char_data)
-                if self._read_callback:
-                    self._read_callback(self._value)
-                    self._read_callback = None
+            sensor = self._sensors.get(conn_handle)
+            if sensor and value_handle == sensor.value_handle:
+                self._update_value(sensor, char_data)
+                if sensor.read_callback:
+                    sensor.read_callback(conn_handle, sensor.value)
+                    sensor.read_callback = None
 
         elif event == _IRQ_GATTC_READ_DONE:
             # Read completed (no-op).
@@ -166,96 +203,149 @@ class BLETemperatureCentral:
         elif event == _IRQ_GATTC_NOTIFY:
             # The ble_temperature.py demo periodically notifies its value.
             conn_handle, value_handle, notify_data = data
-            if conn_handle == self._conn_handle and value_handle == self._value_handle:
-                self._update_value(notify_data)
+            sensor = self._sensors.get(conn_handle)
+            if sensor and value_handle == sensor.value_handle:
+                self._update_value(sensor, notify_data)
                 if self._notify_callback:
-                    self._notify_callback(self._value)
-
-    # Returns true if we've successfully connected and discovered characteristics.
-    def is_connected(self):
-        return self._conn_handle is not None and self._value_handle is not None
-
-    # Find a device advertising the environmental sensor service.
-    def scan(self, callback=None):
-        self._addr_type = None
-        self._addr = None
+                    self._notify_callback(conn_handle, sensor.value)
+
+    def _sensor_by_addr(self, addr):
+        for sensor in self._sensors.values():
+            if sensor.addr == addr:
+                return sensor
+        if self._connecting and self._connecting.addr == addr:
+            return self._connecting
+        return None
+
+    # Start connecting the next waiting sensor, if there's room for it.
+    def _connect_next(self):
+        self._connecting = None
+        if self._pending and len(self._sensors) < self._max_sensors:
+            self._connecting = self._pending.pop(0)
+            self._ble.gap_connect(self._connecting.addr_type, self._connecting.addr)
+
+    # Returns true if at least one sensor (or the given one) is connected and
+    # discovered.
+    def is_connected(self, conn_handle=None):
+        if conn_handle is not None:
+            sensor = self._sensors.get(conn_handle)
+            return sensor is not None and sensor.value_handle is not None
+        return bool(self.connected())
+
+    # Connection handles of the connected and discovered sensors.
+    def connected(self):
+        return [h for h, sensor in self._sensors.items() if sensor.value_handle is not None]
+
+    # True while sensors are still waiting for or going through setup.
+    def connecting(self):
+        return self._connecting is not None or bool(self._pending)
+
+    # Find devices advertising the environmental sensor service, callback gets
+    # the list of sensors found that aren't connected yet.
+    def scan(self, callback=None, duration_ms=2000):
+        self._found = {}
         self._scan_callback = callback
-        self._ble.gap_scan(2000, 30000, 30000)
+        self._ble.gap_scan(duration_ms, 30000, 30000)
 
-    # Connect to the specified device (otherwise use cached address from a scan).
+    # Connect to the sensors found by the last scan (or only the specified
+    # device), one at a time. callback is invoked with each sensor once it's
+    # ready.
     def connect(self, addr_type=None, addr=None, callback=None):
-        self._addr_type = addr_type or self._addr_type
-        self._addr = addr or self._addr
         self._conn_callback = callback
-        if self._addr_type is None or self._addr is None:
+        if addr_type is not None and addr is not None:
+            self._pending.append(_Sensor(addr_type, bytes(addr), "?"))
+        else:
+            self._pending.extend(self._found.values())
+            self._found = {}
+        if not self._pending:
             return False
-        self._ble.gap_connect(self._addr_type, self._addr)
+        if self._connecting is None:
+            self._connect_next()
         return True
 
-    # Disconnect from current device.
-    def disconnect(self):
-        if self._conn_handle is None:
-            return
-        self._ble.gap_disconnect(self._conn_handle)
-        self._reset()
-
-    # Issues an (asynchronous) read, will invoke callback with data.
-    def read(self, callback):
-        if not self.is_connected():
-            return
-        self._read_callback = callback
-        self._ble.gattc_read(self._conn_handle, self._value_handle)
-
-    # Sets a callback to be invoked when the device notifies us.
+    # Disconnect from one sensor, or from all of them.
+    def disconnect(self, conn_handle=None):
+        if conn_handle is None:
+            self._pending = []
+            for handle in list(self._sensors):
+                self._ble.gap_disconnect(handle)
+            self._sensors = {}
+            self._connecting = None
+        elif conn_handle in self._sensors:
+            self._ble.gap_disconnect(conn_handle)
+            del self._sensors[conn_handle]
+
+    # Issues an (asynchronous) read of one sensor or of every connected one,
+    # will invoke callback with the conn_handle and the value. Reads on
+    # different connections run concurrently.
+    def read(self, callback, conn_handle=None):
+        for handle in (conn_handle,) if conn_handle is not None else self.connected():
+            sensor = self._sensors.get(handle)
+            if sensor is None or sensor.value_handle is None or sensor.read_callback:
+                continue
+            sensor.read_callback = callback
+            self._ble.gattc_read(handle, sensor.value_handle)
+
+    # Sets a callback to be invoked with the conn_handle and the value when a
+    # device notifies us.
     def on_notify(self, callback):
         self._notify_callback = callback
 
-    def _update_value(self, data):
+    def _update_value(self, sensor, data):
         # Data is sint16 in degrees Celsius with a resolution of 0.01 degrees Celsius.
-        self._value = struct.unpack("<h", data)[0] / 100
-        return self._value
+        sensor.value = struct.unpack("<h", data)[0] / 100
+        return sensor.value
+
+    def value(self, conn_handle):
+        sensor = self._sensors.get(conn_handle)
+        return sensor.value if sensor else None
 
-    def value(self):
-        return self._value
+    # Most recent value of every connected sensor, as conn_handle: (name,
+    # value). Names aren't unique (or are "?"), so they can't be the key.
+    def values(self):
+        return {h: (sensor.name, sensor.value) for h, sensor in self._sensors.items()}
 
 
 def demo():
     ble = bluetooth.BLE()
     central = BLETemperatureCentral(ble)
 
-    not_found = False
+    found = None
 
-    def on_scan(addr_type, addr, name):
-        if addr_type is not None:
-            print("Found sensor:", addr_type, addr, name)
-            central.connect()
-        else:
-            nonlocal not_found
-            not_found = True
-            print("No sensor found.")
+    def on_scan(sensors):
+        nonlocal found
+        found = sensors
+        for sensor in sensors:
+            print("Found sensor:", sensor.addr_type, sensor.addr, sensor.name)
 
     central.scan(callback=on_scan)
 
-    # Wait for connection...
-    while not central.is_connected():
+    # Wait for the scan to finish...
+    while found is None:
+        time.sleep_ms(100)
+    if not found:
+        print("No sensor found.")
+        return
+
+    # ...and for every sensor to be connected (or to fail).
+    central.connect(callback=lambda sensor: print("Connected", sensor.name, sensor.conn_handle))
+    while central.connecting():
         time.sleep_ms(100)
-        if not_found:
-            return
 
-    print("Connected")
+    print("Connected to", len(central.connected()), "sensors")
 
-    # Explicitly issue reads, using "print" as the callback.
+    # Explicitly issue reads of all sensors, using "print" as the callback.
     while central.is_connected():
         central.read(callback=print)
         time.sleep_ms(2000)
 
-    # Alternative to the above, just show the most recently notified value.
+    # Alternative to the above, just show the most recently notified values.
     # while central.is_connected():
-    #     print(central.value())
+    #     print(central.values())
     #     time.sleep_ms(2000)
 
     print("Disconnected")
 
 
 if __name__ == "__main__":
-    demo()
\ No newline at end of file
+    demo()
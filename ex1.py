@@ -14,19 +14,94 @@
 # characteristic (e.g. file size), or via the L2CAP channel (file contents or
 # directory listing).
 
+# A command has to fit in one write of at most _ATT_MTU - 3 bytes; anything
+# longer is cut short by the stack without an error. That leaves 50 bytes of
+# path for SEND and HASH, 55 for RECV and PATCH and 54 less the prefix for LIST.
+
+# Uploads carry the file size between the sequence number and the path
+# (<command><seq><size:u32><path...>). The client then streams exactly that many
+# bytes over the L2CAP channel. They are written to a temporary file, which
+# replaces the target only once the whole file has arrived, so an interrupted
+# upload never leaves a truncated file behind. Progress notifications
+# (<PROGRESS><seq><received:u32>) are sent every _RECV_PROGRESS_BYTES, followed
+# by the usual done notification.
+
+# Commands are queued per connection and run in order, so a client can write
+# several SEND/RECV/LIST commands back to back. Every reply carries the seq of
+# its command. A command written while _MAX_PENDING_OPS are already queued (or
+# reusing a queued seq) is answered right away with _STATUS_BUSY.
+
+# Up to _MAX_CONNECTIONS centrals can be connected at once, each with its own
+# session and operation queue. The stack has only one L2CAP channel though (a
+# second l2cap_accept fails with EALREADY), so sessions take turns: a session
+# accepts the channel only once it has queued commands, and closes it after an
+# operation when another session is waiting, leaving the rest of its queue for
+# its next turn. A central opens the channel after writing a command, retrying
+# until it's accepted, and opens it again whenever the device closes it before
+# the reply (that command hasn't run yet, its upload has to be sent again).
+
+# Downloads read ahead into a ring of _SEND_BUFFERS buffers of _SEND_BUFFER_SIZE
+# bytes, so flash reads overlap with the channel waiting for credits. Their done
+# notification has the achieved rate appended: <DONE><seq><status><bytes/s:u32>.
+
+# Listings are binary and paged:
+#   <LIST><seq><cursor:u16><limit:u16><prefix len:u8><prefix...><path...>
+# Entries whose name starts with prefix are packed into SDUs of the peer's MTU
+# as <type:u8><size:u32><mtime:u32><name len:u8><name...>, type being the upper
+# bits of the mode (4 directory, 8 file). limit 0 means no limit. The done
+# notification is <DONE><seq><status><entries:u16><next cursor:u16>, and the
+# next page starts at that cursor; 0 means the listing is complete.
+
+# Downloads and checksums work on a byte range, so an interrupted download can
+# resume where it stopped and a client can check what it already has:
+#   <SEND><seq><offset:u32><length:u32><path...>
+#   <HASH><seq><algorithm:u8><offset:u32><length:u32><path...>
+# length 0 means up to the end of the file, and a range past the end is cut
+# short. HASH is answered with <DONE><seq><status><algorithm><digest>, the
+# digest being SHA-256 (32 bytes, needs an ATT MTU of at least 38) or CRC32
+# (u32). An offset past the end of the file is _STATUS_BAD_RANGE.
+
+# SEND and RECV with _COMMAND_FLAG_COMPRESSED set in the command byte transfer
+# a zlib stream instead of the raw bytes. For RECV the size is the size of the
+# zlib stream, and it's inflated once it has been received. Both report
+# <compressed:u32><raw:u32> in the done notification (after the rate for
+# SEND). Uploads should use a window of at most 2**_DEFLATE_WBITS bytes, the
+# device allocates whatever the zlib header asks for. Without the deflate
+# module compressed commands answer _STATUS_NOT_IMPLEMENTED.
+
+# Delta updates (see mpysync.py) use two more commands:
+#   <BLOCKS><seq><block size:u16><path...>
+# sends the CRC32 of every block of the file over the channel as u32s, packed
+# into full frames, and answers <DONE><seq><status><file size:u32>.
+#   <PATCH><seq><size:u32><path...>
+# receives a delta of size bytes (optionally compressed, like RECV) and
+# rebuilds the file from it into a temporary file. The delta is
+# <new size:u32><sha256:32> followed by ops, <COPY><offset:u32><length:u32>
+# copying a range of the current file or <DATA><length:u32><bytes...>. The
+# result replaces the file only if its size and SHA-256 match the header.
+
 import sys
 
 # ruff: noqa: E402
 sys.path.append("")
 
 import asyncio
+import binascii
+import hashlib
+import io
 import os
 import struct
+import time
 
 import aioble
 import bluetooth
 from micropython import const
 
+try:
+    import deflate
+except ImportError:
+    deflate = None
+
 # Randomly generated UUIDs.
 _FILE_SERVICE_UUID = bluetooth.UUID("0492fcec-7194-11eb-9439-0242ac130002")
 _CONTROL_CHARACTERISTIC_UUID = bluetooth.UUID("0492fcec-7194-11eb-9439-0242ac130003")
@@ -36,129 +111,650 @@ _ADV_INTERVAL_MS = 250_000
 
 
 _COMMAND_SEND = const(0)
-_COMMAND_RECV = const(1)  # Not yet implemented.
+_COMMAND_RECV = const(1)
 _COMMAND_LIST = const(2)
 _COMMAND_SIZE = const(3)
 _COMMAND_DONE = const(4)
+_COMMAND_PROGRESS = const(5)
+_COMMAND_HASH = const(6)
+_COMMAND_BLOCKS = const(7)
+_COMMAND_PATCH = const(8)
+_COMMAND_FLAG_COMPRESSED = const(0x80)
+
+_HASH_SHA256 = const(0)
+_HASH_CRC32 = const(1)
+
+_DELTA_COPY = const(0)
+_DELTA_DATA = const(1)
 
 _STATUS_OK = const(0)
 _STATUS_NOT_IMPLEMENTED = const(1)
 _STATUS_NOT_FOUND = const(2)
+_STATUS_FAILED = const(3)
+_STATUS_BUSY = const(4)
+_STATUS_BAD_RANGE = const(5)
 
 _L2CAP_PSN = const(22)
-_L2CAP_MTU = const(128)
+# Our receive MTU, i.e. the largest SDU the client can send in an upload. Larger
+# SDUs mean fewer recvinto() calls and file writes per byte.
+_L2CAP_MTU = const(512)
 
+_RECV_PROGRESS_BYTES = const(4096)
+# Give up on an upload if the client stops sending for this long.
+_RECV_TIMEOUT_MS = const(5000)
+_RECV_TMP_SUFFIX = ".part"
+_RECV_COMPRESSED_SUFFIX = ".z.part"
+_DELTA_SUFFIX = ".delta"
 
-# Register GATT server.
-file_service = aioble.Service(_FILE_SERVICE_UUID)
-control_characteristic = aioble.Characteristic(
-    file_service, _CONTROL_CHARACTERISTIC_UUID, write=True, notify=True
-)
-aioble.register_services(file_service)
+# 1 KB window: small enough for the heap, still 3-5x on JSON and sources.
+_DEFLATE_WBITS = const(10)
 
+_MAX_PENDING_OPS = const(4)
 
-send_file = None
-recv_file = None
-list_path = None
-op_seq = None
-l2cap_event = asyncio.Event()
+# A session whose central doesn't open the channel in time gives up its turn.
+_ACCEPT_TIMEOUT_MS = const(10_000)
 
+# The controller has to be built with at least this many connections.
+_MAX_CONNECTIONS = const(3)
 
-def send_done_notification(connection, status=_STATUS_OK):
-    global op_seq
-    control_characteristic.notify(connection, struct.pack("<BBB", _COMMAND_DONE, op_seq, status))
-    op_seq = None
+_SEND_BUFFERS = const(3)
+# channel.send() splits each buffer into SDUs of the peer's MTU.
+_SEND_BUFFER_SIZE = const(1024)
 
+_LIST_ENTRY_HEADER = const(10)
 
-async def l2cap_task(connection):
-    global send_file, recv_file, list_path
-    try:
-        channel = await connection.l2cap_accept(_L2CAP_PSN, _L2CAP_MTU)
-        print("channel accepted")
+# Large enough for a HASH reply with a SHA-256 digest. Also sets the longest
+# command a client can write.
+_ATT_MTU = const(64)
 
-        while True:
-            await l2cap_event.wait()
-            l2cap_event.clear()
-
-            if send_file:
-                print("Sending:", send_file)
-                with open(send_file, "rb") as f:  # noqa: ASYNC230
-                    buf = bytearray(channel.peer_mtu)
-                    mv = memoryview(buf)
-                    while n := f.readinto(buf):
-                        await channel.send(mv[:n])
-                await channel.flush()
-                send_done_notification(connection)
-                send_file = None
-            if recv_file:
-                print("Receiving:", recv_file)
-                send_done_notification(connection, _STATUS_NOT_IMPLEMENTED)
-                recv_file = None
-            if list_path:
-                print("List:", list_path)
-                try:
-                    for name, _, _, size in os.ilistdir(list_path):
-                        await channel.send("{}:{}\n".format(size, name))
-                    await channel.send("\n")
-                    await channel.flush()
-                    send_done_notification(connection)
-                except OSError:
-                    send_done_notification(connection, _STATUS_NOT_FOUND)
-                list_path = None
 
-    except aioble.DeviceDisconnectedError:
-        print("Stopping l2cap")
-        return
-
-
-async def control_task(connection):
-    global send_file, recv_file, list_path
+aioble.config(mtu=_ATT_MTU)
 
+# Register GATT server.
+file_service = aioble.Service(_FILE_SERVICE_UUID)
+# Capture every write, otherwise commands written back to back overwrite each
+# other before control_task reads them.
+control_characteristic = aioble.Characteristic(
+    file_service, _CONTROL_CHARACTERISTIC_UUID, write=True, notify=True, capture=True
+)
+aioble.register_services(file_service)
+# The value buffer defaults to 20 bytes, too short for most commands.
+bluetooth.BLE().gatts_set_buffer(control_characteristic._value_handle, _ATT_MTU - 3)
+
+
+# Operations of one connection, oldest first: (command, seq, path, arg), arg
+# being the (offset, length, compressed) of a download, the (size, compressed)
+# of an upload or a delta, the (cursor, limit, prefix) of a listing, the
+# (algorithm, offset, length) of a checksum or the block size of BLOCKS. The
+# running operation stays at the head until it's done.
+class OpQueue:
+    def __init__(self, depth=_MAX_PENDING_OPS):
+        self.depth = depth
+        self.ops = []
+        self.event = asyncio.Event()
+
+    def put(self, op):
+        if len(self.ops) >= self.depth or any(o[1] == op[1] for o in self.ops):
+            return False
+        self.ops.append(op)
+        self.event.set()
+        return True
+
+    async def head(self):
+        while not self.ops:
+            await self.event.wait()
+            self.event.clear()
+        return self.ops[0]
+
+    def done(self):
+        self.ops.pop(0)
+
+
+# One connected central, with its own L2CAP channel and operation queue.
+class Session:
+    def __init__(self, connection):
+        self.connection = connection
+        self.queue = OpQueue()
+        sessions[connection._conn_handle] = self
+
+    async def serve(self):
+        t = asyncio.create_task(l2cap_task(self.connection, self.queue))
+        try:
+            await self.connection.disconnected(timeout_ms=None)
+        finally:
+            t.cancel()
+            del sessions[self.connection._conn_handle]
+            session_closed.set()
+            print("Session closed", self.connection.device)
+
+
+sessions = {}  # conn handle -> Session
+session_closed = asyncio.Event()
+channel_lock = asyncio.Lock()  # Held by the session with the L2CAP channel
+channel_waiting = 0  # Sessions with queued commands waiting for the channel
+
+
+def send_done_notification(connection, seq, status=_STATUS_OK, extra=b""):
+    msg = struct.pack("<BBB", _COMMAND_DONE, seq, status)
+    control_characteristic.notify(connection, msg + extra if extra else msg)
+
+
+# Pack the entries of a directory into full frames. Returns the number of
+# entries sent and the cursor to resume from (0 when the listing is complete).
+async def send_listing(channel, path, cursor, limit, prefix, buf):
+    mv = memoryview(buf)
+    base = path + "/" if path and not path.endswith("/") else path
+    n = 0
+    count = 0
+    pos = 0
+    for entry in os.ilistdir(path):
+        pos += 1
+        name = entry[0]
+        if pos <= cursor or not name.startswith(prefix):
+            continue
+        stat = os.stat(base + name)
+        encoded = name.encode()[: min(255, len(buf) - _LIST_ENTRY_HEADER)]
+        end = n + _LIST_ENTRY_HEADER + len(encoded)
+        if end > len(buf):
+            await channel.send(mv[:n])
+            n = 0
+            end = _LIST_ENTRY_HEADER + len(encoded)
+        struct.pack_into("<BIIB", buf, n, entry[1] >> 12, stat[6], stat[8], len(encoded))
+        buf[n + _LIST_ENTRY_HEADER : end] = encoded
+        n = end
+        count += 1
+        if count == limit:
+            break
+    else:
+        pos = 0
+    if n:
+        await channel.send(mv[:n])
+    await channel.flush()
+    return count, pos
+
+
+# Open path positioned at offset. Returns the file and the number of bytes
+# left in the range, length 0 meaning up to the end of the file.
+def open_range(path, offset, length):
+    size = os.stat(path)[6]
+    if offset > size:
+        raise ValueError("range")
+    f = open(path, "rb")
+    f.seek(offset)
+    return f, min(length, size - offset) if length else size - offset
+
+
+# Send length bytes of a file through a ring of buffers: a reader task fills
+# the free buffers while this coroutine sends the filled ones, so the next
+# chunk is already read by the time channel.send() returns. Returns the
+# achieved bytes/s.
+async def send_from_file(channel, f, length, bufs, lengths):
+    count = len(bufs)
+    read = 0
+    sent = 0
+    ready = asyncio.Event()
+    free = asyncio.Event()
+
+    async def reader():
+        nonlocal read, length
+        while True:
+            while read - sent >= count:
+                free.clear()
+                await free.wait()
+            i = read % count
+            try:
+                if length >= len(bufs[i]):
+                    n = f.readinto(bufs[i])
+                else:
+                    n = f.readinto(memoryview(bufs[i])[:length]) if length else 0
+            except OSError:
+                n = -1
+            lengths[i] = n
+            read += 1
+            ready.set()
+            if n <= 0:
+                return
+            length -= n
+            # Let the sender pick the buffer up before reading the next one.
+            await asyncio.sleep(0)
+
+    start = time.ticks_ms()
+    total = 0
+    t = asyncio.create_task(reader())
     try:
-        with connection.timeout(None):
-            while True:
-                print("Waiting for write")
-                await control_characteristic.written()
-                msg = control_characteristic.read()
-                control_characteristic.write(b"")
-
-                if len(msg) < 3:
-                    continue
-
-                # Message is <command><seq><path...>.
-
-                command = msg[0]
-                seq = msg[1]
-                file = msg[2:].decode()
-
-                if command == _COMMAND_SEND:
-                    send_file = file
-                    l2cap_event.set()
-                elif command == _COMMAND_RECV:
-                    recv_file = file
-                    l2cap_event.set()
-                elif command == _COMMAND_LIST:
-                    list_path = file
-                    l2cap_event.set()
-                elif command == _COMMAND_SIZE:
-                    try:
-                        stat = os.stat(file)
-                        size = stat[6]
-                        status = 0
-                    except OSError:
-                        size = 0
-                        status = _STATUS_NOT_FOUND
-                    control_characteristic.notify(
-                        connection, struct.pack("<BBI", seq, status, size)
-                    )
-    except aioble.DeviceDisconnectedError:
+        while True:
+            while sent == read:
+                ready.clear()
+                await ready.wait()
+            i = sent % count
+            n = lengths[i]
+            if n < 0:
+                raise OSError("read")
+            if n == 0:
+                break
+            await channel.send(bufs[i] if n == len(bufs[i]) else memoryview(bufs[i])[:n])
+            total += n
+            sent += 1
+            free.set()
+        await channel.flush()
+    finally:
+        t.cancel()
+    return total * 1000 // max(1, time.ticks_diff(time.ticks_ms(), start))
+
+
+# Compressed send: DeflateIO writes its output a byte at a time, so it goes
+# into a BytesIO (which keeps its capacity when rewound) and is sent from
+# there after every input chunk. Returns the raw bytes/s and the compressed
+# size.
+async def send_compressed(channel, f, length, inbuf, outbuf):
+    inmv = memoryview(inbuf)
+    outmv = memoryview(outbuf)
+    sink = io.BytesIO()
+    z = deflate.DeflateIO(sink, deflate.ZLIB, _DEFLATE_WBITS)
+    start = time.ticks_ms()
+    total = 0
+    compressed = 0
+    while True:
+        n = f.readinto(inmv[: min(length - total, len(inbuf))]) if total < length else 0
+        if n:
+            z.write(inmv[:n])
+            total += n
+        else:
+            z.close()
+        pending = sink.tell()
+        sink.seek(0)
+        while pending:
+            k = sink.readinto(outmv[: min(pending, len(outbuf))])
+            await channel.send(outmv[:k])
+            pending -= k
+            compressed += k
+        sink.seek(0)
+        if not n:
+            break
+    await channel.flush()
+    return total * 1000 // max(1, time.ticks_diff(time.ticks_ms(), start)), compressed
+
+
+# Checksum length bytes of a file in chunks of buf, yielding between chunks so
+# the control task keeps answering while a large file is hashed.
+async def hash_file(f, length, algorithm, buf):
+    mv = memoryview(buf)
+    if algorithm == _HASH_SHA256:
+        h = hashlib.sha256()
+    else:
+        crc = 0
+    while length:
+        n = f.readinto(mv[: min(length, len(buf))])
+        if not n:
+            break
+        if algorithm == _HASH_SHA256:
+            h.update(mv[:n])
+        else:
+            crc = binascii.crc32(mv[:n], crc)
+        length -= n
+        await asyncio.sleep(0)
+    if algorithm == _HASH_SHA256:
+        return h.digest()
+    return struct.pack("<I", crc & 0xFFFFFFFF)
+
+
+# Stream size bytes from the channel into a temporary file (inflating it into
+# a second one if compressed), then rename it over the target. Uses only the
+# buffers allocated by l2cap_task, so nothing is allocated per chunk. Returns
+# the status and the size of the file written.
+async def recv_to_file(connection, channel, seq, path, size, compressed, buf, progress):
+    mv = memoryview(buf)
+    tmp = path + _RECV_TMP_SUFFIX
+    ztmp = path + _RECV_COMPRESSED_SUFFIX
+    received = 0
+    next_progress = _RECV_PROGRESS_BYTES
+    try:
+        with open(ztmp if compressed else tmp, "wb") as f:  # noqa: ASYNC230
+            while received < size:
+                n = await channel.recvinto(buf, _RECV_TIMEOUT_MS)
+                if received + n > size:
+                    raise ValueError("overrun")
+                f.write(buf if n == len(buf) else mv[:n])
+                received += n
+                if received >= next_progress:
+                    struct.pack_into("<BBI", progress, 0, _COMMAND_PROGRESS, seq, received)
+                    control_characteristic.notify(connection, progress)
+                    next_progress += _RECV_PROGRESS_BYTES
+        if compressed:
+            received = await inflate_file(ztmp, tmp, buf)
+            os.remove(ztmp)
+        replace(tmp, path)
+        return _STATUS_OK, received
+    except (OSError, ValueError, asyncio.TimeoutError):
+        for name in (tmp, ztmp):
+            try:
+                os.remove(name)
+            except OSError:
+                pass
+        return _STATUS_FAILED, received
+
+
+def replace(tmp, path):
+    try:
+        os.rename(tmp, path)
+    except OSError:
+        # Filesystems without rename-over-existing (FAT).
+        os.remove(path)
+        os.rename(tmp, path)
+
+
+async def inflate_file(src, dst, buf):
+    mv = memoryview(buf)
+    raw = 0
+    with open(src, "rb") as f, open(dst, "wb") as out:  # noqa: ASYNC230
+        z = deflate.DeflateIO(f, deflate.ZLIB)
+        while n := z.readinto(buf):
+            out.write(buf if n == len(buf) else mv[:n])
+            raw += n
+            await asyncio.sleep(0)
+    return raw
+
+
+# Send the CRC32 of each block_size bytes of a file, reading through buf and
+# packing the CRCs into frames in out. Returns the file size.
+async def send_block_hashes(channel, path, block_size, buf, out):
+    mv = memoryview(buf)
+    outmv = memoryview(out)
+    size = os.stat(path)[6]
+    n = 0
+    with open(path, "rb") as f:  # noqa: ASYNC230
+        for start in range(0, size, block_size):
+            crc = 0
+            left = min(block_size, size - start)
+            while left:
+                k = f.readinto(mv[: min(left, len(buf))])
+                if not k:
+                    raise OSError("short read")
+                crc = binascii.crc32(mv[:k], crc)
+                left -= k
+            if n + 4 > len(out):
+                await channel.send(outmv[:n])
+                n = 0
+            struct.pack_into("<I", out, n, crc & 0xFFFFFFFF)
+            n += 4
+    if n:
+        await channel.send(outmv[:n])
+    await channel.flush()
+    return size
+
+
+# Rebuild path from the current file and a received delta, then swap it in.
+async def apply_delta(path, delta, buf):
+    mv = memoryview(buf)
+    tmp = path + _RECV_TMP_SUFFIX
+    old = None
+    h = hashlib.sha256()
+    written = 0
+    try:
+        with open(delta, "rb") as d, open(tmp, "wb") as out:  # noqa: ASYNC230
+            header = d.read(36)
+            if len(header) != 36:
+                raise ValueError("short delta")
+            size, digest = struct.unpack("<I32s", header)
+            while op := d.read(1):
+                if op[0] == _DELTA_COPY:
+                    offset, length = struct.unpack("<II", d.read(8))
+                    if old is None:
+                        old = open(path, "rb")  # noqa: ASYNC230
+                    old.seek(offset)
+                    src = old
+                else:
+                    length = struct.unpack("<I", d.read(4))[0]
+                    src = d
+                while length:
+                    n = src.readinto(mv[: min(length, len(buf))])
+                    if not n:
+                        raise ValueError("short delta")
+                    out.write(mv[:n])
+                    h.update(mv[:n])
+                    written += n
+                    length -= n
+                    await asyncio.sleep(0)
+        if old is not None:
+            old.close()
+            old = None
+        if written != size or h.digest() != digest:
+            raise ValueError("digest")
+        replace(tmp, path)
+        return _STATUS_OK
+    except (OSError, ValueError):
+        if old is not None:
+            old.close()
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        return _STATUS_FAILED
+    finally:
+        try:
+            os.remove(delta)
+        except OSError:
+            pass
+
+
+# Takes a turn on the channel whenever the queue has commands. Waking the other
+# sessions' queues lets one idling with the channel notice it's wanted.
+async def l2cap_task(connection, queue):
+    global channel_waiting
+    while True:
+        await queue.head()
+        channel_waiting += 1
+        for session in sessions.values():
+            session.queue.event.set()
+        try:
+            await channel_lock.acquire()
+        finally:
+            channel_waiting -= 1
+        try:
+            await channel_turn(connection, queue)
+        except aioble.DeviceDisconnectedError:
+            print("Stopping l2cap")
+            return
+        finally:
+            channel_lock.release()
+
+
+# Runs queued operations until another session waits for the channel, then
+# closes it. Transfer buffers are allocated per turn, so only the session
+# holding the channel has them.
+async def channel_turn(connection, queue):
+    try:
+        channel = await connection.l2cap_accept(_L2CAP_PSN, _L2CAP_MTU, _ACCEPT_TIMEOUT_MS)
+    except asyncio.TimeoutError:
         return
+    print("channel accepted")
+    try:
+        recv_buf = bytearray(_L2CAP_MTU)
+        progress = bytearray(6)
+        send_bufs = [bytearray(_SEND_BUFFER_SIZE) for _ in range(_SEND_BUFFERS)]
+        send_lengths = [0] * _SEND_BUFFERS
+        list_buf = bytearray(channel.peer_mtu)
 
+        while True:
+            command, seq, path, arg = queue.ops[0]
 
-# Serially wait for connections. Don't advertise while a central is
-# connected.
+            if command == _COMMAND_SEND:
+                print("Sending:", path, arg)
+                try:
+                    f, length = open_range(path, arg[0], arg[1])
+                except OSError:
+                    send_done_notification(connection, seq, _STATUS_NOT_FOUND)
+                except ValueError:
+                    send_done_notification(connection, seq, _STATUS_BAD_RANGE)
+                else:
+                    try:
+                        if arg[2]:
+                            rate, compressed = await send_compressed(
+                                channel, f, length, send_bufs[0], send_bufs[1]
+                            )
+                            stats = struct.pack("<III", rate, compressed, length)
+                        else:
+                            rate = await send_from_file(
+                                channel, f, length, send_bufs, send_lengths
+                            )
+                            stats = struct.pack("<I", rate)
+                        print("Sent", path, rate, "B/s")
+                        send_done_notification(connection, seq, _STATUS_OK, stats)
+                    except OSError:
+                        send_done_notification(connection, seq, _STATUS_FAILED)
+                    finally:
+                        f.close()
+            elif command == _COMMAND_RECV:
+                print("Receiving:", path, arg)
+                size, compressed = arg
+                status, raw = await recv_to_file(
+                    connection, channel, seq, path, size, compressed, recv_buf, progress
+                )
+                stats = struct.pack("<II", size, raw) if compressed else b""
+                send_done_notification(connection, seq, status, stats)
+            elif command == _COMMAND_LIST:
+                print("List:", path)
+                try:
+                    count, cursor = await send_listing(channel, path, *arg, list_buf)
+                    page = struct.pack("<HH", count, cursor)
+                    send_done_notification(connection, seq, _STATUS_OK, page)
+                except OSError:
+                    send_done_notification(connection, seq, _STATUS_NOT_FOUND)
+            elif command == _COMMAND_HASH:
+                print("Hash:", path, arg)
+                algorithm, offset, length = arg
+                try:
+                    f, length = open_range(path, offset, length)
+                    try:
+                        digest = await hash_file(f, length, algorithm, send_bufs[0])
+                    finally:
+                        f.close()
+                    reply = bytes((algorithm,)) + digest
+                    send_done_notification(connection, seq, _STATUS_OK, reply)
+                except OSError:
+                    send_done_notification(connection, seq, _STATUS_NOT_FOUND)
+                except ValueError:
+                    send_done_notification(connection, seq, _STATUS_BAD_RANGE)
+            elif command == _COMMAND_BLOCKS:
+                print("Blocks:", path, arg)
+                try:
+                    size = await send_block_hashes(channel, path, arg, send_bufs[0], list_buf)
+                    send_done_notification(connection, seq, _STATUS_OK, struct.pack("<I", size))
+                except OSError:
+                    send_done_notification(connection, seq, _STATUS_NOT_FOUND)
+            elif command == _COMMAND_PATCH:
+                print("Patching:", path, arg)
+                size, compressed = arg
+                delta = path + _DELTA_SUFFIX
+                status, _ = await recv_to_file(
+                    connection, channel, seq, delta, size, compressed, recv_buf, progress
+                )
+                if status == _STATUS_OK:
+                    status = await apply_delta(path, delta, recv_buf)
+                send_done_notification(connection, seq, status)
+            queue.done()
+
+            while not queue.ops and not channel_waiting:
+                queue.event.clear()
+                await queue.event.wait()
+            if channel_waiting:
+                return
+
+    except aioble.L2CAPDisconnectedError:
+        # Closed by the central, the operation at the head runs again next turn.
+        print("channel closed")
+    finally:
+        await channel.disconnect()
+
+
+# Writes from every connection arrive on the one control characteristic, each
+# command goes to the queue of the session it came from.
+async def control_task():
+    while True:
+        print("Waiting for write")
+        connection, msg = await control_characteristic.written()
+        session = sessions.get(connection._conn_handle)
+        if session is None:
+            continue
+
+        if len(msg) < 3:
+            continue
+
+        # Message is <command><seq><path...>.
+
+        command = msg[0] & ~_COMMAND_FLAG_COMPRESSED
+        compressed = bool(msg[0] & _COMMAND_FLAG_COMPRESSED)
+        seq = msg[1]
+        arg = None
+        if command == _COMMAND_SEND:
+            # <command><seq><offset:u32><length:u32><path...>
+            if len(msg) < 11:
+                continue
+            arg = struct.unpack_from("<II", msg, 2) + (compressed,)
+            file = msg[10:].decode()
+        elif command == _COMMAND_HASH:
+            # <command><seq><algorithm:u8><offset:u32><length:u32><path...>
+            if len(msg) < 12 or msg[2] not in (_HASH_SHA256, _HASH_CRC32):
+                continue
+            arg = struct.unpack_from("<BII", msg, 2)
+            file = msg[11:].decode()
+        elif command == _COMMAND_BLOCKS:
+            # <command><seq><block size:u16><path...>
+            if len(msg) < 5:
+                continue
+            arg = struct.unpack_from("<H", msg, 2)[0]
+            if not arg:
+                continue
+            file = msg[4:].decode()
+        elif command in (_COMMAND_RECV, _COMMAND_PATCH):
+            # Upload: <command><seq><size:u32><path...>.
+            if len(msg) < 7:
+                continue
+            arg = (struct.unpack_from("<I", msg, 2)[0], compressed)
+            file = msg[6:].decode()
+        elif command == _COMMAND_LIST:
+            # <command><seq><cursor:u16><limit:u16><prefix len:u8><prefix...><path...>
+            if len(msg) < 7 or len(msg) < 7 + msg[6]:
+                continue
+            cursor, limit = struct.unpack_from("<HH", msg, 2)
+            arg = (cursor, limit, msg[7 : 7 + msg[6]].decode())
+            file = msg[7 + msg[6] :].decode()
+        else:
+            file = msg[2:].decode()
+
+        compressible = command in (_COMMAND_SEND, _COMMAND_RECV, _COMMAND_PATCH)
+        if compressed and (deflate is None or not compressible):
+            send_done_notification(connection, seq, _STATUS_NOT_IMPLEMENTED)
+        elif command in (
+            _COMMAND_SEND,
+            _COMMAND_RECV,
+            _COMMAND_LIST,
+            _COMMAND_HASH,
+            _COMMAND_BLOCKS,
+            _COMMAND_PATCH,
+        ):
+            if not session.queue.put((command, seq, file, arg)):
+                send_done_notification(connection, seq, _STATUS_BUSY)
+        elif command == _COMMAND_SIZE:
+            try:
+                stat = os.stat(file)
+                size = stat[6]
+                status = 0
+            except OSError:
+                size = 0
+                status = _STATUS_NOT_FOUND
+            control_characteristic.notify(
+                connection, struct.pack("<BBI", seq, status, size)
+            )
+
+
+# Keep advertising while there is room for another session, so several
+# centrals can be connected (and queue commands) at once.
 async def peripheral_task():
     while True:
+        while len(sessions) >= _MAX_CONNECTIONS:
+            session_closed.clear()
+            await session_closed.wait()
         print("Waiting for connection")
         connection = await aioble.advertise(
             _ADV_INTERVAL_MS,
@@ -166,17 +762,15 @@ async def peripheral_task():
             services=[_FILE_SERVICE_UUID],
         )
         print("Connection from", connection.device)
-
-        t = asyncio.create_task(l2cap_task(connection))
-        await control_task(connection)
-        t.cancel()
-
-        await connection.disconnected()
+        asyncio.create_task(Session(connection).serve())
 
 
 # Run both tasks.
 async def main():
+    asyncio.create_task(control_task())
     await peripheral_task()
 
 
-asyncio.run(main())
\ No newline at end of file
+# Imported by mpysync.py's loopback transport, which drives the tasks itself.
+if __name__ == "__main__":
+    asyncio.run(main())
\ No newline at end of file
@@ -0,0 +1,440 @@
+# Delta sync of a directory (normally .mpyFiles) to a device running the ex1.py file server, run on the host:
+#
+#   python mpysync.py --address AA:BB:CC:DD:EE:FF [--src .mpyFiles] [--verify]
+#   python mpysync.py --loopback DIR [--src .mpyFiles] [--gatt-ms 7.5]
+#
+# The manifest (--manifest, .mpysync.json by default) keeps the SHA-256 of every file as last pushed to each
+# device, so unchanged files cost nothing; --verify asks the device for its hashes instead of trusting the
+# manifest. A changed file is fetched as per-block CRC32s (BLOCKS), matched against the new content at every
+# offset, and only the unmatched bytes go out in a delta (PATCH). The device rebuilds the file next to the old
+# one and swaps it in once the SHA-256 from the delta header matches, so a dropped link never leaves a
+# half-written module behind. A file the device doesn't have is sent as one literal delta. Deltas are
+# compressed when the device has the deflate module. Files on the device that are no longer in the source
+# are left alone, and directories have to exist on the device already.
+#
+# --address needs Linux with BlueZ, bleak for the control characteristic and Python 3.12+ for LE L2CAP
+# sockets. --loopback runs ex1.py's tasks in-process on the simulated radio (sim/) with DIR as the device's
+# filesystem, each L2CAP SDU costing one --gatt-ms interval.
+
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import socket
+import struct
+import sys
+import time
+import zlib
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Must match ex1.py.
+CONTROL_CHARACTERISTIC_UUID = "0492fcec-7194-11eb-9439-0242ac130003"
+L2CAP_PSM = 22
+L2CAP_MTU = 512  # The device's receive MTU, the largest SDU we may send
+ATT_MTU = 64  # A command has to fit in one write of ATT_MTU - 3 bytes, the device cuts longer ones short
+COMMAND_DONE = 4
+COMMAND_HASH = 6
+COMMAND_BLOCKS = 7
+COMMAND_PATCH = 8
+COMMAND_FLAG_COMPRESSED = 0x80
+HASH_SHA256 = 0
+STATUS_OK = 0
+STATUS_NOT_IMPLEMENTED = 1
+STATUS_NOT_FOUND = 2
+DELTA_COPY = 0
+DELTA_DATA = 1
+DEFLATE_WBITS = 10
+
+REPLY_TIMEOUT_S = 30
+CHANNEL_TIMEOUT_S = 120  # The device has one L2CAP channel, other centrals may be taking their turns
+REPLY_GRACE_S = 1  # The device notifies the reply before it closes the channel, it may still be in flight
+MAX_PATH = ATT_MTU - 3 - 11  # HASH has the longest header of the commands we send
+SKIP = ("__pycache__",)
+
+
+def local_files(src: str) -> dict[str, bytes]:
+    files = {}
+    for dirpath, dirnames, filenames in os.walk(src):
+        dirnames[:] = sorted(d for d in dirnames if d not in SKIP and not d.startswith("."))
+        for name in sorted(filenames):
+            if name.startswith("."):
+                continue
+            path = os.path.join(dirpath, name)
+            with open(path, "rb") as f:
+                files[os.path.relpath(path, src).replace(os.sep, "/")] = f.read()
+    return files
+
+
+# Delta from the device's block CRCs: every full block of the old file is looked up by the CRC32 of the
+# window at each offset of the new content, so blocks that only moved (lines added above them) are still
+# copied. A CRC32 collision gives a wrong copy, which the device catches with the SHA-256 in the header.
+def make_delta(new: bytes, crcs: list[int], block_size: int, old_size: int) -> bytes:
+    index = {}
+    for i, crc in enumerate(crcs):
+        if (i + 1) * block_size <= old_size:
+            index.setdefault(crc, i)
+    ops = []
+    literal = 0
+    i = 0
+    while i + block_size <= len(new) and index:
+        block = index.get(zlib.crc32(new[i : i + block_size]))
+        if block is None:
+            i += 1
+            continue
+        if literal < i:
+            ops.append((DELTA_DATA, new[literal:i]))
+        offset = block * block_size
+        if ops and ops[-1][0] == DELTA_COPY and sum(ops[-1][1]) == offset:
+            ops[-1] = (DELTA_COPY, (ops[-1][1][0], ops[-1][1][1] + block_size))
+        else:
+            ops.append((DELTA_COPY, (offset, block_size)))
+        i += block_size
+        literal = i
+    if literal < len(new):
+        ops.append((DELTA_DATA, new[literal:]))
+
+    out = [struct.pack("<I32s", len(new), hashlib.sha256(new).digest())]
+    for op, arg in ops:
+        if op == DELTA_COPY:
+            out.append(struct.pack("<BII", DELTA_COPY, *arg))
+        else:
+            out.append(struct.pack("<BI", DELTA_DATA, len(arg)) + arg)
+    return b"".join(out)
+
+
+# Client side of the file server protocol. Replies are matched to requests by seq, so requests could be
+# pipelined up to the device's queue depth; the sync below keeps it to one file at a time. Every command runs
+# on the device's turn on the channel, so the channel is opened after writing it. The device closes it between
+# operations to let another central have a turn: closed before the reply means the command hasn't run yet.
+class FileServer:
+    def __init__(self, transport):
+        self.transport = transport
+        self.seq = 0
+        self.replies: dict[int, asyncio.Future] = {}
+        self.compress = None  # Unknown until the first delta
+        self.sent = 0  # Bytes written to the channel
+
+    async def run(self):
+        while True:
+            msg = await self.transport.notifications.get()
+            if len(msg) >= 3 and msg[0] == COMMAND_DONE:
+                reply = self.replies.pop(msg[1], None)
+                if reply is not None and not reply.done():
+                    reply.set_result((msg[2], msg[3:]))
+
+    async def request(self, command: int, args: bytes, path: str, data: bytes = b""):
+        path = (self.transport.root + path).encode()
+        if 2 + len(args) + len(path) > ATT_MTU - 3:
+            raise ValueError("{}: too long for a command".format(path.decode()))
+        self.seq = (self.seq + 1) & 0xFF
+        reply = self.replies[self.seq] = asyncio.get_running_loop().create_future()
+        await self.transport.write(bytes((command, self.seq)) + args + path)
+        while True:
+            await self.transport.open_channel()
+            closed = asyncio.ensure_future(self.transport.channel_closed())
+            try:
+                if data:
+                    await self.transport.send(data)
+                    self.sent += len(data)
+                await asyncio.wait((reply, closed), timeout=REPLY_TIMEOUT_S, return_when=asyncio.FIRST_COMPLETED)
+            except ConnectionError:
+                await closed  # Closed while sending, the data went nowhere
+            finally:
+                closed.cancel()
+            if reply.done():
+                return reply.result()
+            if not closed.done():
+                raise asyncio.TimeoutError
+            try:
+                return await asyncio.wait_for(asyncio.shield(reply), REPLY_GRACE_S)
+            except asyncio.TimeoutError:
+                pass  # Ours again next turn, with the data sent again
+
+    async def sha256(self, path: str):
+        status, extra = await self.request(COMMAND_HASH, struct.pack("<BII", HASH_SHA256, 0, 0), path)
+        return extra[1:33] if status == STATUS_OK else None
+
+    async def blocks(self, path: str, block_size: int):
+        status, extra = await self.request(COMMAND_BLOCKS, struct.pack("<H", block_size), path)
+        if status != STATUS_OK:
+            return 0, []
+        size = struct.unpack_from("<I", extra)[0]
+        count = (size + block_size - 1) // block_size
+        data = await self.transport.recv(4 * count)
+        return size, list(struct.unpack("<%dI" % count, data))
+
+    async def patch(self, path: str, delta: bytes) -> tuple[int, int]:
+        if self.compress is None:
+            # An empty compressed delta only fails on a device with deflate, without it the answer is
+            # NOT_IMPLEMENTED before anything is read from the channel.
+            status, _ = await self.request(COMMAND_PATCH | COMMAND_FLAG_COMPRESSED, struct.pack("<I", 0), path)
+            self.compress = status != STATUS_NOT_IMPLEMENTED
+        if self.compress:
+            z = zlib.compressobj(9, zlib.DEFLATED, DEFLATE_WBITS)
+            delta = z.compress(delta) + z.flush()
+        command = COMMAND_PATCH | (COMMAND_FLAG_COMPRESSED if self.compress else 0)
+        status, _ = await self.request(command, struct.pack("<I", len(delta)), path, delta)
+        return status, len(delta)
+
+
+# The file server runs with DIR as its working directory, so paths are as short as on the device.
+class LoopbackTransport:
+    def __init__(self, root: str, gatt_ms: float, verbose=False):
+        self.dir = os.path.abspath(root)
+        self.root = ""
+        self.name = "loopback"
+        self.gatt_ms = gatt_ms
+        self.verbose = verbose
+        self.notifications: asyncio.Queue = asyncio.Queue()
+
+    async def open(self):
+        sys.path[:0] = [os.path.join(HERE, "sim"), HERE]
+        import aioble
+        import ex1
+        from simradio import radio
+
+        radio.configure(gatt_ms=self.gatt_ms)
+        self.cwd = os.getcwd()
+        os.chdir(self.dir)
+        if not self.verbose:
+            ex1.print = lambda *args, **kwargs: None
+        self.ex1 = ex1
+        self.radio = radio
+        self.connection = aioble.DeviceConnection(aioble.Device(0, b"\x02\x00\x00\x00\x00\x01"), 1, self)
+        aioble._server_connections[1] = self
+        self.tasks = [
+            asyncio.create_task(ex1.Session(self.connection).serve()),
+            asyncio.create_task(ex1.control_task()),
+        ]
+        self.aioble = aioble
+        self.channel = None
+        self.buf = bytearray(L2CAP_MTU)
+
+    async def open_channel(self):
+        if not self.channel_is_closed():
+            return
+        deadline = time.monotonic() + CHANNEL_TIMEOUT_S
+        while True:
+            try:
+                self.channel = await self.connection.l2cap_connect(self.ex1._L2CAP_PSN, L2CAP_MTU)
+                return
+            except self.aioble.L2CAPConnectionError:
+                if time.monotonic() > deadline:
+                    raise
+
+    def channel_is_closed(self) -> bool:
+        return self.channel is None or not self.channel._is_open()
+
+    async def channel_closed(self):
+        while not self.channel_is_closed():
+            await asyncio.sleep(0.005)
+
+    def on_notify(self, value_handle, data):
+        self.notifications.put_nowait(bytes(data))
+
+    def on_disconnect(self):
+        pass
+
+    async def write(self, msg: bytes):
+        await self.radio.delay(self.gatt_ms)
+        self.ex1.control_characteristic._remote_write(self.connection, msg)
+
+    async def send(self, data: bytes):
+        try:
+            await self.channel.send(data)
+        except self.aioble.L2CAPDisconnectedError:
+            raise ConnectionError("channel closed")
+
+    async def recv(self, n: int) -> bytes:
+        data = bytearray()
+        while len(data) < n:
+            try:
+                k = await self.channel.recvinto(memoryview(self.buf)[: n - len(data)], REPLY_TIMEOUT_S * 1000)
+            except self.aioble.L2CAPDisconnectedError:
+                raise ConnectionError("channel closed")
+            data += self.buf[:k]
+        return bytes(data)
+
+    async def close(self):
+        for task in self.tasks:
+            task.cancel()
+        self.connection._on_disconnect()
+        os.chdir(self.cwd)
+
+
+# GATT through bleak, the channel through a BlueZ LE L2CAP socket to the same device.
+class BleTransport:
+    def __init__(self, address: str, root=""):
+        self.root = root
+        self.name = address.upper()
+        self.address = address
+        self.notifications: asyncio.Queue = asyncio.Queue()
+
+    async def open(self):
+        from bleak import BleakClient
+
+        self.client = BleakClient(self.address)
+        await self.client.connect()
+        await self.client.start_notify(
+            CONTROL_CHARACTERISTIC_UUID, lambda _, data: self.notifications.put_nowait(bytes(data))
+        )
+        self.sock = None
+        self.closed = asyncio.Event()
+        self.closed.set()
+
+    async def open_channel(self):
+        if self.sock is not None:
+            return
+        loop = asyncio.get_running_loop()
+        addr_type = getattr(socket, "BDADDR_LE_PUBLIC", 1)
+        deadline = time.monotonic() + CHANNEL_TIMEOUT_S
+        while True:  # Refused until it's our turn
+            sock = socket.socket(socket.AF_BLUETOOTH, socket.SOCK_SEQPACKET, socket.BTPROTO_L2CAP)
+            try:
+                await loop.run_in_executor(None, sock.connect, (self.address, L2CAP_PSM, 0, addr_type))
+                break
+            except OSError:
+                sock.close()
+                if time.monotonic() > deadline:
+                    raise
+                await asyncio.sleep(1)
+        sock.setblocking(False)
+        self.sock = sock
+        self.closed.clear()
+        self.pending = b""
+        self.sdus: asyncio.Queue = asyncio.Queue()
+        self.reader = asyncio.create_task(self.read_channel(sock))
+
+    # Reads ahead, so a close is noticed while waiting for a reply. b"" marks the end of the channel.
+    async def read_channel(self, sock):
+        loop = asyncio.get_running_loop()
+        try:
+            while sdu := await loop.sock_recv(sock, 65535):
+                self.sdus.put_nowait(sdu)
+        except OSError:
+            pass
+        sock.close()
+        self.sdus.put_nowait(b"")
+        self.sock = None
+        self.closed.set()
+
+    async def channel_closed(self):
+        await self.closed.wait()
+
+    async def write(self, msg: bytes):
+        await self.client.write_gatt_char(CONTROL_CHARACTERISTIC_UUID, msg, response=True)
+
+    async def send(self, data: bytes):
+        loop = asyncio.get_running_loop()
+        try:
+            for offset in range(0, len(data), L2CAP_MTU):  # One SDU per packet
+                if self.sock is None:
+                    raise OSError
+                await loop.sock_sendall(self.sock, data[offset : offset + L2CAP_MTU])
+        except OSError:
+            raise ConnectionError("channel closed")
+
+    async def recv(self, n: int) -> bytes:
+        while len(self.pending) < n:
+            sdu = await asyncio.wait_for(self.sdus.get(), REPLY_TIMEOUT_S)
+            if not sdu:
+                raise ConnectionError("channel closed")
+            self.pending += sdu
+        data, self.pending = self.pending[:n], self.pending[n:]
+        return data
+
+    async def close(self):
+        if self.sock is not None:
+            self.reader.cancel()
+            self.sock.close()
+        await self.client.disconnect()
+
+
+def load_manifest(path: str) -> dict:
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_manifest(path: str, manifest: dict):
+    with open(path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(path + ".tmp", path)
+
+
+async def sync(transport, args) -> int:
+    files = local_files(args.src)
+    manifest = load_manifest(args.manifest)
+    pushed = manifest.setdefault(transport.name, {})
+    start = time.perf_counter()
+    await transport.open()
+    server = FileServer(transport)
+    reader = asyncio.create_task(server.run())
+    changed = failed = 0
+    raw = 0
+    try:
+        for path, data in files.items():
+            digest = hashlib.sha256(data).digest()
+            if len((transport.root + path).encode()) > MAX_PATH:
+                print("{}: path too long for the device's commands".format(path))
+                failed += 1
+                continue
+            if not args.verify and pushed.get(path) == digest.hex():
+                continue
+            if args.verify and await server.sha256(path) == digest:
+                pushed[path] = digest.hex()
+                continue
+            old_size, crcs = await server.blocks(path, args.block_size)
+            status, sent = await server.patch(path, make_delta(data, crcs, args.block_size, old_size))
+            if status != STATUS_OK and crcs:
+                # Most likely a CRC32 collision in the matching, send the whole file instead.
+                status, sent = await server.patch(path, make_delta(data, [], args.block_size, 0))
+            if status != STATUS_OK:
+                print("{}: failed ({})".format(path, status))
+                failed += 1
+                continue
+            print("{}: {} B, {} B delta".format(path, len(data), sent))
+            pushed[path] = digest.hex()
+            save_manifest(args.manifest, manifest)  # An interrupted rollout picks up from here
+            changed += 1
+            raw += len(data)
+    finally:
+        reader.cancel()
+        await transport.close()
+        save_manifest(args.manifest, manifest)
+    print(
+        "{}: {} of {} files updated, {} B on the channel for {} B of files, {:.2f} s".format(
+            transport.name, changed, len(files), server.sent, raw, time.perf_counter() - start
+        )
+    )
+    return 1 if failed else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Delta sync of a directory to an ex1.py file server")
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("--address", help="BLE address of the device")
+    target.add_argument("--loopback", metavar="DIR", help="sync into DIR through the simulated radio")
+    parser.add_argument("--src", default=os.path.join(HERE, ".mpyFiles"))
+    parser.add_argument("--manifest", default=".mpysync.json")
+    parser.add_argument("--block-size", type=int, default=256)
+    parser.add_argument("--verify", action="store_true", help="check the device's hashes, not the manifest")
+    parser.add_argument("--root", default="", help="path prefix on the device")
+    parser.add_argument("--gatt-ms", type=float, default=7.5, help="loopback: latency of one SDU or write")
+    parser.add_argument("--verbose", action="store_true", help="loopback: keep the file server's prints")
+    args = parser.parse_args()
+    args.manifest = os.path.abspath(args.manifest)  # The loopback changes directory
+
+    if args.loopback:
+        transport = LoopbackTransport(args.loopback, args.gatt_ms, args.verbose)
+    else:
+        transport = BleTransport(args.address, args.root)
+    sys.exit(asyncio.run(sync(transport, args)))
+
+
+if __name__ == "__main__":
+    main()
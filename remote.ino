@@ -10,12 +10,23 @@
 
 #include "esp_timer.h"
 #include "inttypes.h"
+#include "mbedtls/md.h"
 
 #define REMOTE_SERVICE_UUID "A9DCFE62-41AF-49E3-ADC0-000000000000"
 #define REMOTE_PAIRING_CHAR_UUID "A9DCFE62-41AF-49E3-ADC0-000000000001"
 #define REMOTE_NOTIFY_CHAR_UUID "A9DCFE62-41AF-49E3-ADC0-000000000002"
+#define REMOTE_ACK_CHAR_UUID "A9DCFE62-41AF-49E3-ADC0-000000000003"
 
 #define KEY_FILE "/key"
+#define COUNTER_FILE "/counter"
+
+// 1: send paired presses as an authenticated advertisement (RemoteHandler.TRANSPORT_ADV)
+// 0: wait for the receiver to connect and notify (RemoteHandler.TRANSPORT_GATT)
+#define TRANSPORT_ADV 0
+#define ADV_COMMAND_MS 100
+#define NOTIFY_LINGER_MS 1000  // Without an ack (older receivers), the link stays up this long after the last press
+#define SUBSCRIBE_TIMEOUT_MS 10000
+#define DEBOUNCE_MS 50
 
 // Default pairing key -- includes manufacturer-data
 String default_key = "rl-default";
@@ -25,6 +36,7 @@ String remote_key = "";
 BLEServer* pServer;
 BLECharacteristic* pairingChar;
 BLECharacteristic* notifyChar;
+BLECharacteristic* ackChar;
 BLEAdvertising* pAdvertising;
 
 #define INCREASE_PIN 12
@@ -33,8 +45,21 @@ BLEAdvertising* pAdvertising;
 bool connected = false;
 bool received = false;
 
-volatile bool incr_pressed = false;
-volatile bool decr_pressed = false;
+// Presses since the last notification, summed so presses made while the link comes up go out as one message
+volatile int8_t pending_step = 0;
+volatile uint32_t last_press_ms = 0;
+RTC_DATA_ATTR uint16_t notify_seq = 0;  // Survives deep sleep, the receiver drops repeats of a seq
+volatile uint16_t acked_seq = 0;
+
+void IRAM_ATTR add_press(int8_t step) {
+    uint32_t now = millis();
+    if (now - last_press_ms < DEBOUNCE_MS) return;
+    last_press_ms = now;
+    if (pending_step + step >= -127 && pending_step + step <= 127) pending_step += step;
+}
+
+void IRAM_ATTR on_increase() { add_press(1); }
+void IRAM_ATTR on_decrease() { add_press(-1); }
 
 class MyServerCallbacks : public BLEServerCallbacks {
     void onConnect(BLEServer* pServer) {
@@ -56,10 +81,19 @@ class PairingCallback : public BLECharacteristicCallbacks {
         if (!f) abort();
         f.write((const uint8_t*)value.c_str(), value.length());
         f.close();
+        SPIFFS.remove(COUNTER_FILE);  // New key, the receiver starts counting from zero again
         remote_key = value;
     }
 };
 
+// Ack: <seq:u16 LE><level:u8>, written by the receiver once it applied the notification with that seq
+class AckCallback : public BLECharacteristicCallbacks {
+    void onWrite(BLECharacteristic* pChar) {
+        uint8_t* data = pChar->getData();
+        if (pChar->getLength() >= 2) acked_seq = data[0] | (data[1] << 8);
+    }
+};
+
 class NotifyCallback : public BLEDescriptorCallbacks {
     void onNotify(BLECharacteristic* pChar) {
     }
@@ -70,8 +104,8 @@ void setup() {
     // digitalWrite(RGB_BUILTIN, HIGH);
     pinMode(INCREASE_PIN, INPUT_PULLUP);
     pinMode(DECREASE_PIN, INPUT_PULLUP);
-    attachInterrupt(digitalPinToInterrupt(INCREASE_PIN), NULL, FALLING);
-    attachInterrupt(digitalPinToInterrupt(DECREASE_PIN), NULL, FALLING);
+    attachInterrupt(digitalPinToInterrupt(INCREASE_PIN), on_increase, FALLING);
+    attachInterrupt(digitalPinToInterrupt(DECREASE_PIN), on_decrease, FALLING);
 
     Serial.begin(115200);
     delay(100);
@@ -100,6 +134,11 @@ void ble_handler() {
         BLECharacteristic::PROPERTY_NOTIFY | BLECharacteristic::PROPERTY_READ);
     notifyChar->addDescriptor(new BLE2902());
 
+    ackChar = pService->createCharacteristic(
+        REMOTE_ACK_CHAR_UUID,
+        BLECharacteristic::PROPERTY_WRITE | BLECharacteristic::PROPERTY_WRITE_NR);
+    ackChar->setCallbacks(new AckCallback());
+
     pService->start();
 
     BLEAdvertising* pAdvertising = BLEDevice::getAdvertising();
@@ -110,24 +149,101 @@ void ble_handler() {
     pAdvertising->start();
 }
 
+bool subscribed() {
+    BLE2902* cccd = (BLE2902*)notifyChar->getDescriptorByUUID(BLEUUID((uint16_t)0x2902));
+    return cccd && cccd->getNotifications();
+}
+
+// Notification: <step:i8><seq:u16 LE>, step is the sum of the presses since the last notification
+bool send_pending() {
+    noInterrupts();
+    int8_t step = pending_step;
+    pending_step = 0;
+    interrupts();
+    if (!step) return false;
+    notify_seq++;
+    uint8_t msg[3] = {(uint8_t)step, (uint8_t)(notify_seq & 0xFF), (uint8_t)(notify_seq >> 8)};
+    notifyChar->setValue(msg, sizeof(msg));
+    notifyChar->notify();
+    return true;
+}
+
+uint32_t next_counter() {
+    uint32_t counter = 0;
+    File f = SPIFFS.open(COUNTER_FILE, "r");
+    if (f && f.size() == sizeof(counter)) f.read((uint8_t*)&counter, sizeof(counter));
+    if (f) f.close();
+    counter++;
+    f = SPIFFS.open(COUNTER_FILE, "w");
+    if (!f) abort();
+    f.write((const uint8_t*)&counter, sizeof(counter));
+    f.close();
+    return counter;
+}
+
+// Manufacturer data: <0xCA 0xFE><key id:2><counter:u32 LE><step:i8><tag:4>
+// key id = sha256(key)[:2], tag = hmac_sha256(key, key id + counter + step)[:4]
+void send_adv_command(int8_t step) {
+    const mbedtls_md_info_t* sha256 = mbedtls_md_info_from_type(MBEDTLS_MD_SHA256);
+    const uint8_t* key = (const uint8_t*)remote_key.c_str();
+    uint8_t digest[32];
+    uint8_t frame[13] = {0xCA, 0xFE};
+
+    mbedtls_md(sha256, key, remote_key.length(), digest);
+    frame[2] = digest[0];
+    frame[3] = digest[1];
+    uint32_t counter = next_counter();
+    for (int i = 0; i < 4; i++) frame[4 + i] = (counter >> (8 * i)) & 0xFF;
+    frame[8] = (uint8_t)step;
+    mbedtls_md_hmac(sha256, key, remote_key.length(), frame + 2, 7, digest);
+    memcpy(frame + 9, digest, 4);
+
+    BLEDevice::init("");
+    BLEAdvertisementData advData;
+    advData.setFlags(0x04);
+    advData.setManufacturerData(String((const char*)frame, sizeof(frame)));
+    pAdvertising = BLEDevice::getAdvertising();
+    pAdvertising->setAdvertisementData(advData);
+    pAdvertising->setAdvertisementType(ADV_TYPE_NONCONN_IND);
+    pAdvertising->setMinInterval(0x20);  // 20 ms
+    pAdvertising->setMaxInterval(0x20);
+    pAdvertising->start();
+    delay(ADV_COMMAND_MS);
+    pAdvertising->stop();
+}
+
 void loop() {
     if (esp_sleep_get_wakeup_cause() == ESP_SLEEP_WAKEUP_EXT1) {
         uint64_t wakePinMask = esp_sleep_get_ext1_wakeup_status();
 
+        if (TRANSPORT_ADV && getDeviceName() != default_key) {
+            send_adv_command((wakePinMask & (1ULL << INCREASE_PIN)) ? 1 : -1);
+            Serial.println("BLE advertisement sent, going to deep sleep...");
+            esp_sleep_enable_ext1_wakeup(
+                (1ULL << INCREASE_PIN) | (1ULL << DECREASE_PIN),
+                ESP_EXT1_WAKEUP_ANY_LOW);
+            esp_deep_sleep_start();
+        }
+
+        add_press((wakePinMask & (1ULL << INCREASE_PIN)) ? 1 : -1);
         ble_handler();
         Serial.println("Button pressed, waiting for BLE connection...");
-        while (!connected) delay(5);
-
-        bool increase = (wakePinMask & (1ULL << INCREASE_PIN));
-        String c = (increase) ? "1" : "0";
-        delay(500);
-        notifyChar->setValue(c);
-        notifyChar->notify();
-        delay(1500);
-        delay(500);
-        notifyChar->setValue(c);
-        notifyChar->notify();
-        delay(1500);
+        uint32_t start = millis();
+        while (!(connected && subscribed()) && millis() - start < SUBSCRIBE_TIMEOUT_MS) delay(5);
+
+        // The first pass sends what was pressed while the link came up, however long that took. Presses keep
+        // coming in from the interrupts while connected, each batch is one notification. Sleep as soon as the
+        // receiver acked everything that was sent, or NOTIFY_LINGER_MS after the last send or press (whichever
+        // is later) without an ack.
+        acked_seq = notify_seq;
+        uint32_t last_send_ms = millis();
+        while (connected) {
+            if (send_pending()) last_send_ms = millis();
+            if (acked_seq == notify_seq && !pending_step) break;
+            uint32_t now = millis();
+            if (now - last_send_ms >= NOTIFY_LINGER_MS && now - last_press_ms >= NOTIFY_LINGER_MS) break;
+            delay(5);
+        }
         Serial.println("BLE notification sent, going to deep sleep...");
     }
     esp_sleep_enable_ext1_wakeup(
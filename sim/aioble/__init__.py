@@ -0,0 +1,571 @@
+# Stand-in for aioble on top of the simulated radio. The API follows micropython-lib's aioble closely
+# enough for the receivers: scanning, Device/DeviceConnection, GATT client discovery, reads, writes and
+# notifications, a GATT server with advertise() for the peripheral side, and L2CAP channels between the
+# two ends of one connection.
+
+import asyncio
+import errno
+import struct
+from collections import deque
+
+import bluetooth
+from simradio import radio
+
+_ADV_TYPE_NAME = 0x09
+_ADV_TYPE_UUID16_COMPLETE = 0x03
+_ADV_TYPE_UUID32_COMPLETE = 0x05
+_ADV_TYPE_UUID128_COMPLETE = 0x07
+_ADV_TYPE_UUID16_MORE = 0x02
+_ADV_TYPE_UUID32_MORE = 0x04
+_ADV_TYPE_UUID128_MORE = 0x06
+_ADV_TYPE_MANUFACTURER = 0xFF
+
+_CCCD_UUID = bluetooth.UUID(0x2902)
+
+
+class GattError(Exception):
+    def __init__(self, status=0):
+        super().__init__(status)
+        self._status = status
+
+
+class DeviceDisconnectedError(Exception):
+    pass
+
+
+def config(*args, **kwargs):
+    return bluetooth.BLE().config(*args, **kwargs)
+
+
+class Device:
+    def __init__(self, addr_type, addr):
+        self.addr_type = addr_type
+        self.addr = bytes(addr)
+        self._connection = None
+
+    def __eq__(self, other):
+        return isinstance(other, Device) and self.addr_type == other.addr_type and self.addr == other.addr
+
+    def __hash__(self):
+        return hash((self.addr_type, self.addr))
+
+    def __str__(self):
+        return "Device({}, {})".format(self.addr_type, self.addr_hex())
+
+    def addr_hex(self):
+        return ":".join("{:02x}".format(b) for b in self.addr)
+
+    async def connect(self, timeout_ms=10000, scan_duration_ms=None, min_conn_interval_us=None, max_conn_interval_us=None):
+        # MicroPython's gap_connect() initiates for 2 s unless told otherwise.
+        self._connection = await radio.connect(self, timeout_ms, scan_duration_ms or 2000)
+        return self._connection
+
+
+class _Timeout:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+class DeviceConnection:
+    def __init__(self, device, conn_handle, peripheral):
+        self.device = device
+        self._conn_handle = conn_handle
+        self._peripheral = peripheral
+        self._characteristics = {}
+        self._task = None
+        self._disconnected = asyncio.Event()
+        self.mtu = None  # Like aioble, only set once an MTU exchange happened
+        self.encrypted = False
+        self.authenticated = False
+        self.bonded = False
+        self.key_size = False
+
+    def is_connected(self):
+        return not self._disconnected.is_set()
+
+    def timeout(self, timeout_ms):
+        return _Timeout()
+
+    async def disconnect(self, timeout_ms=2000):
+        if self.is_connected():
+            await radio.delay(radio.gatt_ms)
+            self._on_disconnect()
+
+    def _on_disconnect(self):
+        if not self._disconnected.is_set():
+            self._disconnected.set()
+            for characteristic in self._characteristics.values():
+                characteristic._notify_event.set()  # Wake notified() so it raises
+            self._peripheral.on_disconnect()
+
+    async def disconnected(self, timeout_ms=60000, disconnect=False):
+        if disconnect:
+            await self.disconnect()
+        await asyncio.wait_for(self._disconnected.wait(), timeout_ms / 1000 if timeout_ms else None)
+
+    async def exchange_mtu(self, mtu=None, timeout_ms=1000):
+        await self._request()
+        self.mtu = min(mtu or bluetooth.BLE().config("mtu"), 517)
+        return self.mtu
+
+    async def _request(self):
+        if not self.is_connected():
+            raise DeviceDisconnectedError
+        await radio.delay(radio.gatt_ms)
+        if not self.is_connected():
+            raise DeviceDisconnectedError
+
+    async def services(self, uuid=None, timeout_ms=2000):
+        await self._request()
+        for start_handle, end_handle, service_uuid in self._peripheral.services:
+            if uuid is None or uuid == service_uuid:
+                yield ClientService(self, start_handle, end_handle, service_uuid)
+
+    async def service(self, uuid, timeout_ms=2000):
+        async for service in self.services(uuid, timeout_ms):
+            return service
+        return None
+
+    def _on_notify(self, value_handle, data):
+        characteristic = self._characteristics.get(value_handle)
+        if characteristic is not None:
+            characteristic._on_notify(data)
+
+    async def l2cap_accept(self, psm, mtu, timeout_ms=None):
+        global _l2cap_channel
+        # MicroPython has a single L2CAP channel: listening again while it's open, or while another
+        # connection listens, fails with EALREADY.
+        if _l2cap_listeners or (_l2cap_channel is not None and _l2cap_channel._is_open()):
+            raise OSError(errno.EALREADY)
+        listener = asyncio.get_running_loop().create_future()
+        _l2cap_listeners[(self._conn_handle, psm)] = (listener, mtu)
+        try:
+            _l2cap_channel = await asyncio.wait_for(listener, timeout_ms / 1000 if timeout_ms else None)
+            return _l2cap_channel
+        finally:
+            _l2cap_listeners.pop((self._conn_handle, psm), None)
+
+    # The other end of the connection calls this with the same conn handle, like a central opening a
+    # channel to the peripheral that accepts it.
+    async def l2cap_connect(self, psm, mtu, timeout_ms=1000):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout_ms / 1000
+        while (self._conn_handle, psm) not in _l2cap_listeners:
+            if loop.time() > deadline:
+                raise L2CAPConnectionError
+            await asyncio.sleep(0.001)
+        listener, accept_mtu = _l2cap_listeners.pop((self._conn_handle, psm))
+        await self._request()
+        ours = L2CAPChannel(self, mtu, accept_mtu)
+        theirs = L2CAPChannel(self, accept_mtu, mtu)
+        ours._peer = theirs
+        theirs._peer = ours
+        listener.set_result(theirs)
+        return ours
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_traceback):
+        await self.disconnect()
+
+
+class ClientService:
+    def __init__(self, connection, start_handle, end_handle, uuid):
+        self.connection = connection
+        self._start_handle = start_handle
+        self._end_handle = end_handle
+        self.uuid = uuid
+
+    def __str__(self):
+        return "Service: {} {} {}".format(self._start_handle, self._end_handle, self.uuid)
+
+    async def characteristics(self, uuid=None, timeout_ms=2000):
+        await self.connection._request()
+        found = [c for c in self.connection._peripheral.characteristics if self._start_handle <= c[0] <= self._end_handle]
+        for i, (def_handle, value_handle, properties, char_uuid, _) in enumerate(found):
+            end_handle = found[i + 1][0] - 1 if i + 1 < len(found) else self._end_handle
+            if uuid is None or uuid == char_uuid:
+                yield ClientCharacteristic(self, end_handle, value_handle, properties, char_uuid)
+
+    async def characteristic(self, uuid, timeout_ms=2000):
+        async for characteristic in self.characteristics(uuid, timeout_ms):
+            return characteristic
+        return None
+
+
+class BaseClientCharacteristic:
+    def __init__(self, value_handle, properties, uuid):
+        self._value_handle = value_handle
+        self.properties = properties
+        self.uuid = uuid
+
+    def _connection(self):
+        raise NotImplementedError
+
+    def _valid(self, handle):
+        peripheral = self._connection()._peripheral
+        for def_handle, value_handle, _, _, descriptors in peripheral.characteristics:
+            if handle == value_handle or any(handle == h for h, _ in descriptors):
+                return True
+        return False
+
+    async def read(self, timeout_ms=1000):
+        connection = self._connection()
+        await connection._request()
+        if not self._valid(self._value_handle):
+            raise GattError(0x01)  # Invalid handle
+        return connection._peripheral.values.get(self._value_handle, b"")
+
+    async def write(self, data, response=None, timeout_ms=1000):
+        connection = self._connection()
+        if isinstance(data, str):
+            data = data.encode()
+        if response:
+            await connection._request()
+        elif not connection.is_connected():
+            raise DeviceDisconnectedError
+        if not self._valid(self._value_handle):
+            if response:
+                raise GattError(0x01)
+            return
+        if response:
+            connection._peripheral.on_write(self._value_handle, bytes(data))
+        else:  # Returns right away, the peripheral gets it with the next connection event
+            asyncio.get_running_loop().call_later(
+                radio.gatt_ms / 1000, self._deliver, connection, self._value_handle, bytes(data)
+            )
+
+    @staticmethod
+    def _deliver(connection, handle, data):
+        if connection.is_connected():
+            connection._peripheral.on_write(handle, data)
+
+
+class ClientCharacteristic(BaseClientCharacteristic):
+    def __init__(self, service, end_handle, value_handle, properties, uuid):
+        self.service = service
+        self.connection = service.connection
+        self._end_handle = end_handle
+        super().__init__(value_handle, properties, uuid)
+        self._notify_event = asyncio.Event()
+        self._notify_queue = deque((), 1)
+        self.connection._characteristics[value_handle] = self
+
+    def __str__(self):
+        return "Characteristic: {} {} {} {}".format(self._end_handle, self._value_handle, self.properties, self.uuid)
+
+    def _connection(self):
+        return self.service.connection
+
+    def _on_notify(self, data):
+        self._notify_queue.append(data)
+        self._notify_event.set()
+
+    async def notified(self, timeout_ms=None):
+        while not self._notify_queue:
+            if not self.connection.is_connected():
+                raise DeviceDisconnectedError
+            self._notify_event.clear()
+            await asyncio.wait_for(self._notify_event.wait(), timeout_ms / 1000 if timeout_ms else None)
+        return self._notify_queue.popleft()
+
+    async def descriptors(self, uuid=None, timeout_ms=2000):
+        await self.connection._request()
+        for def_handle, value_handle, _, _, descriptors in self.connection._peripheral.characteristics:
+            if value_handle == self._value_handle:
+                for handle, dsc_uuid in descriptors:
+                    if uuid is None or uuid == dsc_uuid:
+                        yield ClientDescriptor(self, handle, dsc_uuid)
+
+    async def descriptor(self, uuid, timeout_ms=2000):
+        async for descriptor in self.descriptors(uuid, timeout_ms):
+            return descriptor
+        return None
+
+    async def subscribe(self, notify=True, indicate=False):
+        cccd = await self.descriptor(_CCCD_UUID)
+        if cccd is not None:
+            await cccd.write(struct.pack("<H", (1 if notify else 0) | (2 if indicate else 0)), True)
+
+
+class ClientDescriptor(BaseClientCharacteristic):
+    def __init__(self, characteristic, dsc_handle, uuid):
+        self.characteristic = characteristic
+        super().__init__(dsc_handle, bluetooth.FLAG_READ | bluetooth.FLAG_WRITE, uuid)
+
+    def _connection(self):
+        return self.characteristic.service.connection
+
+
+class ScanResult:
+    def __init__(self, adv):
+        self.device = Device(adv.addr_type, adv.addr)
+        self.adv_data = adv.adv_data
+        self.resp_data = adv.resp_data
+        self.rssi = adv.rssi
+        self.connectable = adv.adv_type in (0x00, 0x01)
+
+    def __str__(self):
+        return "Scan result: {} {}".format(self.device, self.rssi)
+
+    def _decode_field(self, *adv_type):
+        for payload in (self.adv_data, self.resp_data):
+            if not payload:
+                continue
+            i = 0
+            while i + 1 < len(payload):
+                if payload[i + 1] in adv_type:
+                    yield payload[i + 2 : i + payload[i] + 1]
+                i += 1 + payload[i]
+
+    def name(self):
+        for n in self._decode_field(_ADV_TYPE_NAME):
+            return str(n, "utf-8") if n else ""
+
+    def services(self):
+        for u in self._decode_field(_ADV_TYPE_UUID16_COMPLETE, _ADV_TYPE_UUID16_MORE):
+            yield bluetooth.UUID(struct.unpack("<H", u)[0])
+        for u in self._decode_field(_ADV_TYPE_UUID32_COMPLETE, _ADV_TYPE_UUID32_MORE):
+            yield bluetooth.UUID(struct.unpack("<I", u)[0])
+        for u in self._decode_field(_ADV_TYPE_UUID128_COMPLETE, _ADV_TYPE_UUID128_MORE):
+            yield bluetooth.UUID(u)
+
+    def manufacturer(self, filter=None):
+        for u in self._decode_field(_ADV_TYPE_MANUFACTURER):
+            if len(u) < 2:
+                continue
+            m = struct.unpack("<H", u[0:2])[0]
+            if filter is None or m == filter:
+                yield (m, u[2:])
+
+
+class scan:
+    def __init__(self, duration_ms, interval_us=1280000, window_us=11250, active=False, **kwargs):
+        self._duration_ms = duration_ms
+        self._queue = None
+        self._deadline = None
+
+    async def __aenter__(self):
+        loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue()
+        self._deadline = loop.time() + self._duration_ms / 1000 if self._duration_ms else None
+        radio.scanners.append(self._queue)
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_traceback):
+        await self.cancel()
+
+    async def cancel(self):
+        if self._queue in radio.scanners:
+            radio.scanners.remove(self._queue)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if radio.on_scan_result is not None:
+            radio.on_scan_result()
+        if self._deadline is None:
+            adv = await self._queue.get()
+        else:
+            timeout = self._deadline - asyncio.get_running_loop().time()
+            if timeout <= 0:
+                raise StopAsyncIteration
+            try:
+                adv = await asyncio.wait_for(self._queue.get(), timeout)
+            except asyncio.TimeoutError:
+                raise StopAsyncIteration
+        return ScanResult(adv)
+
+
+class L2CAPDisconnectedError(Exception):
+    pass
+
+
+class L2CAPConnectionError(Exception):
+    pass
+
+
+_l2cap_listeners: dict = {}  # (conn handle, psm) -> (future for the accepted channel, mtu)
+_l2cap_channel = None  # The last accepted channel
+
+
+# Each send() is split into SDUs of the peer's MTU, one GATT interval apiece, and queued at the other
+# end. recvinto() hands out at most one SDU per call, like aioble on top of the controller's buffers.
+class L2CAPChannel:
+    def __init__(self, connection, our_mtu, peer_mtu):
+        self._connection = connection
+        self.our_mtu = our_mtu
+        self.peer_mtu = peer_mtu
+        self._peer = None
+        self._sdus = deque()
+        self._offset = 0
+        self._event = asyncio.Event()
+        self._open = True
+
+    def _is_open(self):
+        return self._open and self._connection.is_connected()
+
+    def _assert_connected(self):
+        if not self._is_open():
+            raise L2CAPDisconnectedError
+
+    def available(self):
+        return bool(self._sdus)
+
+    async def recvinto(self, buf, timeout_ms=None):
+        while not self._sdus:
+            self._assert_connected()
+            self._event.clear()
+            await asyncio.wait_for(self._event.wait(), timeout_ms / 1000 if timeout_ms else None)
+        sdu = self._sdus[0]
+        n = min(len(buf), len(sdu) - self._offset)
+        buf[:n] = sdu[self._offset : self._offset + n]
+        self._offset += n
+        if self._offset == len(sdu):
+            self._sdus.popleft()
+            self._offset = 0
+        return n
+
+    async def send(self, buf, timeout_ms=None, chunk_size=None):
+        mv = memoryview(buf)
+        size = min(chunk_size or self.peer_mtu, self.peer_mtu)
+        for offset in range(0, len(mv), size):
+            self._assert_connected()
+            await radio.delay(radio.gatt_ms)
+            self._peer._sdus.append(bytes(mv[offset : offset + size]))
+            self._peer._event.set()
+
+    async def flush(self, timeout_ms=None):
+        self._assert_connected()
+
+    async def disconnect(self, timeout_ms=1000):
+        for channel in (self, self._peer):
+            channel._open = False
+            channel._event.set()
+
+    async def disconnected(self, timeout_ms=1000):
+        pass
+
+
+# GATT server side.
+
+
+class Service:
+    def __init__(self, uuid):
+        self.uuid = uuid
+        self.characteristics = []
+
+
+class BaseCharacteristic:
+    def _register(self, value_handle):
+        self._value_handle = value_handle
+        _registered[value_handle] = self
+        if self._initial is not None:
+            self.write(self._initial)
+            self._initial = None
+
+    def read(self):
+        return bluetooth.BLE().gatts_read(self._value_handle)
+
+    def write(self, data, send_update=False):
+        if isinstance(data, str):
+            data = data.encode()
+        bluetooth.BLE().gatts_write(self._value_handle, data)
+        if send_update:
+            for central in list(_server_connections.values()):
+                central.on_notify(self._value_handle, self.read())
+
+    async def written(self, timeout_ms=None):
+        while not self._write_queue:
+            self._write_event.clear()
+            await asyncio.wait_for(self._write_event.wait(), timeout_ms / 1000 if timeout_ms else None)
+        return self._write_queue.popleft()
+
+    def _remote_write(self, connection, data):
+        data = bluetooth.BLE()._gatts_remote_write(self._value_handle, data)
+        self._write_queue.append((connection, data) if self._capture else connection)
+        self._write_event.set()
+
+
+class Characteristic(BaseCharacteristic):
+    def __init__(
+        self,
+        service,
+        uuid,
+        read=False,
+        write=False,
+        write_no_response=False,
+        notify=False,
+        indicate=False,
+        initial=None,
+        capture=False,
+    ):
+        service.characteristics.append(self)
+        self.descriptors = []
+        self.uuid = uuid
+        self._initial = initial
+        self._capture = capture
+        self._value_handle = None
+        self._write_event = asyncio.Event()
+        self._write_queue = deque((), 64 if capture else 1)
+
+    def notify(self, connection, data=None):
+        central = _server_connections.get(connection._conn_handle)
+        if central is not None:
+            central.on_notify(self._value_handle, bytes(data) if data is not None else self.read())
+
+    async def indicate(self, connection, data=None, timeout_ms=1000):
+        self.notify(connection, data)
+        await radio.delay(radio.gatt_ms)
+
+
+BufferedCharacteristic = Characteristic
+
+_registered: dict[int, BaseCharacteristic] = {}
+_server_connections: dict = {}  # conn handle -> simulated central, anything with on_notify(handle, data)
+_advertising = None
+
+
+def register_services(*services):
+    handle = 0
+    for service in services:
+        handle += 1
+        for characteristic in service.characteristics:
+            handle += 2
+            characteristic._register(handle)
+            handle += len(characteristic.descriptors)
+
+
+# Nothing connects to the receiver's own services in the benchmarks, advertising just runs into its timeout.
+# A test can complete aioble._advertising with a DeviceConnection to fake a phone connecting.
+async def advertise(
+    interval_us,
+    adv_data=None,
+    resp_data=None,
+    connectable=True,
+    limited_disc=False,
+    include_tx_power=False,
+    name=None,
+    services=None,
+    appearance=0,
+    manufacturer=None,
+    timeout_ms=None,
+):
+    global _advertising
+    _advertising = asyncio.get_running_loop().create_future() if connectable else None
+    try:
+        if _advertising is None:
+            await asyncio.sleep(timeout_ms / 1000 if timeout_ms else 0)
+            raise asyncio.TimeoutError
+        return await asyncio.wait_for(_advertising, timeout_ms / 1000 if timeout_ms else None)
+    finally:
+        _advertising = None
+
+
+def stop():
+    pass
@@ -0,0 +1 @@
+from . import ScanResult, scan  # noqa: F401
@@ -0,0 +1 @@
+from . import BaseClientCharacteristic, ClientCharacteristic, ClientDescriptor, ClientService  # noqa: F401
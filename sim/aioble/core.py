@@ -0,0 +1 @@
+from . import GattError, config  # noqa: F401
@@ -0,0 +1 @@
+from . import Device, DeviceConnection, DeviceDisconnectedError  # noqa: F401
@@ -0,0 +1 @@
+from . import L2CAPChannel, L2CAPConnectionError, L2CAPDisconnectedError  # noqa: F401
@@ -0,0 +1 @@
+from . import advertise  # noqa: F401
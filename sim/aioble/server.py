@@ -0,0 +1 @@
+from . import BaseCharacteristic, BufferedCharacteristic, Characteristic, Service, register_services  # noqa: F401
@@ -0,0 +1,379 @@
+# Benchmarks for the receivers on the simulated radio, run from the repo root:
+#
+#   python sim/bench.py [--presses 200] [--adverts 2000] [--remotes 20] [--connect-ms 7.5] [--gatt-ms 7.5] [--fade-ms 0]
+#
+# Scan throughput is scan results handled per second of host CPU, so only compare runs from the same machine.
+# Press latency runs from SimRemote.press() to the first PWM duty write, a press that never gets there is
+# counted as lost. The idle tier and slow link runs cover what a fast link at full duty hides: direct connects
+# in the last radio tier, and connecting plus subscribing taking longer than the remote's linger. Heap is the
+# peak allocation while one scan result is handled (tracemalloc on CPython, gc.mem_alloc() with the collector
+# off on MicroPython). The phone runs connect a SimPhone to phone.py's PhoneHandler: a config upload in MTU sized
+# DATA writes, from BEGIN to the END status, and patches, from the write to the notified version.
+# Everything runs in a temporary directory, the receivers' files are created from scratch.
+
+import argparse
+import asyncio
+import contextlib
+import gc
+import io
+import os
+import struct
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+sys.path.insert(1, os.path.join(HERE, "..", ".mpyFiles"))
+sys.path.insert(2, os.path.join(HERE, ".."))  # receiver.py
+
+import aioble  # noqa: E402
+import bluetooth  # noqa: E402
+import simradio  # noqa: E402
+from machine import PWM  # noqa: E402
+from simradio import Advertisement, SimPhone, SimRemote, adv_field, adv_payload, radio  # noqa: E402
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+PRESS_TIMEOUT_S = 12  # Longer than SimRemote's subscribe timeout, a press not handled by then is lost
+PRESS_GAP_MS = 5  # Idle time between presses, so every press starts from a closed connection
+UPLOAD_PROFILES = 8  # Config for the upload runs, profiles of UPLOAD_STEPS steps
+UPLOAD_STEPS = 32
+
+
+class HeapMeter:
+    def start(self):
+        if tracemalloc is not None:
+            tracemalloc.start()
+            self.base = tracemalloc.get_traced_memory()[0]
+        else:
+            gc.collect()
+            gc.disable()
+            self.base = gc.mem_alloc()
+
+    def reset(self):
+        if tracemalloc is not None:
+            tracemalloc.reset_peak()
+            self.base = tracemalloc.get_traced_memory()[0]
+        else:
+            self.base = gc.mem_alloc()
+
+    def used(self) -> int:
+        if tracemalloc is not None:
+            return tracemalloc.get_traced_memory()[1] - self.base
+        return gc.mem_alloc() - self.base
+
+    def stop(self):
+        if tracemalloc is not None:
+            tracemalloc.stop()
+        else:
+            gc.enable()
+
+
+def latency_line(latencies: list) -> str:
+    return "p50 {:>6.2f} ms  p90 {:>6.2f} ms  p99 {:>6.2f} ms".format(
+        percentile(latencies, 50), percentile(latencies, 90), percentile(latencies, 99)
+    )
+
+
+def percentile(values: list, p: float):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+
+def report(name: str, line: str):
+    print("{:<28} {}".format(name, line), file=sys.__stdout__)  # Still shown while the receivers are muted
+
+
+# Advertisers in range that aren't the remote: phones, tags and beacons with names, services and
+# manufacturer data, so every field of a result gets decoded.
+def foreign_trace(count: int) -> list[Advertisement]:
+    trace = []
+    for i in range(count):
+        addr = bytes((0x10, 0x20, 0x30, 0x40, i >> 8 & 0xFF, i & 0xFF))
+        adv_data = adv_payload(name="dev-%d" % (i % 50), services=[bluetooth.UUID(0x180F + i % 4)])
+        adv_data += adv_field(0xFF, bytes((0x4C, 0x00, 0x02, 0x15)) + bytes(16))
+        trace.append(Advertisement(0, addr, simradio.ADV_IND, -70 - i % 20, adv_data))
+    return trace
+
+
+# Command frames from the paired remote that have to be rejected: repeats of an old counter and frames
+# for another receiver's key.
+def stale_adv_trace(remote: SimRemote, count: int) -> list[Advertisement]:
+    trace = []
+    for i in range(count):
+        frame = (b"\x00\x00" if i % 2 else b"\xff\xff") + bytes(9)
+        adv_data = adv_payload(manufacturer=(0xFECA, frame), connectable=False)
+        trace.append(Advertisement(0, remote.addr, simradio.ADV_NONCONN_IND, -60, adv_data))
+    return trace
+
+
+# RemoteHandler.handle_conn() swallows CancelledError, so a cancel can land there and the loop goes on. The
+# controller would keep initiating a direct connect of the stopped handler, cancel it like gap_connect(None).
+async def stop(task):
+    while not task.done():
+        task.cancel()
+        await asyncio.sleep(0.001)
+    if radio.initiating is not None:
+        radio.initiating.cancel()
+
+
+async def wait_drained():
+    await radio.drained()
+    await asyncio.sleep(0)  # Let the scanner finish handling the last result
+
+
+async def scan_throughput(name: str, trace: list[Advertisement], heap_samples: int):
+    await asyncio.sleep(0.01)  # Scanner up
+    start = time.perf_counter()
+    radio.replay(trace)
+    await wait_drained()
+    elapsed = time.perf_counter() - start
+
+    heap = HeapMeter()
+    heap.start()
+    peaks = []
+    for adv in trace[:heap_samples]:
+        heap.reset()
+        radio.emit(adv)
+        await wait_drained()
+        peaks.append(heap.used())
+    heap.stop()
+    report(
+        name,
+        "{:>9.0f} results/s  heap/result avg {:>5.0f} B  max {:>5} B".format(
+            len(trace) / elapsed, sum(peaks) / len(peaks), max(peaks)
+        ),
+    )
+
+
+async def press_latency(name: str, remote: SimRemote, pwm: PWM, presses: int, press, before=None):
+    latencies = []
+    awake = []
+    lost = 0
+    for _ in range(presses):
+        if before is not None:
+            before()
+        written = len(pwm.history)
+        pwm.written.clear()
+        await press()
+        pressed_us = remote.pressed_us[-1]
+        slept = len(remote.sleep_us)
+        try:
+            while len(pwm.history) == written:
+                await asyncio.wait_for(pwm.written.wait(), PRESS_TIMEOUT_S)
+                pwm.written.clear()
+        except asyncio.TimeoutError:
+            lost += 1
+        else:
+            latencies.append((pwm.history[written][0] - pressed_us) / 1000)
+        while remote.connection is not None or remote._advertising_task is not None:
+            await asyncio.sleep(0.001)
+        if len(remote.sleep_us) > slept and len(pwm.history) > written:
+            awake.append((remote.sleep_us[-1] - pressed_us) / 1000)
+        await asyncio.sleep(PRESS_GAP_MS / 1000)
+    if latencies:
+        line = latency_line(latencies)
+    else:
+        line = "no press handled"
+    if awake:  # Press to the remote going back to sleep
+        line += "  remote awake p50 {:>7.2f} ms".format(percentile(awake, 50))
+    if lost:
+        line += "  LOST {}".format(lost)
+    report(name, "{}  ({} presses)".format(line, presses))
+
+
+async def run(args):
+    import boot
+
+    boot.load_config()
+    boot.state_file = boot.StateFile(boot.STATE_FILE)
+    ble = bluetooth.BLE()
+    ble.active(True)
+    scheduler = boot.RadioScheduler(boot.radio_tiers)
+    led = boot.LED(26, boot.duty_tables[boot.current_setting][boot.setting_index], fade_ms=args.fade_ms)
+    pwm = led.led
+    remote = SimRemote()
+    foreign = foreign_trace(args.adverts)
+
+    def quiet():
+        return contextlib.redirect_stdout(io.StringIO()) if not args.verbose else contextlib.nullcontext()
+
+    # Unpaired receiver: every result is decoded and compared against the default key.
+    handler = boot.RemoteHandler(ble, led, scheduler, boot.RemoteHandler.TRANSPORT_GATT)
+    task = asyncio.create_task(handler.serve())
+    with quiet():
+        await scan_throughput("scan gatt (unpaired)", foreign, args.heap_samples)
+
+    # Pairing press, then direct connects to the stored address.
+    async def press():
+        remote.press()
+
+    with quiet():
+        await press_latency("press gatt (pairing)", remote, pwm, 1, press)
+    assert remote.key in handler.registry.by_key
+    # Only one remote and the pairing window closed, so presses go through the direct connect.
+    with quiet():
+        await press_latency("press gatt (cached)", remote, pwm, args.presses, press)
+        await press_latency(
+            "press gatt (discovery)", remote, pwm, args.presses, press, lambda: handler.handle_cache.clear()
+        )
+    with quiet():
+        await stop(task)
+
+    # Receiver in its last radio tier, so the direct connect alternates short windows with sleeps.
+    few = max(5, args.presses // 10)
+    scheduler.tiers = boot.radio_tiers[-1:]
+    cycle_ms = scheduler.tiers[0][1] // 1000
+    idle_presses = [0]
+
+    async def press_idle():
+        # Land presses all over the window/sleep cycle, not just at the start of a direct connect round.
+        idle_presses[0] += 1
+        await asyncio.sleep(idle_presses[0] * 97 % cycle_ms / 1000)
+        remote.press()
+
+    handler = boot.RemoteHandler(ble, led, scheduler, boot.RemoteHandler.TRANSPORT_GATT)
+    task = asyncio.create_task(handler.serve())
+    with quiet():
+        await press_latency("press gatt (idle tier)", remote, pwm, few, press_idle)
+        await stop(task)
+    scheduler.tiers = boot.radio_tiers
+
+    # Connecting and subscribing take longer than the remote lingers after a press, the step has to arrive anyway.
+    radio.configure(max(args.connect_ms, remote.linger_ms + 500), args.gatt_ms, args.adv_interval_ms)
+    handler = boot.RemoteHandler(ble, led, scheduler, boot.RemoteHandler.TRANSPORT_GATT)
+    task = asyncio.create_task(handler.serve())
+    with quiet():
+        await press_latency("press gatt (slow link)", remote, pwm, few, press)
+        await stop(task)
+    radio.configure(args.connect_ms, args.gatt_ms, args.adv_interval_ms)
+
+    # More remotes paired (wall and handhelds): the receiver scans and matches names against the registry.
+    for i in range(args.remotes - 1):
+        handler.registry.save(boot.Remote("rl-bench%011d" % i))
+    handler = boot.RemoteHandler(ble, led, scheduler, boot.RemoteHandler.TRANSPORT_GATT)
+    task = asyncio.create_task(handler.serve())
+    with quiet():
+        await scan_throughput("scan gatt (%d remotes)" % len(handler.registry), foreign, args.heap_samples)
+        await stop(task)
+
+    handler = boot.RemoteHandler(ble, led, scheduler, boot.RemoteHandler.TRANSPORT_ADV)
+    task = asyncio.create_task(handler.serve())
+    counter = [handler.registry.get(remote.key).last_counter]
+
+    async def press_adv():
+        counter[0] += 1
+        await remote.press_adv(1, counter[0], args.adv_burst_ms)
+
+    with quiet():
+        trace = foreign + stale_adv_trace(remote, len(foreign))
+        await scan_throughput("scan adv (%d remotes)" % len(handler.registry), trace, args.heap_samples)
+        await press_latency("press adv", remote, pwm, args.presses, press_adv)
+    with quiet():
+        await stop(task)
+
+    # The phone app against PhoneHandler, nothing else on the radio.
+    import phone
+
+    phone_handler = phone.PhoneHandler(ble, scheduler, boot.use_profiles, handler)
+    task = asyncio.create_task(phone_handler.serve())
+    sim_phone = SimPhone()
+    with quiet():
+        await sim_phone.connect()
+        await phone_upload(phone_handler, sim_phone, max(5, args.presses // 10))
+        await phone_patches(phone_handler, sim_phone, args.presses)
+        sim_phone.disconnect()
+        await stop(task)
+
+    # The old IRQ receiver handles results synchronously from the radio.
+    os.mkdir("receiver")
+    os.chdir("receiver")
+    with open("stored_remote", "wb") as f:
+        f.write(remote.addr)
+    with quiet():
+        import receiver
+
+        trace = foreign + [
+            Advertisement(0, remote.addr, simradio.ADV_NONCONN_IND, -60, b"\x02\x01\xca\xfe\x12\x34\x02")
+        ] * len(foreign)
+        await scan_throughput("scan irq (receiver.py)", trace, args.heap_samples)
+    receiver.ble.gap_scan(None)
+    os.chdir("..")
+    boot.state_file.flush()
+
+
+async def phone_upload(phone_handler, sim_phone: SimPhone, runs: int):
+    import binascii
+    import json
+
+    config = {"p%d" % i: [j / (UPLOAD_STEPS - 1) for j in range(UPLOAD_STEPS)] for i in range(UPLOAD_PROFILES)}
+    data = json.dumps(config).encode()
+    crc = binascii.crc32(data)
+    chunk = sim_phone.connection.mtu - 3 - 5  # <op><offset:u32> ahead of the bytes
+    characteristic = phone_handler.transfer_characteristic
+    times = []
+    failed = 0
+    for _ in range(runs):
+        start = time.perf_counter()
+        await sim_phone.write(characteristic, struct.pack("<BII", phone_handler.OP_BEGIN, len(data), crc))
+        await sim_phone.notified(characteristic)
+        for offset in range(0, len(data), chunk):
+            frame = struct.pack("<BI", phone_handler.OP_DATA, offset) + data[offset : offset + chunk]
+            await sim_phone.write(characteristic, frame)
+        await sim_phone.write(characteristic, bytes((phone_handler.OP_END,)))
+        reply = await sim_phone.notified(characteristic)
+        if reply[1] != phone_handler.STATUS_OK:
+            failed += 1
+        times.append((time.perf_counter() - start) * 1000)
+    line = "{}  {:>6.0f} B/s".format(latency_line(times), len(data) * 1000 / percentile(times, 50))
+    if failed:
+        line += "  FAILED {}".format(failed)
+    report("phone upload ({} B)".format(len(data)), "{}  ({} uploads)".format(line, runs))
+
+
+async def phone_patches(phone_handler, sim_phone: SimPhone, patches: int):
+    characteristic = phone_handler.patch_characteristic
+    name = b"p0"
+    times = []
+    failed = 0
+    for i in range(patches):
+        frame = bytes((phone_handler.PATCH_SET_STEP, len(name))) + name
+        frame += struct.pack("<Bf", i % UPLOAD_STEPS, (i % 10) / 10)
+        start = time.perf_counter()
+        await sim_phone.write(characteristic, frame)
+        reply = await sim_phone.notified(characteristic)
+        if reply[1] != phone_handler.STATUS_OK:
+            failed += 1
+        times.append((time.perf_counter() - start) * 1000)
+    line = latency_line(times)
+    if failed:
+        line += "  FAILED {}".format(failed)
+    report("phone patch (set step)", "{}  ({} patches)".format(line, patches))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--presses", type=int, default=200)
+    parser.add_argument("--adverts", type=int, default=2000, help="scan results per throughput run")
+    parser.add_argument("--heap-samples", type=int, default=200)
+    parser.add_argument("--remotes", type=int, default=20, help="paired remotes for the second half of the scans")
+    parser.add_argument("--connect-ms", type=float, default=7.5)
+    parser.add_argument("--gatt-ms", type=float, default=7.5, help="latency of one GATT request")
+    parser.add_argument("--adv-interval-ms", type=float, default=20.0, help="remote advertising interval")
+    parser.add_argument("--adv-burst-ms", type=float, default=100.0, help="length of a connectionless press")
+    parser.add_argument("--fade-ms", type=int, default=0, help="LED fade, 0 writes the duty directly")
+    parser.add_argument("--verbose", action="store_true", help="keep the receivers' prints")
+    args = parser.parse_args()
+
+    radio.configure(args.connect_ms, args.gatt_ms, args.adv_interval_ms)
+    os.chdir(tempfile.mkdtemp(prefix="rl-bench-"))
+    print("{} {}".format(sys.implementation.name, sys.version.split()[0]))
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
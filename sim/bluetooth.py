@@ -0,0 +1,133 @@
+# Stand-in for the MicroPython bluetooth module. Only what the receivers use is here: UUIDs, the flag
+# constants and a BLE object whose IRQ handler gets scan results from the simulated radio.
+
+import struct
+
+FLAG_BROADCAST = 0x0001
+FLAG_READ = 0x0002
+FLAG_WRITE_NO_RESPONSE = 0x0004
+FLAG_WRITE = 0x0008
+FLAG_NOTIFY = 0x0010
+FLAG_INDICATE = 0x0020
+
+_IRQ_SCAN_RESULT = 5
+_IRQ_SCAN_DONE = 6
+
+_DEFAULT_ATTR_LEN = 20  # MP_BLUETOOTH_DEFAULT_ATTR_LEN
+
+
+class UUID:
+    def __init__(self, value):
+        if isinstance(value, UUID):
+            self._le = value._le
+        elif isinstance(value, int):
+            self._le = struct.pack("<H", value) if value <= 0xFFFF else struct.pack("<I", value)
+        elif isinstance(value, str):
+            self._le = bytes(reversed(bytes.fromhex(value.replace("-", ""))))
+        else:
+            self._le = bytes(value)  # Raw little-endian bytes, as found in advertising data
+        if len(self._le) not in (2, 4, 16):
+            raise ValueError("invalid UUID")
+
+    def __bytes__(self):
+        return self._le
+
+    def __len__(self):
+        return len(self._le)
+
+    def __eq__(self, other):
+        return isinstance(other, UUID) and self._le == other._le
+
+    def __hash__(self):
+        return hash(self._le)
+
+    def __repr__(self):
+        if len(self._le) == 2:
+            return "UUID(0x{:04x})".format(struct.unpack("<H", self._le)[0])
+        h = bytes(reversed(self._le)).hex().upper()
+        return "UUID('{}-{}-{}-{}-{}')".format(h[:8], h[8:12], h[12:16], h[16:20], h[20:])
+
+
+class BLE:
+    _instance = None
+
+    # Like MicroPython, there is only one BLE object.
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+            cls._instance._active = False
+            cls._instance._irq = None
+            cls._instance._scanning = False
+            cls._instance._config = {"mtu": 23, "gap_name": b"MPY BTSTACK", "mac": (0, b"\xaa\xbb\xcc\xdd\xee\x01")}
+            cls._instance._buffers = {}
+            cls._instance._buffer_len = {}  # value handle -> (allocated length, append)
+        return cls._instance
+
+    def active(self, value=None):
+        if value is not None:
+            self._active = bool(value)
+            if not self._active:
+                self._scanning = False
+        return self._active
+
+    def config(self, *args, **kwargs):
+        if args:
+            return self._config[args[0]]
+        self._config.update(kwargs)
+
+    def irq(self, handler):
+        self._irq = handler
+
+    def gap_scan(self, duration_ms, interval_us=1280000, window_us=11250, active=False):
+        from simradio import radio
+
+        self._scanning = duration_ms is not None
+        radio.set_irq_scanning(self, self._scanning)
+
+    def gap_advertise(self, interval_us, adv_data=None, resp_data=None, connectable=True):
+        from simradio import radio
+
+        radio.set_ble_advertising(self, interval_us, adv_data, resp_data, connectable)
+
+    def _on_scan_result(self, addr_type, addr, adv_type, rssi, adv_data):
+        if self._active and self._scanning and self._irq is not None:
+            self._irq(_IRQ_SCAN_RESULT, (addr_type, memoryview(addr), adv_type, rssi, memoryview(adv_data)))
+
+    def gatts_register_services(self, services):
+        handles = []
+        handle = 0
+        for _, characteristics in services:
+            handle += 1  # Service declaration
+            service_handles = []
+            for characteristic in characteristics:
+                handle += 2  # Declaration and value
+                service_handles.append(handle)
+                for _ in characteristic[2] if len(characteristic) > 2 else ():
+                    handle += 1
+                    service_handles.append(handle)
+            handles.append(tuple(service_handles))
+        return tuple(handles)
+
+    def gatts_read(self, value_handle):
+        return self._buffers.get(value_handle, b"")
+
+    def gatts_write(self, value_handle, data, send_update=False):
+        # A local write grows the buffer to fit; a central's write doesn't (see _gatts_remote_write).
+        length, append = self._buffer_len.get(value_handle, (_DEFAULT_ATTR_LEN, False))
+        self._buffer_len[value_handle] = (max(length, len(data)), append)
+        self._buffers[value_handle] = bytes(data)
+
+    def gatts_set_buffer(self, value_handle, length, append=False):
+        self._buffer_len[value_handle] = (length, append)
+        self._buffers[value_handle] = b""
+
+    def _gatts_remote_write(self, value_handle, data):
+        # Like the NimBLE and BTstack bindings, keep what fits in the buffer and drop the rest without an error.
+        length, append = self._buffer_len.get(value_handle, (_DEFAULT_ATTR_LEN, False))
+        if append:
+            data = self._buffers.get(value_handle, b"") + bytes(data)
+        self._buffers[value_handle] = bytes(data[:length])
+        return self._buffers[value_handle]
+
+    def gatts_notify(self, conn_handle, value_handle, data=None):
+        pass
@@ -0,0 +1,62 @@
+# Stand-in for MicroPython's deflate module on top of zlib: DeflateIO compresses what's written to it into
+# the wrapped stream, and decompresses what's read from it out of the wrapped stream.
+
+import zlib
+
+AUTO = 0
+RAW = 1
+ZLIB = 2
+GZIP = 3
+
+
+class DeflateIO:
+    def __init__(self, stream, format=AUTO, wbits=0, close=False):
+        self._stream = stream
+        self._format = format
+        self._wbits = wbits or 8
+        self._close = close
+        self._compressor = None
+        self._decompressor = None
+        self._pending = b""
+
+    def write(self, data):
+        if self._compressor is None:
+            wbits = max(9, self._wbits)
+            if self._format == RAW:
+                wbits = -wbits
+            elif self._format == GZIP:
+                wbits += 16
+            self._compressor = zlib.compressobj(9, zlib.DEFLATED, wbits)
+        self._stream.write(self._compressor.compress(bytes(data)))
+        return len(data)
+
+    def readinto(self, buf):
+        if self._decompressor is None:
+            wbits = {AUTO: 47, RAW: -15, ZLIB: 15, GZIP: 31}[self._format]
+            self._decompressor = zlib.decompressobj(wbits)
+        while len(self._pending) < len(buf) and not self._decompressor.eof:
+            chunk = self._stream.read(256)
+            if not chunk:
+                break
+            self._pending += self._decompressor.decompress(chunk)
+        n = min(len(buf), len(self._pending))
+        buf[:n] = self._pending[:n]
+        self._pending = self._pending[n:]
+        return n
+
+    def read(self, n=-1):
+        data = b""
+        buf = bytearray(256)
+        while n < 0 or len(data) < n:
+            k = self.readinto(memoryview(buf)[: 256 if n < 0 else min(256, n - len(data))])
+            if not k:
+                break
+            data += buf[:k]
+        return data
+
+    def close(self):
+        if self._compressor is not None:
+            self._stream.write(self._compressor.flush())
+            self._compressor = None
+        if self._close:
+            self._stream.close()
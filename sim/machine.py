@@ -0,0 +1,88 @@
+# Stand-in for the parts of machine the receivers use. PWM keeps a history of duty writes with their
+# ticks_us() so press-to-light latency can be measured, Timer runs its callback from the asyncio loop.
+
+import asyncio
+
+import utime
+
+
+class Pin:
+    IN = 0
+    OUT = 1
+    PULL_UP = 2
+
+    def __init__(self, id, mode=-1, pull=-1, value=None):
+        self.id = id
+        self._value = value or 0
+
+    def value(self, value=None):
+        if value is None:
+            return self._value
+        self._value = value
+
+
+class PWM:
+    instances: list["PWM"] = []
+
+    def __init__(self, pin, freq=1000, duty=0):
+        self.pin = pin
+        self._freq = freq
+        self._duty = duty
+        self.history: list[tuple[int, int]] = []  # (ticks_us, duty)
+        self.written = asyncio.Event()
+        PWM.instances.append(self)
+
+    def freq(self, value=None):
+        if value is None:
+            return self._freq
+        self._freq = value
+
+    def duty(self, value=None):
+        if value is None:
+            return self._duty
+        self._duty = value
+        self.history.append((utime.ticks_us(), value))
+        self.written.set()
+
+    def deinit(self):
+        pass
+
+
+class Timer:
+    ONE_SHOT = 0
+    PERIODIC = 1
+
+    def __init__(self, id=-1, **kwargs):
+        self.id = id
+        self._handle = None
+        if kwargs:
+            self.init(**kwargs)
+
+    def init(self, mode=PERIODIC, period=-1, callback=None, freq=-1):
+        self.deinit()
+        if freq > 0:
+            period = 1000 / freq
+        self._mode = mode
+        self._period = period / 1000
+        self._callback = callback
+        self._handle = asyncio.get_running_loop().call_later(self._period, self._fire)
+
+    def _fire(self):
+        self._handle = None
+        if self._mode == Timer.PERIODIC:
+            self._handle = asyncio.get_running_loop().call_later(self._period, self._fire)
+        if self._callback is not None:
+            self._callback(self)
+
+    def deinit(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+
+def reset():
+    raise SystemExit
+
+
+def freq(value=None):
+    return 240_000_000
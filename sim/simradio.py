@@ -0,0 +1,369 @@
+# Simulated radio shared by the stand-in bluetooth and aioble modules.
+#
+# Advertisements are delivered to every active scanner (aioble.scan() and IRQ-based bluetooth.BLE scans),
+# either one at a time or replayed from a trace. Connections and GATT operations cost the configured
+# latency, so a run behaves like a press on real hardware minus the air time jitter.
+
+import asyncio
+import errno
+import struct
+
+import bluetooth
+import utime
+
+ADV_IND = 0x00
+ADV_NONCONN_IND = 0x03
+
+REMOTE_SERVICE_UUID = bluetooth.UUID("A9DCFE62-41AF-49E3-ADC0-000000000000")
+REMOTE_PAIRING_CHAR_UUID = bluetooth.UUID("A9DCFE62-41AF-49E3-ADC0-000000000001")
+REMOTE_NOTIFY_CHAR_UUID = bluetooth.UUID("A9DCFE62-41AF-49E3-ADC0-000000000002")
+REMOTE_ACK_CHAR_UUID = bluetooth.UUID("A9DCFE62-41AF-49E3-ADC0-000000000003")
+CCCD_UUID = bluetooth.UUID(0x2902)
+
+
+def adv_field(ad_type: int, value: bytes) -> bytes:
+    return struct.pack("BB", len(value) + 1, ad_type) + value
+
+
+def adv_payload(name=None, services=(), manufacturer=None, connectable=True) -> bytes:
+    payload = adv_field(0x01, b"\x06" if connectable else b"\x04")
+    if name:
+        payload += adv_field(0x09, name.encode() if isinstance(name, str) else name)
+    for uuid in services:
+        b = bytes(uuid)
+        payload += adv_field({2: 0x03, 4: 0x05, 16: 0x07}[len(b)], b)
+    if manufacturer is not None:
+        payload += adv_field(0xFF, struct.pack("<H", manufacturer[0]) + manufacturer[1])
+    return payload
+
+
+class Advertisement:
+    __slots__ = ("addr_type", "addr", "adv_type", "rssi", "adv_data", "resp_data")
+
+    def __init__(self, addr_type, addr, adv_type, rssi, adv_data, resp_data=None):
+        self.addr_type = addr_type
+        self.addr = bytes(addr)
+        self.adv_type = adv_type
+        self.rssi = rssi
+        self.adv_data = bytes(adv_data)
+        self.resp_data = bytes(resp_data) if resp_data else None
+
+
+class Radio:
+    def __init__(self):
+        self.configure()
+        self.scanners: list = []  # aioble scan queues
+        self.irq_scanners: list = []  # bluetooth.BLE objects with gap_scan running
+        self.advertisers: dict[bytes, "SimPeripheral"] = {}  # Connectable peripherals by address
+        self._advertisers_changed = asyncio.Event()
+        self.next_conn_handle = 0
+        self.initiating = None  # Task of the running direct connect
+        self.ble_advertising: dict = {}  # bluetooth.BLE -> task emitting its gap_advertise() data
+        self.on_scan_result = None  # Instrumentation hook, called before each aioble scan result is handed out
+
+    # Latencies in ms. One connection interval per GATT request is a fair model for a 7.5 ms interval link.
+    def configure(self, connect_ms=7.5, gatt_ms=7.5, adv_interval_ms=20.0):
+        self.connect_ms = connect_ms
+        self.gatt_ms = gatt_ms
+        self.adv_interval_ms = adv_interval_ms
+
+    async def delay(self, ms):
+        await asyncio.sleep(ms / 1000 if ms > 0 else 0)
+
+    def set_irq_scanning(self, ble, scanning: bool):
+        if scanning and ble not in self.irq_scanners:
+            self.irq_scanners.append(ble)
+        elif not scanning and ble in self.irq_scanners:
+            self.irq_scanners.remove(ble)
+
+    def emit(self, adv: Advertisement):
+        for queue in self.scanners:
+            queue.put_nowait(adv)
+        for ble in self.irq_scanners:
+            ble._on_scan_result(adv.addr_type, adv.addr, adv.adv_type, adv.rssi, adv.adv_data)
+            if adv.resp_data:
+                ble._on_scan_result(adv.addr_type, adv.addr, 0x04, adv.rssi, adv.resp_data)
+
+    def replay(self, trace):
+        for adv in trace:
+            self.emit(adv)
+
+    async def drained(self):
+        while any(queue.qsize() for queue in self.scanners):
+            await asyncio.sleep(0)
+
+    def set_advertising(self, peripheral: "SimPeripheral", advertising: bool):
+        if advertising:
+            self.advertisers[peripheral.addr] = peripheral
+        else:
+            self.advertisers.pop(peripheral.addr, None)
+        self._advertisers_changed.set()
+        self._advertisers_changed = asyncio.Event()
+
+    # Raw advertising from bluetooth.BLE.gap_advertise(), repeated every interval until it's stopped. Scanners
+    # of the same BLE object hear it too, unlike on a real controller.
+    def set_ble_advertising(self, ble, interval_us, adv_data, resp_data, connectable):
+        task = self.ble_advertising.pop(ble, None)
+        if task is not None:
+            task.cancel()
+        if interval_us is None:
+            return
+        addr_type, addr = ble.config("mac")
+        adv_type = ADV_IND if connectable else ADV_NONCONN_IND
+        adv = Advertisement(addr_type, addr, adv_type, -50, adv_data or b"", resp_data)
+        self.ble_advertising[ble] = asyncio.get_running_loop().create_task(self._repeat(adv, interval_us / 1000))
+
+    async def _repeat(self, adv: Advertisement, interval_ms: float):
+        while True:
+            self.emit(adv)
+            await self.delay(interval_ms)
+
+    # Direct connect: the initiator waits for a connectable advertisement from the address. Like gap_connect(),
+    # the controller keeps initiating for scan_ms however long the caller waits: another connect meanwhile
+    # fails with EALREADY, and a connection made after the caller timed out is left to nobody.
+    async def connect(self, device, timeout_ms, scan_ms):
+        if self.initiating is not None and not self.initiating.done():
+            raise OSError(errno.EALREADY)
+        self.initiating = asyncio.get_running_loop().create_task(self._initiate(device, scan_ms))
+        connection = await asyncio.wait_for(asyncio.shield(self.initiating), timeout_ms / 1000 if timeout_ms else None)
+        if connection is None:
+            raise asyncio.TimeoutError
+        return connection
+
+    async def _initiate(self, device, scan_ms):
+        async def heard():
+            while device.addr not in self.advertisers:
+                await self._advertisers_changed.wait()
+
+        try:
+            await asyncio.wait_for(heard(), scan_ms / 1000)  # Scanning stops once the connect request is sent
+        except asyncio.TimeoutError:
+            return None
+        await self.delay(self.connect_ms)
+        peripheral = self.advertisers.get(device.addr)
+        if peripheral is None:
+            return None
+        self.next_conn_handle += 1
+        return peripheral.accept(device, self.next_conn_handle)
+
+
+radio = Radio()
+
+
+class SimPeripheral:
+    def __init__(self, addr: bytes, addr_type=0):
+        self.addr = bytes(addr)
+        self.addr_type = addr_type
+        self.connection = None
+        # (start handle, end handle, uuid) and (def handle, value handle, properties, uuid, [(handle, uuid)])
+        self.services: list[tuple[int, int, bluetooth.UUID]] = []
+        self.characteristics: list[tuple[int, int, int, bluetooth.UUID, list[tuple[int, bluetooth.UUID]]]] = []
+        self.values: dict[int, bytes] = {}
+
+    def accept(self, device, conn_handle):
+        import aioble
+
+        radio.set_advertising(self, False)
+        self.connection = aioble.DeviceConnection(device, conn_handle, self)
+        self.on_connect()
+        return self.connection
+
+    def on_connect(self):
+        pass
+
+    def on_disconnect(self):
+        self.connection = None
+
+    def on_write(self, handle: int, data: bytes):
+        self.values[handle] = bytes(data)
+
+    def notify(self, value_handle: int, data: bytes):
+        if self.connection is not None:
+            self.connection._on_notify(value_handle, bytes(data))
+
+
+# Mirrors remote.ino: a press wakes the remote, which advertises its key as name with the remote service
+# until the receiver connects, and goes back to sleep (dropping the press) if nobody subscribed within
+# subscribe_timeout_ms. Once the receiver subscribed, presses are summed into one <step:i8><seq:u16>
+# notification. The remote sleeps as soon as the receiver acked the last one, or linger_ms after the last
+# send or press (whichever is later) without an ack.
+class SimRemote(SimPeripheral):
+    def __init__(
+        self,
+        addr=b"\x74\x4d\xbd\x60\x36\x31",
+        key="rl-default",
+        addr_type=0,
+        linger_ms=1000,
+        subscribe_timeout_ms=10_000,
+    ):
+        super().__init__(addr, addr_type)
+        self.key = key
+        self.linger_ms = linger_ms
+        self.subscribe_timeout_ms = subscribe_timeout_ms
+        self.pending_step = 0
+        self.last_press_ms = 0
+        self.subscribed = False
+        self.seq = 0
+        self.acked_seq = 0
+        self.pressed_us: list[int] = []
+        self.sleep_us: list[int] = []  # When the remote went back to sleep
+        self.services = [(1, 8, REMOTE_SERVICE_UUID)]
+        self.characteristics = [
+            (2, 3, bluetooth.FLAG_WRITE, REMOTE_PAIRING_CHAR_UUID, []),
+            (4, 5, bluetooth.FLAG_READ | bluetooth.FLAG_NOTIFY, REMOTE_NOTIFY_CHAR_UUID, [(6, CCCD_UUID)]),
+            (7, 8, bluetooth.FLAG_WRITE | bluetooth.FLAG_WRITE_NO_RESPONSE, REMOTE_ACK_CHAR_UUID, []),
+        ]
+        self.pairing_handle = 3
+        self.notify_handle = 5
+        self.cccd_handle = 6
+        self.ack_handle = 8
+        self._advertising_task = None
+
+    def advertisement(self) -> Advertisement:
+        # 128-bit service and name don't both fit in 31 bytes, the name goes in the scan response.
+        return Advertisement(
+            self.addr_type,
+            self.addr,
+            ADV_IND,
+            -60,
+            adv_payload(services=[REMOTE_SERVICE_UUID]),
+            adv_field(0x09, self.key.encode()),
+        )
+
+    def press(self, step=1):
+        self.pressed_us.append(utime.ticks_us())
+        self.last_press_ms = utime.ticks_ms()
+        self.pending_step += step
+        if self.connection is None and self._advertising_task is None:
+            self._advertising_task = asyncio.get_running_loop().create_task(self._advertise())
+
+    async def _advertise(self):
+        self.subscribed = False
+        deadline = utime.ticks_add(utime.ticks_ms(), self.subscribe_timeout_ms)
+        radio.set_advertising(self, True)
+        try:
+            while self.addr in radio.advertisers:
+                if utime.ticks_diff(deadline, utime.ticks_ms()) <= 0:
+                    radio.set_advertising(self, False)
+                    self.pending_step = 0
+                    self.sleep_us.append(utime.ticks_us())  # Nobody connected, the press is lost
+                    return
+                radio.emit(self.advertisement())
+                await radio.delay(radio.adv_interval_ms)
+            # Connected: the firmware keeps waiting for the subscription until the same deadline.
+            while self.connection is not None and not self.subscribed:
+                if utime.ticks_diff(deadline, utime.ticks_ms()) <= 0:
+                    self.pending_step = 0
+                    self.sleep_us.append(utime.ticks_us())
+                    self.connection._on_disconnect()
+                    return
+                await radio.delay(1)
+        finally:
+            if self._advertising_task is asyncio.current_task():  # on_disconnect() may have woken it again
+                self._advertising_task = None
+
+    def on_disconnect(self):
+        super().on_disconnect()
+        self.subscribed = False
+        self.values[self.cccd_handle] = b"\x00\x00"
+        if self.pending_step:  # Presses left over, wake up again
+            self._advertising_task = asyncio.get_running_loop().create_task(self._advertise())
+
+    def on_write(self, handle: int, data: bytes):
+        super().on_write(handle, data)
+        if handle == self.pairing_handle:
+            self.key = bytes(data).decode()
+        elif handle == self.ack_handle and len(data) >= 2:
+            self.acked_seq = struct.unpack_from("<H", data)[0]
+        elif handle == self.cccd_handle and bytes(data)[:1] == b"\x01" and not self.subscribed:
+            self.subscribed = True
+            asyncio.get_running_loop().create_task(self._send_pending())
+
+    # The loop() of remote.ino after the subscription.
+    async def _send_pending(self):
+        await radio.delay(radio.gatt_ms)
+        self.acked_seq = self.seq
+        last_send_ms = utime.ticks_ms()
+        while self.connection is not None:
+            if self.pending_step:
+                self.seq = (self.seq + 1) & 0xFFFF
+                self.notify(self.notify_handle, struct.pack("<bH", self.pending_step, self.seq))
+                self.pending_step = 0
+                last_send_ms = utime.ticks_ms()
+            if self.acked_seq == self.seq and not self.pending_step:
+                break
+            now = utime.ticks_ms()
+            if (
+                utime.ticks_diff(now, last_send_ms) >= self.linger_ms
+                and utime.ticks_diff(now, self.last_press_ms) >= self.linger_ms
+            ):
+                break
+            await radio.delay(1)
+        if self.connection is not None:
+            self.sleep_us.append(utime.ticks_us())
+            self.connection._on_disconnect()  # Deep sleep
+
+    # Connectionless press, the same frame remote.ino's send_adv_command() advertises.
+    async def press_adv(self, step: int, counter: int, burst_ms=100):
+        import hashlib
+
+        import utils
+
+        key = self.key.encode()
+        body = hashlib.sha256(key).digest()[:2] + struct.pack("<Ib", counter, step)
+        frame = body + utils.hmac_sha256(key, body)[:4]
+        adv = Advertisement(self.addr_type, self.addr, ADV_NONCONN_IND, -60, adv_payload(manufacturer=(0xFECA, frame)))
+        self.pressed_us.append(utime.ticks_us())
+        for _ in range(max(1, int(burst_ms // radio.adv_interval_ms))):
+            radio.emit(adv)
+            await radio.delay(radio.adv_interval_ms)
+
+
+# The phone app, the central side of phone.py's PhoneHandler. It connects by completing aioble._advertising,
+# like a phone answering the receiver's advertising, exchanges MTUs and writes characteristics one GATT
+# interval apiece. Notifications are queued as (value handle, data).
+class SimPhone:
+    def __init__(self, addr=b"\x5a\x10\x20\x30\x40\x50", conn_handle=0x40):
+        self.addr = bytes(addr)
+        self.conn_handle = conn_handle
+        self.connection = None
+        self.notifications: asyncio.Queue = asyncio.Queue()
+
+    async def connect(self, mtu=247):
+        import aioble
+
+        while True:
+            advertising = aioble._advertising
+            if advertising is not None and not advertising.done():
+                await radio.delay(radio.connect_ms)
+                if aioble._advertising is advertising and not advertising.done():
+                    break
+            await radio.delay(1)
+        self.connection = aioble.DeviceConnection(aioble.Device(0, self.addr), self.conn_handle, self)
+        aioble._server_connections[self.conn_handle] = self
+        advertising.set_result(self.connection)
+        await self.connection.exchange_mtu(mtu)
+
+    def disconnect(self):
+        if self.connection is not None:
+            self.connection._on_disconnect()
+
+    def on_disconnect(self):
+        import aioble
+
+        aioble._server_connections.pop(self.conn_handle, None)
+        self.connection = None
+
+    def on_notify(self, value_handle: int, data: bytes):
+        self.notifications.put_nowait((value_handle, bytes(data)))
+
+    async def write(self, characteristic, data: bytes):
+        await radio.delay(radio.gatt_ms)
+        characteristic._remote_write(self.connection, data)
+
+    # Next notification of one characteristic, the others' are dropped.
+    async def notified(self, characteristic, timeout_s=5) -> bytes:
+        while True:
+            value_handle, data = await asyncio.wait_for(self.notifications.get(), timeout_s)
+            if value_handle == characteristic._value_handle:
+                return data
@@ -0,0 +1,27 @@
+# Stand-in for MicroPython's uasyncio on top of the host asyncio.
+
+import asyncio as _asyncio
+from asyncio import *  # noqa: F403
+
+
+def sleep_ms(ms):
+    return _asyncio.sleep(ms / 1000)
+
+
+async def wait_for_ms(aw, timeout):
+    return await _asyncio.wait_for(aw, timeout / 1000)
+
+
+class ThreadSafeFlag:
+    def __init__(self):
+        self._event = _asyncio.Event()
+
+    def set(self):
+        self._event.set()
+
+    def clear(self):
+        self._event.clear()
+
+    async def wait(self):
+        await self._event.wait()
+        self._event.clear()
@@ -0,0 +1,10 @@
+# Stand-in for MicroPython's uos, adds the ilistdir() the file server uses.
+
+import os as _os
+from os import *  # noqa: F403
+
+
+def ilistdir(path="."):
+    for entry in _os.scandir(path):
+        st = entry.stat()
+        yield (entry.name, 0x4000 if entry.is_dir() else 0x8000, st.st_ino, st.st_size)
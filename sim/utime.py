@@ -0,0 +1,39 @@
+# Stand-in for MicroPython's utime. Ticks count from when the simulator was imported, like ticks count
+# from reset on a board. MicroPython's time module has the same functions, so they are added to the
+# host time module as well (utils.py uses time.ticks_us).
+
+import time
+
+_start = time.monotonic_ns()
+
+
+def ticks_ms():
+    return (time.monotonic_ns() - _start) // 1_000_000
+
+
+def ticks_us():
+    return (time.monotonic_ns() - _start) // 1_000
+
+
+def ticks_diff(end, start):
+    return end - start
+
+
+def ticks_add(ticks, delta):
+    return ticks + delta
+
+
+def sleep_ms(ms):
+    time.sleep(ms / 1000)
+
+
+def sleep_us(us):
+    time.sleep(us / 1_000_000)
+
+
+sleep = time.sleep
+time_ns = time.time_ns
+
+for _name in ("ticks_ms", "ticks_us", "ticks_diff", "ticks_add", "sleep_ms", "sleep_us"):
+    if not hasattr(time, _name):
+        setattr(time, _name, globals()[_name])